@@ -0,0 +1,255 @@
+"""ASGI entry point: uvicorn asgi:app (or gunicorn -k uvicorn.workers.UvicornWorker asgi:app)
+
+POST /api/sensor_data runs natively on the event loop with the async
+Firestore and Gemini clients, so one process keeps many sensor uploads in
+flight while they wait on the network. Every other route, and the async
+and stream variants of /api/sensor_data, is served by the Flask app on a
+thread pool with unchanged behaviour.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from flask_limiter import RateLimitExceeded
+from google.api_core.exceptions import AlreadyExists
+
+from main import ASYNC_SUGGESTIONS, app as flask_app, limiter, start_background_services
+from main import dashboard_snapshots, feature_summaries, firebase_service, gemini_service
+from main import outbox, quota_check, usage_aggregator
+from services.metrics import ERRORS, REQUEST_LATENCY
+from services.outbox import TRANSIENT_ERRORS
+from services.quota import QuotaExceeded
+
+REQUIRED_FIELDS = ["temperature", "humidity", "noise"]
+
+wsgi_app = WSGIMiddleware(flask_app, workers=int(os.getenv("ASGI_WSGI_THREADS", "32")))
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def replay(body, receive):
+    """A receive callable that hands an already read body to the WSGI bridge"""
+    sent = False
+
+    async def replayed():
+        nonlocal sent
+        if sent:
+            # Sau body chỉ còn chờ sự kiện ngắt kết nối thật từ client
+            return await receive()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replayed
+
+
+async def send_json(send, status, payload, headers=()):
+    # Cùng định dạng với jsonify (compact, sort_keys, xuống dòng cuối)
+    body = (flask_app.json.dumps(payload, separators=(",", ":")) + "\n").encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                *headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def remote_address(scope):
+    client = scope.get("client")
+    return client[0] if client else "127.0.0.1"
+
+
+def check_rate_limit(scope):
+    """Breached limit of POST /api/sensor_data for this client, or None.
+
+    Flask-Limiter evaluates the request itself, so the ASGI path gets the
+    same limits (route, default and application limits, by the same
+    override rules) and hits the same counters as the Flask route.
+    """
+    with flask_app.test_request_context(
+        "/api/sensor_data",
+        method="POST",
+        environ_base={"REMOTE_ADDR": remote_address(scope)},
+    ):
+        try:
+            limiter.check()
+        except RateLimitExceeded as e:
+            return e.description
+    return None
+
+
+async def save_reading_async(user_id, reading_data):
+    """Async main.save_reading: write on the event loop, queue on disk on failure"""
+    if not outbox:
+        return await firebase_service.save_sensor_reading_async(user_id, reading_data), False
+
+    loop = asyncio.get_running_loop()
+    document_id = uuid.uuid4().hex
+    if outbox.accepting_direct_writes:
+        try:
+            await firebase_service.save_sensor_reading_async(
+                user_id, reading_data, document_id=document_id, timeout=outbox.write_timeout
+            )
+            return document_id, False
+        except AlreadyExists:
+            return document_id, False
+        except TRANSIENT_ERRORS as e:
+            outbox.direct_write_failed(e)
+    # fsync của outbox không chạy trên event loop
+    await loop.run_in_executor(None, outbox.enqueue, user_id, reading_data, document_id)
+    return document_id, True
+
+
+async def receive_sensor_data(scope, data):
+    """Async twin of main.receive_sensor_data for the synchronous suggestion path"""
+    if limiter.enabled:
+        # Bộ đếm có thể nằm trên Redis, không gọi trên event loop
+        breached = await asyncio.get_running_loop().run_in_executor(
+            None, check_rate_limit, scope
+        )
+        if breached is not None:
+            return 429, {"error": f"Rate limit exceeded: {breached}"}
+
+    try:
+        user_id = data.get("user_id")
+        if not user_id:
+            return 400, {"error": "Missing user_id"}
+
+        if not all(field in data for field in REQUIRED_FIELDS):
+            return 400, {"error": "Missing required fields"}
+
+        user_data = await usage_aggregator.get_user_data_async(user_id)
+        api_key = user_data.get("gemini_api_key")
+        using_custom_key = bool(api_key)
+        loop = asyncio.get_running_loop()
+        # Trạng thái đặc trưng chưa có trong cache thì đọc Firestore đồng bộ
+        context = await loop.run_in_executor(
+            None, feature_summaries.context, user_id, user_data
+        )
+
+        over_quota = None
+        check = quota_check(user_id, api_key)
+        try:
+            suggestion_data, raw_response = await gemini_service.get_health_suggestion_async(
+                data["temperature"],
+                data["humidity"],
+                data["noise"],
+                api_key=api_key,
+                user_id=user_id,
+                context=context,
+                quota_check=check,
+            )
+        except QuotaExceeded as e:
+            # Vượt hạn mức vẫn lưu lần đọc, chỉ bỏ qua khuyến nghị
+            over_quota = e
+            suggestion_data, raw_response = None, None
+
+        if data.get("get_recommendation_only"):
+            if over_quota is not None:
+                return 429, over_quota.to_dict()
+            return 200, {"success": True, "suggestion": suggestion_data}
+
+        current_time = datetime.now().isoformat()
+        reading_data = {
+            "temperature": data["temperature"],
+            "humidity": data["humidity"],
+            "noise": data["noise"],
+            "timestamp": current_time,
+            "userId": user_id,
+            "suggestion": suggestion_data,
+            "raw_response": raw_response,
+            "using_custom_key": using_custom_key,
+            "request_number": user_data.get("requests_this_hour", 0) + 1,
+        }
+        if over_quota is not None:
+            reading_data["suggestion_status"] = "quota_exceeded"
+
+        document_id, queued = await save_reading_async(user_id, reading_data)
+        usage_aggregator.record(user_id, reading_data, requests=int(check.called))
+        dashboard_snapshots.apply(user_id, document_id, reading_data)
+        await loop.run_in_executor(None, feature_summaries.record, user_id, reading_data)
+
+        response = {
+            "success": True,
+            "suggestion": suggestion_data,
+            "timestamp": current_time,
+            "document_id": document_id,
+        }
+        if over_quota is not None:
+            response["suggestion_status"] = "quota_exceeded"
+            response["retry_after"] = over_quota.retry_after
+        if queued:
+            response["queued"] = True
+            return 202, response
+        return 200, response
+
+    except Exception as e:
+        ERRORS.inc("asgi.receive_sensor_data")
+        print(f"Error processing sensor data: {e}")
+        return 500, {"error": str(e)}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            start_background_services()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if (
+        scope["type"] != "http"
+        or scope["path"] != "/api/sensor_data"
+        or scope["method"] != "POST"
+    ):
+        await wsgi_app(scope, receive, send)
+        return
+
+    body = await read_body(receive)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    # Chế độ async/stream và body không hợp lệ đi qua route Flask như cũ
+    if (
+        not isinstance(data, dict)
+        or data.get("stream")
+        or (data.get("async", ASYNC_SUGGESTIONS) and not data.get("get_recommendation_only"))
+    ):
+        await wsgi_app(scope, replay(body, receive), send)
+        return
+
+    started = time.perf_counter()
+    status, payload = await receive_sensor_data(scope, data)
+    REQUEST_LATENCY.observe(
+        time.perf_counter() - started, "receive_sensor_data", "POST", str(status)
+    )
+    headers = []
+    if status == 429 and "retry_after" in payload:
+        headers.append((b"retry-after", str(payload["retry_after"]).encode()))
+    await send_json(send, status, payload, headers)
@@ -0,0 +1,50 @@
+"""Compare two load_test JSON results, e.g. from two commits.
+
+Usage: python -m benchmarks.compare baseline.json candidate.json
+"""
+
+import json
+import sys
+
+METRICS = [
+    ("throughput_rps", lambda s: s["throughput_rps"]),
+    ("p50 ms", lambda s: s["latency_ms"]["p50"]),
+    ("p95 ms", lambda s: s["latency_ms"]["p95"]),
+    ("p99 ms", lambda s: s["latency_ms"]["p99"]),
+    ("errors", lambda s: s["errors"]),
+]
+
+
+def change(old, new):
+    if old is None or new is None:
+        return "n/a"
+    if old == 0:
+        return "same" if new == 0 else "new"
+    return f"{100.0 * (new - old) / old:+.1f}%"
+
+
+def main(argv=None):
+    argv = argv if argv is not None else sys.argv[1:]
+    if len(argv) != 2:
+        raise SystemExit(__doc__)
+    with open(argv[0]) as f:
+        baseline = json.load(f)
+    with open(argv[1]) as f:
+        candidate = json.load(f)
+
+    print(
+        f"baseline {baseline['meta'].get('commit')} -> "
+        f"candidate {candidate['meta'].get('commit')}"
+    )
+    names = [n for n in baseline["endpoints"] if n in candidate["endpoints"]]
+    for name in names + ["total"]:
+        old = baseline["total"] if name == "total" else baseline["endpoints"][name]
+        new = candidate["total"] if name == "total" else candidate["endpoints"][name]
+        print(name)
+        for label, get in METRICS:
+            old_value, new_value = get(old), get(new)
+            print(f"  {label:<16}{old_value!s:>12}{new_value!s:>12}{change(old_value, new_value):>10}")
+
+
+if __name__ == "__main__":
+    main()
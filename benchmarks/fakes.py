@@ -0,0 +1,275 @@
+"""In-process stand-ins for Firestore and Gemini with injected latency and errors"""
+
+import re
+import json
+import random
+import asyncio
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from google.api_core.exceptions import AlreadyExists, ServiceUnavailable
+
+from services.firebase_service import FirebaseService
+from services.gemini_service import GeminiService
+from services.user_profile_cache import UserProfileCache
+
+
+class LatencyProfile:
+    """Latency (seconds, mean +/- jitter) and error rate of a fake backend"""
+
+    def __init__(self, mean=0.0, jitter=0.0, error_rate=0.0):
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def wait(self, operation, scale=1.0):
+        delay = scale * (self.mean + random.uniform(-self.jitter, self.jitter))
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ServiceUnavailable(f"Injected failure in {operation}")
+
+    async def wait_async(self, operation):
+        delay = self.mean + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ServiceUnavailable(f"Injected failure in {operation}")
+
+
+class FakeFirebaseService(FirebaseService):
+    """FirebaseService backed by in-memory dicts; the cache logic is the real one"""
+
+    def __init__(self, latency=None):
+        self.latency = latency or LatencyProfile()
+        self.user_cache = UserProfileCache()
+        self.users = {}
+        self.readings = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _io(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.latency.wait(operation)
+
+    async def _io_async(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        await self.latency.wait_async(operation)
+
+    @staticmethod
+    def _default_user():
+        return {
+            "requests_this_hour": 0,
+            "last_request_hour": None,
+            "using_dev_account": True,
+        }
+
+    def _load_user_data(self, user_id, create=True):
+        self._io("users.get")
+        with self._lock:
+            if not create and user_id not in self.users:
+                return None
+            return dict(self.users.setdefault(user_id, self._default_user()))
+
+    async def _load_user_data_async(self, user_id):
+        await self._io_async("users.get")
+        with self._lock:
+            return dict(self.users.setdefault(user_id, self._default_user()))
+
+    def _create(self, document_id, reading_data):
+        # Gọi khi đang giữ self._lock, giống batch.create của Firestore
+        if document_id is None:
+            document_id = uuid.uuid4().hex
+        elif document_id in self.readings:
+            raise AlreadyExists(f"Document {document_id} already exists")
+        self.readings[document_id] = dict(reading_data)
+        return document_id
+
+    def save_sensor_reading(self, user_id, reading_data, document_id=None, timeout=None):
+        self._io("sensor_readings.batch_commit")
+        with self._lock:
+            return self._create(document_id, reading_data)
+
+    async def save_sensor_reading_async(
+        self, user_id, reading_data, document_id=None, timeout=None
+    ):
+        await self._io_async("sensor_readings.batch_commit")
+        with self._lock:
+            return self._create(document_id, reading_data)
+
+    def save_keyed_readings(self, records, timeout=None):
+        self._io("sensor_readings.batch_commit")
+        with self._lock:
+            if any(document_id in self.readings for document_id, _, _ in records):
+                raise AlreadyExists("A document in the batch already exists")
+            for document_id, _, reading_data in records:
+                self._create(document_id, reading_data)
+
+    def save_sensor_readings_batch(self, user_id, readings, count_request=True):
+        self._io("sensor_readings.batch_commit")
+        document_ids = []
+        with self._lock:
+            for reading_data in readings:
+                document_id = uuid.uuid4().hex
+                self.readings[document_id] = dict(reading_data)
+                document_ids.append(document_id)
+        self.user_cache.invalidate(user_id)
+        return document_ids
+
+    def attach_suggestion(self, document_id, suggestion_data, raw_response):
+        self._io("sensor_readings.update")
+        with self._lock:
+            self.readings.setdefault(document_id, {}).update(
+                {"suggestion": suggestion_data, "suggestion_status": "done"}
+            )
+
+    def attach_partial_suggestion(self, document_id, fields):
+        self._io("sensor_readings.update")
+        with self._lock:
+            self.readings.setdefault(document_id, {}).update(
+                {"suggestion": fields, "suggestion_status": "streaming"}
+            )
+
+    def mark_suggestion_status(self, document_id, status):
+        self._io("sensor_readings.update")
+
+    def update_user_usage(self, user_id, reading_data):
+        current_hour = datetime.now().replace(minute=0, second=0, microsecond=0).isoformat()
+        self.apply_usage_updates(
+            {
+                user_id: {
+                    "count": 1,
+                    "last_request_hour": current_hour,
+                    "last_reading": reading_data,
+                }
+            }
+        )
+
+    def apply_usage_updates(self, updates):
+        # Cùng quy ước trường với FirebaseService.apply_usage_updates: entry có
+        # count phải kèm last_request_hour, last_reading có thể không có
+        self._io("users.batch_commit")
+        with self._lock:
+            for user_id, update in updates.items():
+                user_data = self.users.setdefault(user_id, {"requests_this_hour": 0})
+                if update["count"]:
+                    user_data["requests_this_hour"] = (
+                        user_data.get("requests_this_hour", 0) + update["count"]
+                    )
+                    user_data["last_request_hour"] = update["last_request_hour"]
+                if update.get("last_reading") is not None:
+                    user_data["last_reading"] = FirebaseService.compact_last_reading(
+                        update["last_reading"]
+                    )
+                if update.get("features") is not None:
+                    user_data["features"] = update["features"]
+        for user_id in updates:
+            self.user_cache.invalidate(user_id)
+
+    def update_gemini_key(self, user_id, api_key):
+        self._io("users.transaction")
+        with self._lock:
+            user_data = self.users.setdefault(user_id, {})
+            user_data.update({"gemini_api_key": api_key, "requests_this_hour": 0})
+        self.user_cache.invalidate(user_id)
+
+    def remove_gemini_key(self, user_id):
+        self._io("users.transaction")
+        with self._lock:
+            user_data = self.users.setdefault(user_id, {})
+            user_data.pop("gemini_api_key", None)
+            user_data["requests_this_hour"] = 0
+        self.user_cache.invalidate(user_id)
+
+    def get_rollups(self, user_id, granularity, start, end):
+        self._io("sensor_rollups.query")
+        return []
+
+    def get_recent_readings(self, user_id, limit=10):
+        self._io("sensor_readings.query")
+        return []
+
+
+class FakeGenerativeModel:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, prompt, stream=False):
+        if stream:
+            return self._stream()
+        self.latency.wait("gemini.generate_content")
+        rooms = len(re.findall(r"Room \d+:", prompt))
+        if rooms:
+            return FakeBatchResponse(rooms)
+        return FakeResponse()
+
+    async def generate_content_async(self, prompt):
+        await self.latency.wait_async("gemini.generate_content")
+        return FakeResponse()
+
+    def _stream(self, chunks=8):
+        # Tổng độ trễ chia đều cho các chunk, như model sinh token dần dần
+        text = FakeResponse.text
+        size = -(-len(text) // chunks)
+        for i in range(0, len(text), size):
+            self.latency.wait("gemini.generate_content", 1.0 / chunks)
+            yield FakeChunk(text[i : i + size])
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    text = json.dumps(
+        {
+            "immediate_actions": ["Open a window", "Drink water"],
+            "health_impacts": ["Mild discomfort", "Reduced focus"],
+            "optimal_ranges": {
+                "temperature": "20-24°C",
+                "humidity": "40-60%",
+                "noise": "<50 dB",
+            },
+            "summary": "Conditions are acceptable.",
+        }
+    )
+
+
+class FakeBatchResponse:
+    def __init__(self, rooms):
+        suggestion = json.loads(FakeResponse.text)
+        self.text = json.dumps(
+            {"rooms": [{"room": index, **suggestion} for index in range(1, rooms + 1)]}
+        )
+
+
+class FakeClientPool:
+    def __init__(self, latency):
+        self.model = FakeGenerativeModel(latency)
+
+    def get(self, api_key):
+        return self.model
+
+    def get_async(self, api_key):
+        return self.model
+
+    def discard(self, api_key):
+        pass
+
+    def size(self):
+        return 1
+
+
+class FakeGeminiService(GeminiService):
+    """GeminiService whose model is a fake; caching and parsing are the real ones"""
+
+    def __init__(self, latency=None, cache=True):
+        super().__init__()
+        self.client_pool = FakeClientPool(latency or LatencyProfile())
+        if not cache:
+            self.suggestion_cache.backend = None
@@ -0,0 +1,302 @@
+"""Drive the Flask app against in-process fakes at a target request rate.
+
+Usage (from the repository root):
+
+    python -m benchmarks.load_test --rate 50 --duration 30 --gemini-latency 1.5 \
+        --output results.json
+
+Latency is measured from the scheduled send time, so a saturated server shows
+up as queueing delay instead of a lower request rate.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ENDPOINTS = {
+    "sensor_data": ("POST", "/api/sensor_data"),
+    "read_sensors": ("GET", "/api/read_sensors"),
+    "update_gemini_key": ("POST", "/api/update_gemini_key"),
+    "remove_gemini_key": ("POST", "/api/remove_gemini_key"),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rate", type=float, default=20, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=64, help="client threads")
+    parser.add_argument(
+        "--server",
+        choices=("wsgi", "asgi"),
+        default="wsgi",
+        help="threaded werkzeug server or uvicorn running asgi:app",
+    )
+    parser.add_argument("--users", type=int, default=20, help="distinct user ids")
+    parser.add_argument(
+        "--mix",
+        default="sensor_data=7,read_sensors=2,update_gemini_key=0.5,remove_gemini_key=0.5",
+        help="endpoint weights, name=weight,...",
+    )
+    parser.add_argument("--firestore-latency", type=float, default=0.03)
+    parser.add_argument("--firestore-jitter", type=float, default=0.01)
+    parser.add_argument("--firestore-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-latency", type=float, default=1.0)
+    parser.add_argument("--gemini-jitter", type=float, default=0.3)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--gemini-batch-window", type=float, default=0.0, help="seconds, 0 disables"
+    )
+    parser.add_argument("--no-suggestion-cache", action="store_true")
+    parser.add_argument("--no-suggestion-rules", action="store_true")
+    parser.add_argument(
+        "--keep-rate-limits", action="store_true", help="leave Flask-Limiter and the per-user quota enabled"
+    )
+    parser.add_argument("--output", help="write JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def load_app(args):
+    """Import main with the fakes installed in place of the real services"""
+    os.environ.setdefault("FLASK_SECRET_KEY", "benchmark")
+    os.environ.setdefault("DEVICE_TYPE", "raspberry_pi")
+    os.environ.setdefault("TIMESERIES_DIR", tempfile.mkdtemp(prefix="bench-ts-"))
+    os.environ["GEMINI_BATCH_WINDOW"] = str(args.gemini_batch_window)
+
+    import services.firebase_service as firebase_module
+    import services.gemini_service as gemini_module
+    from benchmarks.fakes import FakeFirebaseService, FakeGeminiService, LatencyProfile
+
+    firebase = FakeFirebaseService(
+        LatencyProfile(
+            args.firestore_latency, args.firestore_jitter, args.firestore_error_rate
+        )
+    )
+    gemini = FakeGeminiService(
+        LatencyProfile(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate),
+        cache=not args.no_suggestion_cache,
+    )
+    if args.no_suggestion_rules:
+        gemini.rules.enabled = False
+    firebase_module.FirebaseService = lambda credential_path: firebase
+    gemini_module.GeminiService = lambda: gemini
+
+    if not args.keep_rate_limits:
+        os.environ["QUOTA_ENABLED"] = "false"
+
+    import main as app_module
+
+    if not args.keep_rate_limits:
+        app_module.limiter.enabled = False
+    return app_module, firebase, gemini
+
+
+def start_server(args, app_module):
+    """Serve the app on a free local port, return (port, stop)"""
+    if args.server == "asgi":
+        import uvicorn
+
+        import asgi
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        server = uvicorn.Server(
+            uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        return port, lambda: setattr(server, "should_exit", True)
+
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port, server.shutdown
+
+
+def make_request(name, user_id):
+    method, path = ENDPOINTS[name]
+    if name == "sensor_data":
+        body = {
+            "user_id": user_id,
+            "temperature": round(random.uniform(18, 32), 1),
+            "humidity": round(random.uniform(30, 80), 1),
+            "noise": round(random.uniform(30, 90), 1),
+        }
+    elif name == "update_gemini_key":
+        body = {"user_id": user_id, "api_key": f"bench-key-{user_id}"}
+    elif name == "remove_gemini_key":
+        body = {"user_id": user_id}
+    else:
+        body = None
+    return method, path, body
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(s["latency"] for s in samples)
+    service = sorted(s["service_time"] for s in samples)
+    statuses = {}
+    for s in samples:
+        statuses[str(s["status"])] = statuses.get(str(s["status"]), 0) + 1
+    errors = sum(1 for s in samples if s["status"] == 0 or s["status"] >= 500)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "status_codes": statuses,
+        "throughput_rps": round(len(samples) / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+            "p50": round(1000 * percentile(latencies, 50), 3) if latencies else None,
+            "p95": round(1000 * percentile(latencies, 95), 3) if latencies else None,
+            "p99": round(1000 * percentile(latencies, 99), 3) if latencies else None,
+            "max": round(1000 * latencies[-1], 3) if latencies else None,
+        },
+        "service_time_ms": {
+            "p50": round(1000 * percentile(service, 50), 3) if service else None,
+            "p99": round(1000 * percentile(service, 99), 3) if service else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    weights = parse_mix(args.mix)
+    app_module, firebase, gemini = load_app(args)
+    port, stop_server = start_server(args, app_module)
+
+    samples = {name: [] for name in weights}
+    samples_lock = threading.Lock()
+    user_ids = [f"bench-user-{i}" for i in range(args.users)]
+    names = list(weights)
+    name_weights = [weights[name] for name in names]
+
+    def fire(name, scheduled):
+        method, path, body = make_request(name, random.choice(user_ids))
+        started = time.perf_counter()
+        status = 0
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            conn.request(
+                method, path, body=json.dumps(body) if body is not None else None, headers=headers
+            )
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            conn.close()
+        except Exception as e:
+            print(f"Request to {path} failed: {e}", file=sys.stderr)
+        finished = time.perf_counter()
+        with samples_lock:
+            samples[name].append(
+                {
+                    "status": status,
+                    "latency": finished - scheduled,
+                    "service_time": finished - started,
+                }
+            )
+
+    total = int(args.rate * args.duration)
+    print(
+        f"Sending {total} requests at {args.rate}/s for {args.duration}s "
+        f"to 127.0.0.1:{port}",
+        file=sys.stderr,
+    )
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i in range(total):
+            scheduled = t0 + i / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(fire, random.choices(names, name_weights)[0], scheduled)
+    elapsed = time.perf_counter() - t0
+    stop_server()
+
+    all_samples = [s for endpoint_samples in samples.values() for s in endpoint_samples]
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "args": vars(args),
+            "elapsed_seconds": round(elapsed, 3),
+        },
+        "endpoints": {name: summarize(samples[name], elapsed) for name in names},
+        "total": summarize(all_samples, elapsed),
+        "backend_calls": dict(firebase.calls),
+        "suggestion_cache": gemini.suggestion_cache.stats(),
+        "suggestion_batcher": gemini.batcher.stats(),
+        "suggestion_rules": gemini.rules.stats(),
+    }
+
+
+def print_table(results):
+    print(
+        f"{'endpoint':<20}{'reqs':>7}{'errs':>6}{'rps':>9}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    rows = list(results["endpoints"].items()) + [("total", results["total"])]
+    for name, stats in rows:
+        latency = stats["latency_ms"]
+        print(
+            f"{name:<20}{stats['requests']:>7}{stats['errors']:>6}"
+            f"{stats['throughput_rps']:>9.2f}"
+            f"{latency['p50'] or 0:>10.1f}{latency['p95'] or 0:>10.1f}{latency['p99'] or 0:>10.1f}"
+        )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Report where a cold start of the app spends its time.
+
+Usage (from the repository root, with the deployment's .env):
+
+    python -m benchmarks.startup            # import main only
+    python -m benchmarks.startup --init     # also create every service
+
+Run it in a fresh interpreter; anything imported before main is not counted.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--init", action="store_true", help="create the lazy services after import"
+    )
+    parser.add_argument("--json", action="store_true", help="print the raw report")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.perf_counter()
+    import main as app_module
+
+    imported = time.perf_counter() - started
+    if args.init:
+        for name in (
+            "firebase_service",
+            "gemini_service",
+            "oauth",
+            "usage_aggregator",
+            "suggestion_pool",
+            "timeseries_store",
+            "sensor_service",
+        ):
+            service = getattr(app_module, name)
+            if service is not None:
+                try:
+                    service.resolve()
+                except Exception as e:
+                    print(f"Could not initialise {name}: {e}", file=sys.stderr)
+
+    report = app_module.STARTUP.report()
+    report["import_main_seconds"] = round(imported, 4)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{'phase':<32}{'at s':>9}{'seconds':>10}")
+    for phase in report["phases"]:
+        print(f"{phase['phase']:<32}{phase['at']:>9.3f}{phase['seconds']:>10.3f}")
+    print(f"{'import main (total)':<32}{'':>9}{report['import_main_seconds']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Export sensor_readings to columnar files per user and day, optionally pruning them.
+
+Usage (from the repository root, with the deployment's .env):
+
+    python export_readings.py                        # export into EXPORT_DIR
+    python export_readings.py --max-pages 100        # stop after 100 pages
+    python export_readings.py --retention-days 30    # then delete exported readings older than 30 days
+    python export_readings.py --retention-days 30 --downsample hour
+
+Files are Parquet (zstd) when pyarrow is installed, compressed .npz
+otherwise. Safe to interrupt and run again: the cursor is kept in
+export_state.json and the IDs still to prune in .flushes/ in the output
+directory. Old-schema documents are not
+exported, run migrate_readings.py first.
+"""
+
+import argparse
+import os
+import time
+
+from main import create_firebase_service
+from services.reading_export import ReadingExporter
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--out", default=os.getenv("EXPORT_DIR", "data/exports"), help="output directory")
+    parser.add_argument("--page-size", type=int, default=500, help="documents per query page")
+    parser.add_argument("--max-rows", type=int, default=100000, help="readings buffered before writing files")
+    parser.add_argument("--max-pages", type=int, default=None, help="stop exporting after N pages")
+    parser.add_argument(
+        "--lag-hours",
+        type=float,
+        default=float(os.getenv("EXPORT_LAG_HOURS", "24")),
+        help="leave readings newer than this for the next run (late offline uploads)",
+    )
+    parser.add_argument("--retention-days", type=float, default=None, help="prune exported readings older than this")
+    parser.add_argument(
+        "--downsample",
+        choices=("hour", "day"),
+        default=None,
+        help="keep one reading per user per hour/day instead of deleting all",
+    )
+    return parser.parse_args(argv)
+
+
+def report(state):
+    print(
+        f"Exported {state['exported']} readings in {state['parts']} files, "
+        f"deleted {state['deleted']}"
+    )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    exporter = ReadingExporter(create_firebase_service(), args.out, args.page_size, args.max_rows)
+    exported = exporter.export(
+        until=time.time() - args.lag_hours * 3600, max_pages=args.max_pages, progress=report
+    )
+    print(f"Done: {exported} readings exported to {args.out}")
+    if args.retention_days is not None:
+        deleted = exporter.prune(args.retention_days * 86400, args.downsample, progress=report)
+        print(f"Done: {deleted} readings pruned")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+
+# Đặt PRELOAD_APP=true để master import app và SDK một lần rồi fork worker
+preload_app = os.getenv("PRELOAD_APP", "false").lower() == "true"
+
+
+def post_worker_init(worker):
+    # Với preload, main được import trước khi gevent patch socket trong worker
+    try:
+        from gevent import monkey
+
+        if monkey.is_module_patched("socket"):
+            import grpc.experimental.gevent as grpc_gevent
+
+            grpc_gevent.init_gevent()
+    except ImportError:
+        pass
+
+    # Dịch vụ được tạo lười; khởi động luồng nền ngay trong từng worker
+    import main
+
+    main.start_background_services()
@@ -1,63 +1,443 @@
 import atexit
-from flask import Flask, jsonify, render_template, url_for, redirect, session, request
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
-from authlib.integrations.flask_client import OAuth
+import hashlib
+import json
 import os
+import time
 from datetime import datetime
-
-from services.firebase_service import FirebaseService
-from services.gemini_service import GeminiService
-from services.sensor_service import SensorService
 from functools import wraps
 
+from services.startup import STARTUP, LazyService
+
+with STARTUP.phase("import flask"):
+    from flask import Flask, Response, g, jsonify, render_template, url_for, redirect, session, request
+    from flask_limiter import Limiter
+    from flask_limiter.util import get_remote_address
+    from jinja2 import meta
+
+# Firebase, Gemini, Authlib và GPIO chỉ được import khi dịch vụ được dùng lần đầu
+with STARTUP.phase("import services"):
+    from services.aggregation import GRANULARITIES, aggregate_rollups, bucket_start
+    from services.metrics import ERRORS, REGISTRY, REQUEST_LATENCY
+    from services.quota import QuotaCheck, QuotaExceeded
+    from services.reading_schema import to_epoch
+    from services.dashboard_snapshot import payload_etag
+    from services.stream_hub import StreamHub
+    from services.suggestion_cache import MemoryCacheBackend
+    from services.suggestion_worker import SuggestionWorkerPool
+    from services.usage_aggregator import UsageAggregator
+
+# Khi chạy bằng gunicorn -k gevent, gRPC (Firestore listener) cần hỗ trợ gevent
+try:
+    from gevent import monkey
+
+    if monkey.is_module_patched("socket"):
+        import grpc.experimental.gevent as grpc_gevent
+
+        grpc_gevent.init_gevent()
+except ImportError:
+    pass
+
 if os.getenv("ENVIRONMENT") != "production":
-    from dotenv import load_dotenv
+    with STARTUP.phase("load dotenv"):
+        from dotenv import load_dotenv
 
-    load_dotenv()
+        load_dotenv()
+
+# Preload (gunicorn --preload): import sẵn SDK nặng trong master để các worker
+# fork ra dùng chung, còn client và thread vẫn được tạo riêng trong từng worker
+PRELOAD_APP = os.getenv("PRELOAD_APP", "false").lower() == "true"
+
+
+def create_timeseries_store():
+    from services.timeseries_store import TimeSeriesStore
+
+    # Lưu lịch sử cảm biến cục bộ trên thiết bị
+    try:
+        store = TimeSeriesStore(os.getenv("TIMESERIES_DIR", "data/timeseries"))
+        atexit.register(store.close)
+        return store
+    except Exception as e:
+        print(f"Error initializing local time-series store: {e}")
+        return None
+
+
+def create_sensor_service():
+    from services.sensor_service import SensorService
 
-sensor_service = None
-if os.environ.get("DEVICE_TYPE") == "raspberry_pi":
     try:
-        sensor_service = SensorService()
+        service = SensorService()
         # Đảm bảo cleanup GPIO khi thoát
-        atexit.register(sensor_service.cleanup)
+        atexit.register(service.cleanup)
         print("Sensor service initialized on Raspberry Pi")
     except Exception as e:
         print(f"Error initializing sensor service: {e}")
         print("Running without sensor hardware support")
+        return None
+
+    # Luồng lấy mẫu nền, endpoint chỉ đọc mẫu mới nhất từ ring buffer
+    service.start_sampling(on_sample=timeseries_store.append if timeseries_store else None)
+    return service
+
+
+sensor_service = None
+timeseries_store = None
+if os.environ.get("DEVICE_TYPE") == "raspberry_pi":
+    timeseries_store = LazyService("timeseries_store", create_timeseries_store)
+    sensor_service = LazyService("sensor_service", create_sensor_service)
+
+with STARTUP.phase("create app"):
+    app = Flask(__name__)
+    app.secret_key = os.getenv("FLASK_SECRET_KEY")
+
+
+def create_firebase_service():
+    from services.firebase_service import FirebaseService
+
+    return FirebaseService("config/firebase_admin_sdk.json")
+
+
+def create_gemini_service():
+    from services.gemini_service import GeminiService
+
+    service = GeminiService()
+    atexit.register(service.batcher.shutdown)
+    return service
 
-app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY")
 
 # Initialize services
-firebase_service = FirebaseService("config/firebase_admin_sdk.json")
-gemini_service = GeminiService()
+firebase_service = LazyService("firebase_service", create_firebase_service)
+gemini_service = LazyService("gemini_service", create_gemini_service)
+
+# Firestore listeners per watched user, shared by all of that user's SSE clients
+stream_hub = StreamHub(firebase_service)
+atexit.register(stream_hub.close)
+
+
+def create_usage_aggregator():
+    aggregator = UsageAggregator(firebase_service)
+    aggregator.start()
+    atexit.register(aggregator.shutdown)
+    return aggregator
+
+
+# Usage counters are written behind the request and flushed in batches
+usage_aggregator = LazyService("usage_aggregator", create_usage_aggregator)
+
+
+def create_quota():
+    from services.quota import QuotaManager
+
+    return QuotaManager()
+
+
+# Hạn mức theo user và theo API key, dùng chung giữa các worker
+quota = LazyService("quota", create_quota)
+
+
+def quota_check(user_id, api_key=None):
+    """QuotaCheck for GeminiService that spends one model call of the user's quota.
+
+    GeminiService calls it only when neither the local rules nor the cache
+    answer; it raises QuotaExceeded when the user or the key is over quota,
+    and its called flag tells whether to count the request.
+    """
+    return QuotaCheck(
+        quota,
+        user_id,
+        api_key=api_key or os.getenv("GEMINI_API_KEY"),
+        using_custom_key=bool(api_key),
+    )
+
+
+def quota_response(exceeded):
+    """429 response for a QuotaExceeded"""
+    response = jsonify(exceeded.to_dict())
+    response.headers["Retry-After"] = str(exceeded.retry_after)
+    return response, 429
+
+
+def create_outbox():
+    from services.outbox import Outbox
+
+    # Hàng đợi trên đĩa cho các lần ghi Firestore thất bại khi mất mạng
+    try:
+        outbox = Outbox(os.getenv("OUTBOX_DIR", "data/outbox"), firebase_service)
+    except Exception as e:
+        print(f"Error initializing outbox: {e}")
+        return None
+    outbox.start()
+    atexit.register(outbox.shutdown)
+    return outbox
+
+
+# Mặc định bật trên Raspberry Pi, nơi đường truyền lên cloud hay chập chờn
+outbox = None
+if os.getenv(
+    "OUTBOX_ENABLED", "true" if os.environ.get("DEVICE_TYPE") == "raspberry_pi" else "false"
+).lower() == "true":
+    outbox = LazyService("outbox", create_outbox)
+
+
+def create_dashboard_snapshots():
+    from services.dashboard_snapshot import DashboardSnapshots
+
+    return DashboardSnapshots(firebase_service)
+
+
+# Dữ liệu dashboard được cập nhật khi ghi, không truy vấn Firestore mỗi lần xem
+dashboard_snapshots = LazyService("dashboard_snapshots", create_dashboard_snapshots)
+
+
+def create_feature_summaries():
+    from services.feature_summary import FeatureSummaries
+
+    return FeatureSummaries(
+        load_state=lambda user_id: usage_aggregator.get_user_data(user_id, create=False).get(
+            "features"
+        ),
+        save_state=usage_aggregator.record_features,
+    )
+
+
+# Đặc trưng lịch sử theo user (EWMA, xu hướng, thời gian ngoài ngưỡng) cho prompt
+feature_summaries = LazyService("feature_summaries", create_feature_summaries)
+
+
+def save_reading(user_id, reading_data, queued_fields=None):
+    """Save a reading, queueing it on disk when Firestore is unreachable.
+
+    Returns (document_id, queued).
+    """
+    if not outbox:
+        document_id, queued = firebase_service.save_sensor_reading(user_id, reading_data), False
+    else:
+        document_id, queued = outbox.save(user_id, reading_data, queued_fields)
+    if queued and queued_fields:
+        reading_data = {**reading_data, **queued_fields}
+    dashboard_snapshots.apply(user_id, document_id, reading_data)
+    feature_summaries.record(user_id, reading_data)
+    return document_id, queued
+
+
+def process_suggestion_job(job):
+    """Generate a suggestion in the background and attach it to the reading"""
+    check = quota_check(job["user_id"], job["api_key"])
+    try:
+        _process_suggestion_job(job, check)
+    except QuotaExceeded:
+        # Lần đọc đã được lưu, chỉ không có khuyến nghị
+        firebase_service.mark_suggestion_status(job["document_id"], "quota_exceeded")
+        dashboard_snapshots.update(
+            job["user_id"], job["document_id"], {"suggestion_status": "quota_exceeded"}
+        )
+    finally:
+        # requests_this_hour chỉ đếm lần thật sự gọi model, như quota
+        if check.called:
+            usage_aggregator.record(job["user_id"])
+
+
+def _process_suggestion_job(job, check):
+    if gemini_service.batcher.enabled:
+        # Một prompt nhiều phòng không stream theo từng phòng được
+        suggestion_data, raw_response = gemini_service.get_health_suggestion(
+            job["temperature"],
+            job["humidity"],
+            job["noise"],
+            api_key=job["api_key"],
+            user_id=job["user_id"],
+            context=job.get("context"),
+            quota_check=check,
+        )
+        firebase_service.attach_suggestion(
+            job["document_id"], suggestion_data, raw_response
+        )
+        dashboard_snapshots.update(
+            job["user_id"],
+            job["document_id"],
+            {"suggestion": suggestion_data, "suggestion_status": "done"},
+        )
+        return
+
+    for event in gemini_service.stream_health_suggestion(
+        job["temperature"],
+        job["humidity"],
+        job["noise"],
+        api_key=job["api_key"],
+        user_id=job["user_id"],
+        context=job.get("context"),
+        quota_check=check,
+    ):
+        if event[0] == "field" and event[1] == "immediate_actions":
+            # Dashboard hiện các hành động cần làm ngay trước khi phần còn lại xong
+            firebase_service.attach_partial_suggestion(
+                job["document_id"], {"immediate_actions": event[2]}
+            )
+            dashboard_snapshots.update(
+                job["user_id"],
+                job["document_id"],
+                {"suggestion": {"immediate_actions": event[2]}, "suggestion_status": "streaming"},
+            )
+        elif event[0] == "done":
+            firebase_service.attach_suggestion(job["document_id"], event[1], event[2])
+            dashboard_snapshots.update(
+                job["user_id"],
+                job["document_id"],
+                {"suggestion": event[1], "suggestion_status": "done"},
+            )
+
+
+# Background suggestion pipeline
+ASYNC_SUGGESTIONS = os.getenv("ASYNC_SUGGESTIONS", "false").lower() == "true"
+SUGGESTION_RETRY_AFTER = os.getenv("SUGGESTION_RETRY_AFTER", "5")
+
+
+def create_suggestion_pool():
+    pool = SuggestionWorkerPool(process_suggestion_job)
+    pool.start()
+    atexit.register(pool.shutdown)
+    return pool
+
+
+suggestion_pool = LazyService("suggestion_pool", create_suggestion_pool)
+
+
+def start_background_services():
+    """Start samplers, flushers and workers now instead of on the first request"""
+    for service in (sensor_service, usage_aggregator, suggestion_pool, outbox):
+        if service is not None:
+            service.resolve()
+    if outbox:
+        outbox.adopt_orphans()
+
+
+def warm_imports():
+    """Import the heavy SDKs without creating clients, for preload-and-fork"""
+    with STARTUP.phase("preload imports"):
+        import services.firebase_service  # noqa: F401
+        import services.gemini_service  # noqa: F401
+        import authlib.integrations.flask_client  # noqa: F401
+
+
+# Số liệu được đọc khi Prometheus scrape /metrics, không khởi tạo dịch vụ chưa dùng
+def lazy_gauge(name, documentation, service, read):
+    REGISTRY.gauge(name, documentation, lambda: read() if service.initialized else 0)
+
+
+lazy_gauge(
+    "suggestion_cache_hits",
+    "Suggestion cache hits",
+    gemini_service,
+    lambda: gemini_service.suggestion_cache.hits,
+)
+lazy_gauge(
+    "suggestion_cache_misses",
+    "Suggestion cache misses",
+    gemini_service,
+    lambda: gemini_service.suggestion_cache.misses,
+)
+lazy_gauge(
+    "suggestion_rules_local",
+    "Suggestions answered by the local rules",
+    gemini_service,
+    lambda: gemini_service.rules.local + gemini_service.rules.reused,
+)
+lazy_gauge(
+    "suggestion_rules_escalated",
+    "Readings the local rules escalated to Gemini",
+    gemini_service,
+    lambda: gemini_service.rules.escalated,
+)
+lazy_gauge(
+    "user_cache_hits",
+    "User profile cache hits",
+    firebase_service,
+    lambda: firebase_service.user_cache.hits,
+)
+lazy_gauge(
+    "user_cache_misses",
+    "User profile cache misses",
+    firebase_service,
+    lambda: firebase_service.user_cache.misses,
+)
+lazy_gauge(
+    "suggestion_queue_length",
+    "Jobs waiting in the suggestion worker pool",
+    suggestion_pool,
+    lambda: suggestion_pool.status()["queue_length"],
+)
+if outbox is not None:
+    lazy_gauge(
+        "outbox_depth",
+        "Readings waiting in the on-disk outbox",
+        outbox,
+        lambda: outbox.stats()["depth"],
+    )
+    lazy_gauge(
+        "outbox_dropped",
+        "Queued readings dropped to keep the outbox under its size limit",
+        outbox,
+        lambda: outbox.dropped,
+    )
+lazy_gauge(
+    "usage_pending_increments",
+    "Usage increments not yet flushed to Firestore",
+    usage_aggregator,
+    lambda: usage_aggregator.stats()["pending_increments"],
+)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - started,
+            request.endpoint or "unknown",
+            request.method,
+            str(response.status_code),
+        )
+    return response
+
 
 # Rate limiter
 limiter = Limiter(
     app=app, 
     key_func=get_remote_address,
-    default_limits=["200 per day", "50 per hour"]
+    default_limits=["200 per day", "50 per hour"],
+    # redis://... để mọi worker và replica dùng chung bộ đếm theo IP
+    storage_uri=os.getenv("RATELIMIT_STORAGE_URI", "memory://"),
 )
 
+
+def create_oauth():
+    from authlib.integrations.flask_client import OAuth
+
+    oauth = OAuth(app)
+    oauth.register(
+        name="google",
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        access_token_url="https://accounts.google.com/o/oauth2/token",
+        access_token_params=None,
+        authorize_url="https://accounts.google.com/o/oauth2/auth",
+        authorize_params=None,
+        api_base_url="https://www.googleapis.com/oauth2/v1/",
+        userinfo_endpoint="https://openidconnect.googleapis.com/v1/userinfo",
+        client_kwargs={
+            "scope": "openid email profile",
+            "redirect_uri": "http://localhost:5000/authorize"  # Update this URL based on your deployment
+        },
+    )
+    return oauth
+
+
 # OAuth Configuration
-oauth = OAuth(app)
-google = oauth.register(
-    name="google",
-    client_id=os.getenv("GOOGLE_CLIENT_ID"),
-    client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-    access_token_url="https://accounts.google.com/o/oauth2/token",
-    access_token_params=None,
-    authorize_url="https://accounts.google.com/o/oauth2/auth",
-    authorize_params=None,
-    api_base_url="https://www.googleapis.com/oauth2/v1/",
-    userinfo_endpoint="https://openidconnect.googleapis.com/v1/userinfo",
-    client_kwargs={
-        "scope": "openid email profile",
-        "redirect_uri": "http://localhost:5000/authorize"  # Update this URL based on your deployment
-    },
-)
+oauth = LazyService("oauth", create_oauth)
 
 # Get developer's Firebase config
 try:
@@ -74,6 +454,12 @@ except Exception as e:
     print(f"Error loading developer Firebase config: {e}")
     dev_firebase_config = {}
 
+# Batch ingestion: một WriteBatch Firestore tối đa 500 thao tác ghi, kể cả rollup
+BATCH_MAX_READINGS = int(os.getenv("BATCH_MAX_READINGS", "450"))
+
+# Số bucket tối đa cho một truy vấn /api/readings/aggregate
+AGGREGATE_MAX_BUCKETS = int(os.getenv("AGGREGATE_MAX_BUCKETS", "2000"))
+
 # Google OAuth Configuration
 google_config = {
     "client_id": os.getenv("GOOGLE_CLIENT_ID"),
@@ -92,6 +478,80 @@ def login_required(f):
     return decorated_function
 
 
+def verified_user_id():
+    """uid of the caller, from a verified Firebase ID token or the session.
+
+    The token comes in an Authorization: Bearer header; once verified its
+    uid is kept in the signed session cookie, so EventSource requests (which
+    cannot set headers) are authenticated by the cookie.
+    """
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        user_id = firebase_service.verify_id_token(header[len("Bearer "):])
+        if user_id is None:
+            session.pop("uid", None)
+            return None
+        session["uid"] = user_id
+    return session.get("uid")
+
+
+# Dữ liệu riêng của user: chỉ trả về cho chính user đã đăng nhập
+def user_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user_id = verified_user_id()
+        if user_id is None:
+            return jsonify({"error": "Authentication required"}), 401
+        requested = request.args.get("user_id")
+        if requested and requested != user_id:
+            return jsonify({"error": "Forbidden"}), 403
+        g.user_id = user_id
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+# Trang HTML chỉ phụ thuộc vào cấu hình của process, render một lần cho mỗi context
+page_cache = MemoryCacheBackend(
+    max_entries=int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "256")),
+    ttl=float(os.getenv("PAGE_CACHE_TTL", "3600")),
+)
+
+# template -> tên biến template dùng tới
+template_names = {}
+
+
+def template_variables(template):
+    """Names a template reads from its context, parsed once per template"""
+    names = template_names.get(template)
+    if names is None:
+        source = app.jinja_loader.get_source(app.jinja_env, template)[0]
+        names = frozenset(meta.find_undeclared_variables(app.jinja_env.parse(source)))
+        template_names[template] = names
+    return names
+
+
+def render_cached(template, **context):
+    """render_template with the result cached and served with an ETag.
+
+    The cache key holds only the context values the template renders, so
+    session data such as OAuth tokens passed along never ends up in it.
+    """
+    rendered = {name: context[name] for name in template_variables(template) if name in context}
+    key = (template, json.dumps(rendered, sort_keys=True, default=str))
+    # Chế độ debug luôn render lại để thấy ngay thay đổi của template
+    page = None if app.debug else page_cache.get(key)
+    if page is None:
+        html = render_template(template, **context)
+        page = (html, hashlib.sha256(html.encode()).hexdigest()[:32])
+        page_cache.set(key, page)
+
+    response = Response(page[0], mimetype="text/html")
+    response.set_etag(page[1])
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
 # Routes
 @app.route("/")
 def index():
@@ -103,14 +563,14 @@ def index():
     }
     if "user" in session:
         user_info = dict(session)["user"]
-        return render_template(
+        return render_cached(
             "dashboard.html",
             user=user_info,
             dev_firebase_config=dev_firebase_config,
             google_config=google_config,
             debug_info=debug_info,
         )
-    return render_template(
+    return render_cached(
         "login.html",
         dev_firebase_config=dev_firebase_config,
         google_config=google_config,
@@ -120,7 +580,7 @@ def index():
 
 @app.route("/login")
 def login():
-    return render_template("login.html", dev_firebase_config=dev_firebase_config)
+    return render_cached("login.html", dev_firebase_config=dev_firebase_config)
 
 
 @app.route("/authorize")
@@ -157,7 +617,7 @@ def dashboard():
         user_data = json.loads(user_data)
         session["user"] = user_data
 
-    return render_template(
+    return render_cached(
         "dashboard.html",
         dev_firebase_config=dev_firebase_config,
         google_config=google_config,
@@ -206,23 +666,118 @@ def receive_sensor_data():
             return jsonify({"error": "Missing required fields"}), 400
 
         # Get user data
-        user_data = firebase_service.get_user_data(user_id)
+        user_data = usage_aggregator.get_user_data(user_id)
+        using_custom_key = bool(user_data.get("gemini_api_key"))
 
-        # Configure Gemini with appropriate API key
-        if user_data.get("gemini_api_key"):
-            gemini_service.configure_with_key(user_data["gemini_api_key"])
-            using_custom_key = True
-        else:
-            gemini_service.configure_with_key()
-            using_custom_key = False
+        # Lịch sử trước lần đọc này, kích thước cố định dù lịch sử dài bao nhiêu
+        context = feature_summaries.context(user_id, user_data)
 
-        # Get health suggestion
-        suggestion_data, raw_response = gemini_service.get_health_suggestion(
-            data["temperature"], data["humidity"], data["noise"]
-        )
+        # Chế độ bất đồng bộ: lưu và phản hồi ngay, khuyến nghị được tạo sau
+        async_mode = data.get("async", ASYNC_SUGGESTIONS)
+        if async_mode and not data.get("get_recommendation_only"):
+            if suggestion_pool.is_full():
+                response = jsonify(
+                    {
+                        "error": "Suggestion queue is full",
+                        "queue": suggestion_pool.status(),
+                    }
+                )
+                response.headers["Retry-After"] = SUGGESTION_RETRY_AFTER
+                return response, 503
+
+            current_time = datetime.now().isoformat()
+            reading_data = {
+                "temperature": data["temperature"],
+                "humidity": data["humidity"],
+                "noise": data["noise"],
+                "timestamp": current_time,
+                "userId": user_id,
+                "suggestion_status": "pending",
+                "using_custom_key": using_custom_key,
+                "request_number": user_data.get("requests_this_hour", 0) + 1,
+            }
+
+            # Chưa có document trên Firestore thì không gắn khuyến nghị vào được
+            document_id, deferred = save_reading(
+                user_id, reading_data, {"suggestion_status": "dropped"}
+            )
+            # Lượt gọi Gemini được đếm khi worker thật sự gọi model
+            usage_aggregator.record(user_id, reading_data, requests=0)
+            if deferred:
+                return (
+                    jsonify(
+                        {
+                            "success": True,
+                            "suggestion": None,
+                            "suggestion_status": "dropped",
+                            "timestamp": current_time,
+                            "document_id": document_id,
+                            "queued": True,
+                        }
+                    ),
+                    202,
+                )
+
+            queued = suggestion_pool.submit(
+                {
+                    "document_id": document_id,
+                    "user_id": user_id,
+                    "api_key": user_data.get("gemini_api_key"),
+                    "temperature": data["temperature"],
+                    "humidity": data["humidity"],
+                    "noise": data["noise"],
+                    "context": context,
+                }
+            )
+            if not queued:
+                firebase_service.mark_suggestion_status(document_id, "dropped")
+                dashboard_snapshots.update(
+                    user_id, document_id, {"suggestion_status": "dropped"}
+                )
+
+            return (
+                jsonify(
+                    {
+                        "success": True,
+                        "suggestion": None,
+                        "suggestion_status": "pending" if queued else "dropped",
+                        "timestamp": current_time,
+                        "document_id": document_id,
+                    }
+                ),
+                202,
+            )
+
+        # Chế độ stream: gửi từng phần khuyến nghị qua SSE ngay khi model trả về
+        if data.get("stream"):
+            return Response(
+                stream_suggestion_events(data, user_id, user_data, context),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        # Get health suggestion with the user's key or the default key
+        over_quota = None
+        check = quota_check(user_id, user_data.get("gemini_api_key"))
+        try:
+            suggestion_data, raw_response = gemini_service.get_health_suggestion(
+                data["temperature"],
+                data["humidity"],
+                data["noise"],
+                api_key=user_data.get("gemini_api_key"),
+                user_id=user_id,
+                context=context,
+                quota_check=check,
+            )
+        except QuotaExceeded as e:
+            # Vượt hạn mức vẫn lưu lần đọc, chỉ bỏ qua khuyến nghị
+            over_quota = e
+            suggestion_data, raw_response = None, None
 
         # Kiểm tra nếu chỉ cần lấy khuyến nghị
         if data.get("get_recommendation_only"):
+            if over_quota is not None:
+                return quota_response(over_quota)
             return jsonify({"success": True, "suggestion": suggestion_data})
 
         # Current timestamp
@@ -240,25 +795,429 @@ def receive_sensor_data():
             "using_custom_key": using_custom_key,
             "request_number": user_data.get("requests_this_hour", 0) + 1,
         }
+        if over_quota is not None:
+            reading_data["suggestion_status"] = "quota_exceeded"
 
-        # Save to Firestore
-        document_id = firebase_service.save_sensor_reading(user_id, reading_data)
-        firebase_service.update_user_usage(user_id, reading_data)
+        # Save to Firestore, or the outbox while it is unreachable
+        document_id, queued = save_reading(user_id, reading_data)
+        usage_aggregator.record(user_id, reading_data, requests=int(check.called))
 
-        return jsonify(
-            {
-                "success": True,
-                "suggestion": suggestion_data,
-                "timestamp": current_time,
-                "document_id": document_id,
-            }
-        )
+        response = {
+            "success": True,
+            "suggestion": suggestion_data,
+            "timestamp": current_time,
+            "document_id": document_id,
+        }
+        if over_quota is not None:
+            response["suggestion_status"] = "quota_exceeded"
+            response["retry_after"] = over_quota.retry_after
+        if queued:
+            response["queued"] = True
+            return jsonify(response), 202
+        return jsonify(response)
 
     except Exception as e:
+        ERRORS.inc("receive_sensor_data")
         print(f"Error processing sensor data: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+def stream_suggestion_events(data, user_id, user_data, context=None):
+    """SSE messages for a streamed suggestion, ending with the saved reading"""
+    try:
+        over_quota = None
+        check = quota_check(user_id, user_data.get("gemini_api_key"))
+        try:
+            for event in gemini_service.stream_health_suggestion(
+                data["temperature"],
+                data["humidity"],
+                data["noise"],
+                api_key=user_data.get("gemini_api_key"),
+                user_id=user_id,
+                context=context,
+                quota_check=check,
+            ):
+                if event[0] == "field":
+                    yield StreamHub.format_event(
+                        "suggestion_field", {"name": event[1], "value": event[2]}
+                    )
+                else:
+                    suggestion_data, raw_response = event[1], event[2]
+        except QuotaExceeded as e:
+            # Vượt hạn mức vẫn lưu lần đọc, chỉ bỏ qua khuyến nghị
+            over_quota = e
+            suggestion_data, raw_response = None, None
+
+        if data.get("get_recommendation_only"):
+            if over_quota is not None:
+                yield StreamHub.format_event("error", over_quota.to_dict())
+                return
+            yield StreamHub.format_event(
+                "done", {"success": True, "suggestion": suggestion_data}
+            )
+            return
+
+        current_time = datetime.now().isoformat()
+        reading_data = {
+            "temperature": data["temperature"],
+            "humidity": data["humidity"],
+            "noise": data["noise"],
+            "timestamp": current_time,
+            "userId": user_id,
+            "suggestion": suggestion_data,
+            "raw_response": raw_response,
+            "using_custom_key": bool(user_data.get("gemini_api_key")),
+            "request_number": user_data.get("requests_this_hour", 0) + 1,
+        }
+        if over_quota is not None:
+            reading_data["suggestion_status"] = "quota_exceeded"
+        document_id, queued = save_reading(user_id, reading_data)
+        usage_aggregator.record(user_id, reading_data, requests=int(check.called))
+
+        done = {
+            "success": True,
+            "suggestion": suggestion_data,
+            "timestamp": current_time,
+            "document_id": document_id,
+        }
+        if over_quota is not None:
+            done["suggestion_status"] = "quota_exceeded"
+            done["retry_after"] = over_quota.retry_after
+        if queued:
+            done["queued"] = True
+        yield StreamHub.format_event("done", done)
+    except Exception as e:
+        # Header đã gửi, chỉ còn cách báo lỗi bằng một event
+        ERRORS.inc("stream_suggestion_events")
+        print(f"Error streaming sensor data: {e}")
+        yield StreamHub.format_event("error", {"error": str(e)})
+
+
+def parse_batch_readings(readings):
+    """Validate buffered readings in one pass, return (parsed, errors).
+
+    parsed is sorted by time, with every timestamp rendered as local ISO
+    time the same way stored documents are expanded.
+    """
+    parsed = []
+    epochs = []
+    errors = []
+    for index, reading in enumerate(readings):
+        if not isinstance(reading, dict):
+            errors.append({"index": index, "error": "Reading must be an object"})
+            continue
+
+        values = {}
+        for field in ["temperature", "humidity", "noise"]:
+            value = reading.get(field)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors.append({"index": index, "error": f"Invalid {field}"})
+                break
+            values[field] = value
+        else:
+            # Thiết bị offline gửi kèm thời điểm đo (ISO string hoặc epoch)
+            timestamp = reading.get("timestamp")
+            try:
+                # Quy về epoch để ISO có offset, ISO không offset và epoch so sánh được
+                epoch = time.time() if timestamp is None else to_epoch(timestamp)
+                values["timestamp"] = datetime.fromtimestamp(epoch).isoformat()
+            except (TypeError, ValueError, OverflowError, OSError):
+                errors.append({"index": index, "error": "Invalid timestamp"})
+                continue
+            parsed.append(values)
+            epochs.append(epoch)
+
+    order = sorted(range(len(parsed)), key=epochs.__getitem__)
+    return [parsed[i] for i in order], errors
+
+
+@app.route("/api/sensor_data/batch", methods=["POST"])
+@limiter.limit("10 per minute")
+def receive_sensor_data_batch():
+    """Store a device's buffered readings with one Firestore WriteBatch"""
+    try:
+        data = request.json
+        user_id = data.get("user_id")
+        readings = data.get("readings")
+
+        if not user_id:
+            return jsonify({"error": "Missing user_id"}), 400
+        if not isinstance(readings, list) or not readings:
+            return jsonify({"error": "Missing readings"}), 400
+        if len(readings) > BATCH_MAX_READINGS:
+            return (
+                jsonify({"error": f"Too many readings, max {BATCH_MAX_READINGS}"}),
+                400,
+            )
+
+        parsed, errors = parse_batch_readings(readings)
+        if errors:
+            return jsonify({"error": "Invalid readings", "details": errors}), 400
+        # Readings trải qua nhiều giờ cần thêm rollup, vẫn phải vừa một WriteBatch
+        if not firebase_service.fits_in_one_batch(parsed):
+            return (
+                jsonify(
+                    {
+                        "error": "Readings span too many hours for one batch, "
+                        "send them in smaller batches"
+                    }
+                ),
+                400,
+            )
+
+        # Tùy chọn: một khuyến nghị cho toàn bộ khoảng thời gian
+        suggestion_data = None
+        over_quota = None
+        using_custom_key = False
+        if data.get("suggest"):
+            user_data = usage_aggregator.get_user_data(user_id)
+            using_custom_key = bool(user_data.get("gemini_api_key"))
+
+            count = len(parsed)
+            check = quota_check(user_id, user_data.get("gemini_api_key"))
+            try:
+                suggestion_data, raw_response = gemini_service.get_health_suggestion(
+                    round(sum(r["temperature"] for r in parsed) / count, 1),
+                    round(sum(r["humidity"] for r in parsed) / count, 1),
+                    round(sum(r["noise"] for r in parsed) / count, 1),
+                    api_key=user_data.get("gemini_api_key"),
+                    user_id=user_id,
+                    context=feature_summaries.context(user_id, user_data),
+                    quota_check=check,
+                )
+            except QuotaExceeded as e:
+                # Vượt hạn mức vẫn lưu các lần đọc, chỉ bỏ qua khuyến nghị
+                over_quota = e
+
+        reading_docs = []
+        for reading in parsed:
+            reading_docs.append(
+                {
+                    **reading,
+                    "userId": user_id,
+                    "using_custom_key": using_custom_key,
+                    "batch": True,
+                }
+            )
+        # Khuyến nghị của cả cửa sổ được gắn vào lần đọc mới nhất
+        if suggestion_data is not None:
+            reading_docs[-1]["suggestion"] = suggestion_data
+            reading_docs[-1]["raw_response"] = raw_response
+        elif over_quota is not None:
+            reading_docs[-1]["suggestion_status"] = "quota_exceeded"
+
+        # Lượt gọi Gemini được đếm qua bộ gộp usage, không ghi trong batch
+        document_ids = firebase_service.save_sensor_readings_batch(
+            user_id, reading_docs, count_request=False
+        )
+        if suggestion_data is not None:
+            usage_aggregator.record(user_id, reading_docs[-1], requests=int(check.called))
+        for document_id, reading in zip(document_ids, reading_docs):
+            dashboard_snapshots.apply(user_id, document_id, reading)
+            feature_summaries.record(user_id, reading)
+
+        response = {
+            "success": True,
+            "count": len(document_ids),
+            "document_ids": document_ids,
+            "suggestion": suggestion_data,
+            "window": {
+                "start": parsed[0]["timestamp"],
+                "end": parsed[-1]["timestamp"],
+            },
+        }
+        if over_quota is not None:
+            response["suggestion_status"] = "quota_exceeded"
+            response["retry_after"] = over_quota.retry_after
+        return jsonify(response)
+
+    except Exception as e:
+        ERRORS.inc("receive_sensor_data_batch")
+        print(f"Error processing sensor data batch: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/suggestion_queue/status", methods=["GET"])
+def suggestion_queue_status():
+    """Report queue length and worker utilisation of the suggestion pool"""
+    return jsonify({"async_mode": ASYNC_SUGGESTIONS, **suggestion_pool.status()})
+
+
+@app.route("/api/stream", methods=["GET"])
+@limiter.exempt
+@user_required
+def stream():
+    """Server-Sent Events with new readings, suggestions and usage of the signed-in user"""
+    # Worker đồng bộ chỉ phục vụ một request mỗi lúc, stream không kết thúc sẽ
+    # chiếm nó tới khi gunicorn kill; dashboard chuyển sang hỏi snapshot định kỳ
+    if not request.environ.get("wsgi.multithread"):
+        return (
+            jsonify(
+                {
+                    "error": "Streaming needs a gevent, threaded or ASGI worker",
+                    "fallback": url_for("dashboard_snapshot"),
+                }
+            ),
+            503,
+        )
+
+    user_id = g.user_id
+    subscription = stream_hub.subscribe(user_id)
+    if subscription is None:
+        return jsonify({"error": "Too many open streams"}), 503
+
+    try:
+        user_data = usage_aggregator.get_user_data(user_id, create=False)
+        initial_events = [
+            ("snapshot", {"readings": dashboard_snapshots.readings(user_id)}),
+            (
+                "usage",
+                {
+                    "requests_this_hour": user_data.get("requests_this_hour", 0),
+                    "has_custom_key": bool(user_data.get("gemini_api_key")),
+                },
+            ),
+        ]
+    except Exception as e:
+        stream_hub.unsubscribe(subscription)
+        ERRORS.inc("stream")
+        print(f"Error opening stream: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    return Response(
+        stream_hub.stream(subscription, initial_events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/dashboard/snapshot", methods=["GET"])
+@limiter.exempt
+@user_required
+def dashboard_snapshot():
+    """Readings, current suggestion and usage of the signed-in user for the dashboard's first paint"""
+    user_id = g.user_id
+    try:
+        readings = dashboard_snapshots.readings(user_id)
+        user_data = usage_aggregator.get_user_data(user_id, create=False)
+    except Exception as e:
+        ERRORS.inc("dashboard_snapshot")
+        print(f"Error building dashboard snapshot: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    payload = {
+        "readings": readings,
+        # Khuyến nghị hoàn chỉnh mới nhất
+        "suggestion": next(
+            (
+                reading["suggestion"]
+                for reading in readings
+                if reading.get("suggestion") and reading.get("suggestion_status") != "streaming"
+            ),
+            None,
+        ),
+        "usage": {
+            "requests_this_hour": user_data.get("requests_this_hour", 0),
+            "has_custom_key": bool(user_data.get("gemini_api_key")),
+        },
+    }
+    response = jsonify(payload)
+    response.set_etag(payload_etag(payload))
+    # Dữ liệu riêng của user, trình duyệt luôn hỏi lại bằng If-None-Match
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/api/dashboard/stats", methods=["GET"])
+def dashboard_stats():
+    """Report hit ratio of the dashboard snapshots and cached pages"""
+    return jsonify({**dashboard_snapshots.stats(), "cached_pages": page_cache.size()})
+
+
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def metrics():
+    """Latency histograms and counters in the Prometheus text format"""
+    return Response(REGISTRY.expose(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/stream/status", methods=["GET"])
+def stream_status():
+    """Report connected SSE clients and upstream listener state"""
+    return jsonify(stream_hub.stats())
+
+
+@app.route("/api/usage/status", methods=["GET"])
+def usage_status():
+    """Report usage counters waiting to be flushed"""
+    return jsonify(usage_aggregator.stats())
+
+
+@app.route("/api/user_cache/stats", methods=["GET"])
+def user_cache_stats():
+    """Report hit ratio of the user profile cache"""
+    return jsonify(firebase_service.user_cache.stats())
+
+
+@app.route("/api/suggestion_cache/stats", methods=["GET"])
+def suggestion_cache_stats():
+    """Report hit/miss counters of the suggestion cache"""
+    return jsonify(gemini_service.suggestion_cache.stats())
+
+
+@app.route("/api/suggestion_batcher/stats", methods=["GET"])
+def suggestion_batcher_stats():
+    """Report how many suggestion requests were coalesced per Gemini call"""
+    return jsonify(gemini_service.batcher.stats())
+
+
+@app.route("/api/suggestion_rules/stats", methods=["GET"])
+def suggestion_rules_stats():
+    """Report how many suggestions were answered locally instead of by Gemini"""
+    return jsonify(gemini_service.rules.stats())
+
+
+@app.route("/api/outbox/status", methods=["GET"])
+def outbox_status():
+    """Report readings queued on disk while Firestore is unreachable"""
+    if not outbox:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **outbox.stats()})
+
+
+@app.route("/api/features/stats", methods=["GET"])
+def feature_stats():
+    """Report how many users have rolling features and how they were updated"""
+    return jsonify(feature_summaries.stats())
+
+
+@app.route("/api/features", methods=["GET"])
+@user_required
+def user_features():
+    """Rolling features of the signed-in user and the history block sent to Gemini"""
+    user_id = g.user_id
+    context = feature_summaries.context(user_id)
+    return jsonify(
+        {
+            "user_id": user_id,
+            "features": feature_summaries.describe(user_id),
+            "context": context.text if context else None,
+        }
+    )
+
+
+@app.route("/api/quota/stats", methods=["GET"])
+def quota_stats():
+    """Report quota limits, the shared store and how many checks stayed local"""
+    return jsonify(quota.stats())
+
+
+@app.route("/api/startup/report", methods=["GET"])
+def startup_report():
+    """Where import and service initialisation time went in this process"""
+    return jsonify(STARTUP.report())
+
+
 @app.route("/api/update_gemini_key", methods=["POST"])
 def update_gemini_key():
     try:
@@ -270,7 +1229,14 @@ def update_gemini_key():
             return jsonify({"error": "Missing user_id or api_key"}), 400
 
         # Validate API key
-        if gemini_service.validate_api_key(api_key):
+        try:
+            is_valid = gemini_service.validate_api_key(api_key)
+        except Exception as e:
+            # Lỗi mạng/timeout không có nghĩa là key sai
+            return jsonify({"error": f"Could not validate API key: {e}"}), 503
+        if is_valid:
+            # Ghi các lượt đếm còn chờ trước khi transaction đặt lại bộ đếm
+            usage_aggregator.flush([user_id])
             firebase_service.update_gemini_key(user_id, api_key)
             return jsonify({"success": True, "message": "API key updated successfully"})
         else:
@@ -289,6 +1255,7 @@ def remove_gemini_key():
         if not user_id:
             return jsonify({"error": "Missing user_id"}), 400
 
+        usage_aggregator.flush([user_id])
         firebase_service.remove_gemini_key(user_id)
         return jsonify({"success": True, "message": "API key removed successfully"})
 
@@ -311,26 +1278,178 @@ def read_sensors():
                 400,
             )
 
-        # Đọc dữ liệu từ cảm biến
-        sensor_data = sensor_service.read_all_sensors()
+        window = request.args.get("window", type=int)
+        if sensor_service.sampling and window:
+            samples = sensor_service.recent_samples(window)
+            return jsonify(
+                {
+                    "success": True,
+                    "samples": samples,
+                    "sampling": sensor_service.sampling_stats(),
+                }
+            )
+
+        # Đọc mẫu mới nhất từ luồng lấy mẫu, đọc trực tiếp nếu chưa có mẫu nào
+        sensor_data = sensor_service.latest_sample() if sensor_service.sampling else None
+        if sensor_data is not None:
+            sample_age = round(time.time() - sensor_data["timestamp"], 3)
+        else:
+            sensor_data = sensor_service.read_all_sensors()
+            sample_age = 0
+
+            # Ghi vào lịch sử cục bộ trước khi đổi timestamp sang ISO
+            if timeseries_store and not sensor_service.sampling:
+                try:
+                    timeseries_store.append(sensor_data)
+                except Exception as e:
+                    ERRORS.inc("read_sensors.timeseries")
+                    print(f"Error writing local time-series: {e}")
 
         # Thêm timestamp
-        sensor_data["timestamp"] = datetime.now().isoformat()
+        sensor_data["timestamp"] = datetime.fromtimestamp(sensor_data["timestamp"]).isoformat()
 
         # Tùy chọn: lưu dữ liệu vào Firebase
         if request.args.get("save") == "true":
             user_id = request.args.get("user_id")
             if user_id:
-                # Lưu dữ liệu vào Firebase
-                document_id = firebase_service.save_sensor_reading(user_id, sensor_data)
+                # Lưu dữ liệu vào Firebase, vào outbox nếu mất kết nối
+                document_id, queued = save_reading(user_id, sensor_data)
                 sensor_data["document_id"] = document_id
+                if queued:
+                    sensor_data["queued"] = True
 
-        return jsonify({"success": True, "data": sensor_data})
+        return jsonify({"success": True, "data": sensor_data, "sample_age": sample_age})
 
     except Exception as e:
+        ERRORS.inc("read_sensors")
         print(f"Error reading sensors: {e}")
         return jsonify({"error": str(e), "message": "Failed to read from sensors"}), 500
 
 
+@app.route("/api/sensors/status", methods=["GET"])
+def sensors_status():
+    """Report sample age and read-failure rate of the sampling loop"""
+    if not sensor_service:
+        return jsonify({"error": "Sensor hardware not available"}), 400
+    return jsonify(sensor_service.sampling_stats())
+
+
+@app.route("/api/readings/local", methods=["GET"])
+def local_readings():
+    """Recent sensor history from the on-device time-series store"""
+    try:
+        if not timeseries_store:
+            return (
+                jsonify(
+                    {
+                        "error": "Local history not available",
+                        "message": "This endpoint only works on Raspberry Pi",
+                    }
+                ),
+                400,
+            )
+
+        start = request.args.get("start", type=float)
+        end = request.args.get("end", type=float)
+        limit = request.args.get("limit", default=100, type=int)
+        if limit < 1:
+            return jsonify({"error": "limit must be at least 1"}), 400
+
+        if start is None and end is None:
+            readings = timeseries_store.latest(limit)
+        else:
+            readings = timeseries_store.range(start, end, limit=limit)
+
+        return jsonify(
+            {
+                "success": True,
+                "count": len(readings),
+                "readings": readings,
+                "store": timeseries_store.stats(),
+            }
+        )
+
+    except Exception as e:
+        ERRORS.inc("local_readings")
+        print(f"Error reading local history: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def parse_time_arg(name, default):
+    """Parse a query argument given as epoch seconds or an ISO timestamp"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+@app.route("/api/readings/aggregate", methods=["GET"])
+@user_required
+def aggregate_readings():
+    """Min/max/mean/percentiles per time bucket, computed from ingest-time rollups"""
+    try:
+        user_id = g.user_id
+        bucket = request.args.get("bucket", "hour")
+        bucket_seconds = GRANULARITIES.get(bucket)
+        if bucket_seconds is None:
+            try:
+                bucket_seconds = int(bucket)
+            except ValueError:
+                return jsonify({"error": "Invalid bucket"}), 400
+        if bucket_seconds <= 0 or bucket_seconds % GRANULARITIES["hour"]:
+            return jsonify({"error": "Bucket must be a whole number of hours"}), 400
+
+        # Dùng rollup theo ngày khi bucket là bội số của ngày
+        granularity = "day" if bucket_seconds % GRANULARITIES["day"] == 0 else "hour"
+
+        end = parse_time_arg("end", time.time())
+        start = parse_time_arg("start", end - 7 * 86400)
+        start = bucket_start(datetime.fromtimestamp(start).isoformat(), granularity)
+        if end <= start:
+            return jsonify({"error": "end must be after start"}), 400
+        if (end - start) / bucket_seconds > AGGREGATE_MAX_BUCKETS:
+            return jsonify({"error": f"Too many buckets, max {AGGREGATE_MAX_BUCKETS}"}), 400
+
+        try:
+            percentiles = [
+                float(p) for p in request.args.get("percentiles", "50,90,95").split(",") if p
+            ]
+        except ValueError:
+            return jsonify({"error": "Invalid percentiles"}), 400
+        # Viết dạng 0 <= p <= 100 để loại cả nan
+        if not all(0 <= p <= 100 for p in percentiles):
+            return jsonify({"error": "Percentiles must be between 0 and 100"}), 400
+        percentiles = [int(p) if p.is_integer() else p for p in percentiles]
+
+        rollups = firebase_service.get_rollups(user_id, granularity, start, end)
+        result = aggregate_rollups(rollups, start, end, bucket_seconds, percentiles)
+
+        return jsonify(
+            {
+                "success": True,
+                "user_id": user_id,
+                "start": start,
+                "end": end,
+                "source_granularity": granularity,
+                **result,
+            }
+        )
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        ERRORS.inc("aggregate_readings")
+        print(f"Error aggregating readings: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+if PRELOAD_APP:
+    warm_imports()
+
+
 if __name__ == "__main__":
+    start_background_services()
     app.run(debug=True)
@@ -0,0 +1,40 @@
+"""Rewrite old sensor_readings documents in the compact schema.
+
+Usage (from the repository root, with the deployment's .env):
+
+    python migrate_readings.py                  # migrate everything
+    python migrate_readings.py --max-batches 10 # stop after 10 pages
+
+Safe to interrupt and run again: migrated documents are no longer matched.
+The app reads both schemas, so it can keep running during the migration.
+"""
+
+import argparse
+
+from main import create_firebase_service
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--batch-size", type=int, default=200, help="documents per batch")
+    parser.add_argument("--max-batches", type=int, default=None, help="stop after N batches")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    firebase_service = create_firebase_service()
+    total = 0
+    batches = 0
+    while args.max_batches is None or batches < args.max_batches:
+        migrated = firebase_service.migrate_legacy_readings(args.batch_size)
+        if not migrated:
+            break
+        total += migrated
+        batches += 1
+        print(f"Migrated {total} readings")
+    print(f"Done: {total} readings in {batches} batches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import math
+from datetime import datetime
+
+import numpy as np
+
+METRICS = ["temperature", "humidity", "noise"]
+
+# Độ rộng bin histogram dùng để tính percentile từ rollup
+HISTOGRAM_BIN_WIDTHS = {"temperature": 0.5, "humidity": 1.0, "noise": 1.0}
+
+# Khoảng giá trị có histogram; giá trị ngoài khoảng (cảm biến lỗi) rơi vào bin ở biên
+# để một lần đọc bất thường không làm mảng histogram phình ra
+HISTOGRAM_RANGES = {"temperature": (-50.0, 100.0), "humidity": (0.0, 100.0), "noise": (0.0, 150.0)}
+
+
+def histogram_bin(value, metric):
+    """Histogram bin index of a value, clamped to the metric's range"""
+    low, high = HISTOGRAM_RANGES[metric]
+    width = HISTOGRAM_BIN_WIDTHS[metric]
+    return math.floor(min(max(value, low), high) / width)
+
+# Rollup được ghi ở hai độ phân giải: theo giờ và theo ngày
+GRANULARITIES = {"hour": 3600, "day": 86400}
+
+
+def bucket_start(timestamp, granularity):
+    """Epoch of the hour/day containing an ISO timestamp"""
+    moment = datetime.fromisoformat(timestamp)
+    if granularity == "day":
+        moment = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        moment = moment.replace(minute=0, second=0, microsecond=0)
+    return int(moment.timestamp())
+
+
+def summarize_for_rollups(readings):
+    """Pre-aggregate readings into one summary per (granularity, bucket)"""
+    summaries = {}
+    for reading in readings:
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(reading["timestamp"], granularity))
+            summary = summaries.get(key)
+            if summary is None:
+                summary = summaries[key] = {
+                    "count": 0,
+                    "sum": {metric: 0.0 for metric in METRICS},
+                    "min": {metric: math.inf for metric in METRICS},
+                    "max": {metric: -math.inf for metric in METRICS},
+                    "hist": {metric: {} for metric in METRICS},
+                }
+            summary["count"] += 1
+            for metric in METRICS:
+                value = float(reading[metric])
+                summary["sum"][metric] += value
+                summary["min"][metric] = min(summary["min"][metric], value)
+                summary["max"][metric] = max(summary["max"][metric], value)
+                bin_key = str(histogram_bin(value, metric))
+                hist = summary["hist"][metric]
+                hist[bin_key] = hist.get(bin_key, 0) + 1
+    return summaries
+
+
+def aggregate_rollups(rollups, start, end, bucket_seconds, percentiles=(50, 90, 95)):
+    """Merge rollup documents into buckets of bucket_seconds, vectorized with NumPy"""
+    n_buckets = max(1, math.ceil((end - start) / bucket_seconds))
+    bucket_starts = start + bucket_seconds * np.arange(n_buckets)
+    result = {
+        "bucket_seconds": bucket_seconds,
+        "buckets": [],
+    }
+    rollups = [r for r in rollups if start <= r["bucket_start"] < end and r.get("count")]
+
+    if rollups:
+        index = (
+            (np.array([r["bucket_start"] for r in rollups]) - start) // bucket_seconds
+        ).astype(np.int64)
+        doc_counts = np.array([r["count"] for r in rollups], dtype=np.float64)
+        counts = np.bincount(index, weights=doc_counts, minlength=n_buckets)
+    else:
+        index = np.zeros(0, dtype=np.int64)
+        counts = np.zeros(n_buckets)
+
+    empty = counts == 0
+    stats = {}
+    for metric in METRICS:
+        if rollups:
+            sums = np.bincount(
+                index,
+                weights=np.array([r["sum"][metric] for r in rollups], dtype=np.float64),
+                minlength=n_buckets,
+            )
+            mins = np.full(n_buckets, np.inf)
+            np.minimum.at(mins, index, np.array([r["min"][metric] for r in rollups]))
+            maxs = np.full(n_buckets, -np.inf)
+            np.maximum.at(maxs, index, np.array([r["max"][metric] for r in rollups]))
+        else:
+            sums = np.zeros(n_buckets)
+            mins = np.full(n_buckets, np.inf)
+            maxs = np.full(n_buckets, -np.inf)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        stats[metric] = {
+            "min": mins,
+            "max": maxs,
+            "mean": means,
+            "percentiles": _histogram_percentiles(
+                rollups, index, n_buckets, counts, metric, percentiles, mins, maxs
+            ),
+        }
+
+    for i in range(n_buckets):
+        bucket = {
+            "start": int(bucket_starts[i]),
+            "count": int(counts[i]),
+        }
+        for metric in METRICS:
+            metric_stats = stats[metric]
+            if empty[i]:
+                bucket[metric] = None
+                continue
+            bucket[metric] = {
+                "min": round(float(metric_stats["min"][i]), 2),
+                "max": round(float(metric_stats["max"][i]), 2),
+                "mean": round(float(metric_stats["mean"][i]), 2),
+                **{
+                    f"p{p}": round(float(metric_stats["percentiles"][p][i]), 2)
+                    for p in percentiles
+                },
+            }
+        result["buckets"].append(bucket)
+    return result
+
+
+def _histogram_percentiles(rollups, index, n_buckets, counts, metric, percentiles, mins, maxs):
+    """Percentiles per bucket from merged histograms, at bin resolution"""
+    if not rollups:
+        return {p: np.full(n_buckets, np.nan) for p in percentiles}
+
+    rows, bins, weights = [], [], []
+    for row, rollup in zip(index, rollups):
+        for bin_key, count in rollup["hist"][metric].items():
+            rows.append(row)
+            bins.append(int(bin_key))
+            weights.append(count)
+    rows = np.array(rows, dtype=np.int64)
+    # Rollup cũ có thể còn bin ngoài khoảng, kẹp lại để kích thước mảng luôn có giới hạn
+    low, high = HISTOGRAM_RANGES[metric]
+    bins = np.clip(
+        np.array(bins, dtype=np.int64),
+        histogram_bin(low, metric),
+        histogram_bin(high, metric),
+    )
+    lowest = bins.min()
+    n_bins = int(bins.max() - lowest + 1)
+
+    histogram = np.zeros((n_buckets, n_bins))
+    np.add.at(histogram, (rows, bins - lowest), np.array(weights, dtype=np.float64))
+    cumulative = np.cumsum(histogram, axis=1)
+
+    width = HISTOGRAM_BIN_WIDTHS[metric]
+    values = {}
+    for p in percentiles:
+        target = counts * (p / 100.0)
+        position = np.argmax(cumulative >= target[:, None] - 1e-9, axis=1)
+        # Lấy tâm bin, giới hạn trong [min, max] chính xác của bucket
+        estimate = (lowest + position + 0.5) * width
+        values[p] = np.clip(estimate, mins, maxs)
+    return values
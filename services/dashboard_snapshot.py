@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import threading
+
+from services.reading_schema import to_epoch
+from services.suggestion_cache import MemoryCacheBackend
+
+
+def _newest_first(reading):
+    # ISO có/không offset và epoch đều quy về epoch trước khi so sánh
+    timestamp = reading.get("timestamp")
+    return to_epoch(timestamp) if timestamp is not None else float("-inf")
+
+
+class DashboardSnapshots:
+    """Per-user dashboard data kept current by the ingest path.
+
+    A snapshot is seeded once from Firestore (the latest readings of the
+    user) and then updated in place whenever this process saves a reading
+    or attaches a suggestion, so opening the dashboard or reconnecting its
+    stream does not query Firestore. Readings saved by other workers show
+    up once the snapshot expires after DASHBOARD_SNAPSHOT_TTL seconds;
+    updates do not extend its lifetime.
+    """
+
+    def __init__(self, firebase_service, size=None, max_users=None, ttl=None):
+        self.firebase_service = firebase_service
+        self.size = size or int(os.getenv("DASHBOARD_SNAPSHOT_READINGS", "10"))
+        self._snapshots = MemoryCacheBackend(
+            max_entries=max_users or int(os.getenv("DASHBOARD_SNAPSHOT_MAX_USERS", "1000")),
+            ttl=ttl or float(os.getenv("DASHBOARD_SNAPSHOT_TTL", "60")),
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def readings(self, user_id):
+        """Latest readings of a user, newest first"""
+        snapshot = self._snapshots.get(user_id)
+        if snapshot is None:
+            with self._lock:
+                self.misses += 1
+            snapshot = self._seed(user_id)
+        else:
+            with self._lock:
+                self.hits += 1
+        with self._lock:
+            return [dict(reading) for reading in snapshot]
+
+    def _seed(self, user_id):
+        snapshot = self.firebase_service.get_recent_readings(user_id, limit=self.size)
+        self._snapshots.set(user_id, snapshot)
+        return snapshot
+
+    def apply(self, user_id, document_id, reading_data):
+        """Add a reading this process just saved"""
+        snapshot = self._snapshots.get(user_id)
+        # Chưa có snapshot thì lần xem tới sẽ đọc cả lần đọc này từ Firestore
+        if snapshot is None:
+            return
+        reading = {
+            name: value for name, value in reading_data.items() if name != "raw_response"
+        }
+        reading["id"] = document_id
+        with self._lock:
+            snapshot[:] = [r for r in snapshot if r.get("id") != document_id]
+            snapshot.append(reading)
+            snapshot.sort(key=_newest_first, reverse=True)
+            del snapshot[self.size:]
+            self.updates += 1
+
+    def update(self, user_id, document_id, fields):
+        """Merge fields (a suggestion, its status) into a reading of the snapshot"""
+        snapshot = self._snapshots.get(user_id)
+        if snapshot is None:
+            return
+        with self._lock:
+            for reading in snapshot:
+                if reading.get("id") == document_id:
+                    reading.update(fields)
+                    self.updates += 1
+                    return
+
+    def invalidate(self, user_id):
+        self._snapshots.delete(user_id)
+
+    def stats(self):
+        with self._lock:
+            hits, misses, updates = self.hits, self.misses, self.updates
+        lookups = hits + misses
+        return {
+            "users": self._snapshots.size(),
+            "readings_per_user": self.size,
+            "ttl": self._snapshots.ttl,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "updates": updates,
+        }
+
+
+def payload_etag(payload):
+    """Strong ETag of a JSON payload, stable across workers"""
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(body.encode()).hexdigest()[:32]
@@ -0,0 +1,209 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from services.reading_schema import to_epoch
+from services.suggestion_rules import METRICS, UNITS, comfort_range
+
+# Độ dốc nhỏ hơn mức này (đơn vị mỗi giờ) được coi là ổn định
+STEADY_TREND = {"temperature": 0.5, "humidity": 2.0, "noise": 3.0}
+
+# Chỉ số của từng metric trong state lưu trên document user
+WEIGHT, SUM_T, SUM_X, SUM_TT, SUM_TX, ABOVE, BELOW, TOTAL, LAST = range(9)
+
+FeatureContext = namedtuple("FeatureContext", ("key", "text"))
+
+
+def update_features(state, timestamp, values, ranges, half_life, max_gap):
+    """Fold one reading into a user's rolling state in constant time.
+
+    Per metric the state keeps exponentially decayed sums of weight, time,
+    value, time² and time·value, with time in hours relative to the latest
+    reading, which give the weighted average and least-squares slope, plus
+    decayed seconds spent above and below the comfort range. A gap longer
+    than max_gap (device offline) counts as max_gap. Readings older than the
+    latest one are ignored. Returns True when the reading was applied.
+    """
+    if state.get("ts") is not None and timestamp < state["ts"]:
+        return False
+    elapsed = timestamp - state["ts"] if state.get("ts") is not None else 0.0
+    decay = 0.5 ** (elapsed / half_life)
+    shift = elapsed / 3600
+    held = min(elapsed, max_gap)
+
+    series = state.setdefault("m", {})
+    for metric in METRICS:
+        value = float(values[metric])
+        sums = series.get(metric)
+        if sums is None:
+            sums = [0.0] * LAST + [value]
+        weight, sum_t, sum_x, sum_tt, sum_tx, above, below, total, last = sums
+        low, high = ranges[metric]
+        # Các điểm cũ lùi về quá khứ một đoạn shift giờ rồi mới giảm trọng số
+        sums = [
+            decay * weight + 1,
+            decay * (sum_t - shift * weight),
+            decay * sum_x + value,
+            decay * (sum_tt - 2 * shift * sum_t + shift * shift * weight),
+            decay * (sum_tx - shift * sum_x),
+            decay * (above + (held if last > high else 0)),
+            decay * (below + (held if last < low else 0)),
+            decay * (total + held),
+            value,
+        ]
+        series[metric] = [round(v, 6) for v in sums]
+    state["ts"] = timestamp
+    state["n"] = state.get("n", 0) + 1
+    return True
+
+
+def describe_features(state):
+    """{metric: {"average", "trend_per_hour", "above", "below"}} of a rolling state"""
+    described = {}
+    for metric in METRICS:
+        sums = state["m"][metric]
+        weight, sum_t, sum_x = sums[WEIGHT], sums[SUM_T], sums[SUM_X]
+        spread = weight * sums[SUM_TT] - sum_t * sum_t
+        trend = (weight * sums[SUM_TX] - sum_t * sum_x) / spread if spread > 1e-9 else 0.0
+        total = sums[TOTAL]
+        described[metric] = {
+            "average": round(sum_x / weight, 1),
+            "trend_per_hour": round(trend, 2),
+            "above": round(sums[ABOVE] / total, 2) if total else 0.0,
+            "below": round(sums[BELOW] / total, 2) if total else 0.0,
+        }
+    return described
+
+
+def _trend_word(metric, trend):
+    if trend >= STEADY_TREND[metric]:
+        return "rising"
+    if trend <= -STEADY_TREND[metric]:
+        return "falling"
+    return "steady"
+
+
+def feature_context(state, half_life):
+    """Prompt block and coarse cache key for a rolling state"""
+    described = describe_features(state)
+    hours = half_life / 3600
+    lines = [f"Recent history (weighted average, half-life {hours:g} h):"]
+    key = []
+    for metric, features in described.items():
+        unit = UNITS[metric]
+        trend = features["trend_per_hour"]
+        parts = [
+            f"average {features['average']:g}{unit}",
+            f"{_trend_word(metric, trend)} ({trend:+g}{unit}/h)",
+        ]
+        if features["above"]:
+            parts.append(f"above comfort range {features['above']:.0%} of the time")
+        if features["below"]:
+            parts.append(f"below comfort range {features['below']:.0%} of the time")
+        lines.append(f"{metric.capitalize()}: " + ", ".join(parts))
+        # Khóa cache: hướng xu hướng và tỉ lệ thời gian ngoài ngưỡng theo từng phần tư
+        key.append(
+            "{}{}{}{}".format(
+                metric[0],
+                _trend_word(metric, trend)[0],
+                round(features["above"] * 4),
+                round(features["below"] * 4),
+            )
+        )
+    return FeatureContext("".join(key), "\n".join(lines))
+
+
+class FeatureSummaries:
+    """Per-user rolling features of the readings, for history-aware prompts.
+
+    Each saved reading updates the user's state in O(1); the prompt gets a
+    fixed-size summary of it however long the history is. States are kept
+    in an LRU per process, loaded from the user document on a miss and
+    written back through save_state (the usage write-behind). Workers keep
+    their own copy, so with several workers the stored summary is that of
+    the last one to flush.
+    """
+
+    def __init__(self, load_state, save_state, half_life=None, max_gap=None, min_readings=None, max_users=None):
+        self.enabled = os.getenv("FEATURE_CONTEXT_ENABLED", "true").lower() == "true"
+        self.load_state = load_state
+        self.save_state = save_state
+        self.half_life = half_life or float(os.getenv("FEATURE_HALF_LIFE", "7200"))
+        self.max_gap = max_gap or float(os.getenv("FEATURE_MAX_GAP", "900"))
+        self.min_readings = min_readings or int(os.getenv("FEATURE_MIN_READINGS", "3"))
+        self.max_users = max_users or int(os.getenv("FEATURE_MAX_USERS", "1000"))
+        self.ranges = {metric: comfort_range(metric) for metric in METRICS}
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.updates = 0
+        self.out_of_order = 0
+        self.loads = 0
+
+    def _state(self, user_id, user_data=None):
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None:
+                self._states.move_to_end(user_id)
+                return state
+        # Chỉ đọc document user khi state không còn trong bộ nhớ
+        if user_data is not None:
+            loaded = user_data.get("features") or {}
+        else:
+            loaded = self.load_state(user_id) or {}
+        # Không sửa trực tiếp dict của cache hồ sơ user
+        loaded = {**loaded, "m": dict(loaded.get("m", {}))}
+        self.loads += 1
+        with self._lock:
+            state = self._states.setdefault(user_id, loaded)
+            while len(self._states) > self.max_users:
+                self._states.popitem(last=False)
+            return state
+
+    def record(self, user_id, reading_data):
+        """Update a user's features with a saved reading"""
+        if not self.enabled or not all(metric in reading_data for metric in METRICS):
+            return
+        state = self._state(user_id)
+        timestamp = to_epoch(reading_data.get("timestamp") or 0)
+        with self._lock:
+            applied = update_features(
+                state, timestamp, reading_data, self.ranges, self.half_life, self.max_gap
+            )
+            if not applied:
+                self.out_of_order += 1
+                return
+            self.updates += 1
+            snapshot = {"ts": state["ts"], "n": state["n"], "m": dict(state["m"])}
+        self.save_state(user_id, snapshot)
+
+    def context(self, user_id, user_data=None):
+        """FeatureContext of a user's history, None until there is enough of it.
+
+        user_data, when the caller already has it, seeds a missing state
+        without another profile lookup.
+        """
+        if not self.enabled:
+            return None
+        state = self._state(user_id, user_data)
+        with self._lock:
+            if state.get("n", 0) < self.min_readings:
+                return None
+            return feature_context(state, self.half_life)
+
+    def describe(self, user_id):
+        """describe_features of a user, None without any reading"""
+        state = self._state(user_id)
+        with self._lock:
+            return describe_features(state) if state.get("n") else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "tracked_users": len(self._states),
+                "half_life": self.half_life,
+                "min_readings": self.min_readings,
+                "updates": self.updates,
+                "out_of_order": self.out_of_order,
+                "loads": self.loads,
+            }
@@ -1,6 +1,28 @@
+import os
 from datetime import datetime
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import auth, credentials, firestore, firestore_async
+
+from services.aggregation import METRICS, summarize_for_rollups
+from services.metrics import FIRESTORE_LATENCY
+from services.reading_schema import (
+    PARTIAL_SUGGESTION,
+    STATUS,
+    SUGGESTION_REF,
+    SUGGESTIONS_COLLECTION,
+    TIMESTAMP,
+    USER_ID,
+    compact_reading,
+    expand_reading,
+    suggestion_key,
+    suggestion_refs,
+    to_epoch,
+)
+from services.suggestion_cache import MemoryCacheBackend
+from services.user_profile_cache import UserProfileCache
+
+# Một WriteBatch Firestore tối đa 500 thao tác ghi
+MAX_BATCH_WRITES = 500
 
 
 class FirebaseService:
@@ -9,34 +31,475 @@ class FirebaseService:
             cred = credentials.Certificate(credential_path)
             firebase_admin.initialize_app(cred)
             self.db = firestore.client()
+            self._async_db = None
+            self.user_cache = UserProfileCache()
+            # suggestions/{hash} không bao giờ đổi nội dung, chỉ giới hạn số lượng giữ lại
+            self.suggestion_docs = MemoryCacheBackend(
+                max_entries=int(os.getenv("SUGGESTION_DOC_CACHE_SIZE", "2000")), ttl=86400
+            )
+            # Đọc thêm các document schema cũ (userId/timestamp) chưa được migrate
+            self.legacy_reads = os.getenv("READINGS_LEGACY_COMPAT", "true").lower() == "true"
             print("Firebase Admin SDK initialized successfully")
         except Exception as e:
             print(f"Error initializing Firebase Admin SDK: {e}")
             raise e
 
-    def get_user_data(self, user_id):
-        """Get user data, create if doesn't exist"""
+    def get_user_data(self, user_id, create=True):
+        """Get user data, create if doesn't exist.
+
+        With create=False (read-only endpoints) a missing user gets the
+        defaults without writing or caching a document.
+        """
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        user_data = self._load_user_data(user_id, create)
+        if user_data is None:
+            return {"requests_this_hour": 0, "last_request_hour": None, "using_dev_account": True}
+        self.user_cache.set(user_id, user_data)
+        return user_data
+
+    def verify_id_token(self, id_token):
+        """uid of a Firebase ID token, None if it is invalid or expired"""
+        try:
+            return auth.verify_id_token(id_token)["uid"]
+        except (auth.InvalidIdTokenError, ValueError) as e:
+            print(f"Rejected Firebase ID token: {e}")
+            return None
+
+    @property
+    def async_db(self):
+        """AsyncClient for the ASGI entry point, created inside the running loop"""
+        if self._async_db is None:
+            self._async_db = firestore_async.client()
+        return self._async_db
+
+    async def get_user_data_async(self, user_id):
+        """Async get_user_data sharing the same profile cache"""
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        user_data = await self._load_user_data_async(user_id)
+        self.user_cache.set(user_id, user_data)
+        return user_data
+
+    async def _load_user_data_async(self, user_id):
+        user_ref = self.async_db.collection("users").document(user_id)
+        with FIRESTORE_LATENCY.time("users.get"):
+            user_doc = await user_ref.get()
+
+        if not user_doc.exists:
+            default_data = {
+                "requests_this_hour": 0,
+                "last_request_hour": None,
+                "using_dev_account": True,
+                "created_at": datetime.now().isoformat(),
+            }
+            with FIRESTORE_LATENCY.time("users.set"):
+                await user_ref.set(default_data)
+            return default_data
+
+        return user_doc.to_dict()
+
+    def _load_user_data(self, user_id, create=True):
         user_ref = self.db.collection("users").document(user_id)
-        user_doc = user_ref.get()
+        with FIRESTORE_LATENCY.time("users.get"):
+            user_doc = user_ref.get()
 
         if not user_doc.exists:
+            if not create:
+                return None
             default_data = {
                 "requests_this_hour": 0,
                 "last_request_hour": None,
                 "using_dev_account": True,
                 "created_at": datetime.now().isoformat(),
             }
-            user_ref.set(default_data)
+            with FIRESTORE_LATENCY.time("users.set"):
+                user_ref.set(default_data)
             return default_data
 
         return user_doc.to_dict()
 
-    def save_sensor_reading(self, user_id, reading_data):
-        """Save sensor reading to database"""
-        reading_ref = self.db.collection("sensor_readings").document()
-        reading_ref.set(reading_data)
+    def save_sensor_reading(self, user_id, reading_data, document_id=None, timeout=None):
+        """Save sensor reading and its rollups to database.
+
+        With a document_id the reading is created under that ID and the
+        commit fails with AlreadyExists if it was saved before, so a retried
+        write never counts the reading twice in the rollups.
+        """
+        batch = self.db.batch()
+        document, suggestions = self._compact_writes(batch, user_id, [reading_data])
+        if document_id is None:
+            reading_ref = self.db.collection("sensor_readings").document()
+            batch.set(reading_ref, document[0])
+        else:
+            reading_ref = self.db.collection("sensor_readings").document(document_id)
+            batch.create(reading_ref, document[0])
+        for rollup_ref, rollup_data in self._rollup_writes(user_id, [reading_data]):
+            batch.set(rollup_ref, rollup_data, merge=True)
+        with FIRESTORE_LATENCY.time("sensor_readings.batch_commit"):
+            batch.commit(timeout=timeout)
+        self._remember_suggestions(suggestions)
+        return reading_ref.id
+
+    def save_keyed_readings(self, records, timeout=None):
+        """Create (document_id, user_id, reading_data) readings and rollups in one batch.
+
+        The batch is atomic: if any document already exists nothing is
+        written and AlreadyExists is raised.
+        """
+        batch = self.db.batch()
+        by_user = {}
+        for document_id, user_id, reading_data in records:
+            by_user.setdefault(user_id, []).append((document_id, reading_data))
+        stored = {}
+        for user_id, entries in by_user.items():
+            readings = [reading_data for _, reading_data in entries]
+            documents, suggestions = self._compact_writes(
+                batch, user_id, readings, skip=stored
+            )
+            stored.update(suggestions)
+            for (document_id, _), document in zip(entries, documents):
+                batch.create(
+                    self.db.collection("sensor_readings").document(document_id), document
+                )
+            for rollup_ref, rollup_data in self._rollup_writes(user_id, readings):
+                batch.set(rollup_ref, rollup_data, merge=True)
+        with FIRESTORE_LATENCY.time("sensor_readings.batch_commit"):
+            batch.commit(timeout=timeout)
+        self._remember_suggestions(stored)
+
+    async def save_sensor_reading_async(self, user_id, reading_data, document_id=None, timeout=None):
+        """Async save_sensor_reading, same documents in one batch"""
+        batch = self.async_db.batch()
+        document, suggestions = self._compact_writes(
+            batch, user_id, [reading_data], db=self.async_db
+        )
+        if document_id is None:
+            reading_ref = self.async_db.collection("sensor_readings").document()
+            batch.set(reading_ref, document[0])
+        else:
+            reading_ref = self.async_db.collection("sensor_readings").document(document_id)
+            batch.create(reading_ref, document[0])
+        for rollup_ref, rollup_data in self._rollup_writes(
+            user_id, [reading_data], db=self.async_db
+        ):
+            batch.set(rollup_ref, rollup_data, merge=True)
+        with FIRESTORE_LATENCY.time("sensor_readings.batch_commit"):
+            await batch.commit(timeout=timeout)
+        self._remember_suggestions(suggestions)
         return reading_ref.id
 
+    def _compact_writes(self, batch, user_id, readings, db=None, skip=()):
+        """Compact documents of readings; add their new suggestions to the batch.
+
+        Returns (documents, {key: suggestion_data}) for the suggestions written.
+        A suggestion already stored (known from the cache or in skip) is only
+        referenced by its hash, so identical suggestions are stored once.
+        """
+        documents = []
+        written = {}
+        for reading_data in readings:
+            document, suggestion = compact_reading(reading_data, user_id)
+            documents.append(document)
+            if suggestion is None:
+                continue
+            key, stored = suggestion
+            if key in written or key in skip or self.suggestion_docs.get(key) is not None:
+                continue
+            batch.set((db or self.db).collection(SUGGESTIONS_COLLECTION).document(key), stored)
+            written[key] = stored["suggestion"]
+        return documents, written
+
+    def _remember_suggestions(self, suggestions):
+        # Chỉ ghi nhớ sau khi commit thành công, tránh tham chiếu tới document chưa có
+        for key, suggestion_data in suggestions.items():
+            self.suggestion_docs.set(key, suggestion_data)
+
+    def _load_suggestions(self, keys):
+        """Suggestions by content key, from the cache or one batched read"""
+        found = {}
+        missing = []
+        for key in keys:
+            suggestion_data = self.suggestion_docs.get(key)
+            if suggestion_data is None:
+                missing.append(key)
+            else:
+                found[key] = suggestion_data
+        if missing:
+            refs = [
+                self.db.collection(SUGGESTIONS_COLLECTION).document(key) for key in missing
+            ]
+            with FIRESTORE_LATENCY.time("suggestions.get_all"):
+                for doc in self.db.get_all(refs):
+                    if doc.exists:
+                        found[doc.id] = doc.to_dict()["suggestion"]
+                        self.suggestion_docs.set(doc.id, found[doc.id])
+        return found
+
+    def expand_readings(self, documents):
+        """Full-name readings from stored documents of either schema"""
+        suggestions = self._load_suggestions(suggestion_refs(documents))
+        return [expand_reading(document, suggestions) for document in documents]
+
+    def _rollup_writes(self, user_id, readings, db=None):
+        """Hourly and daily rollup updates for readings, using only field transforms"""
+        try:
+            summaries = summarize_for_rollups(readings)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Skipping rollups for invalid reading: {e}")
+            return []
+
+        writes = []
+        for (granularity, bucket_start), summary in summaries.items():
+            rollup_ref = (db or self.db).collection("sensor_rollups").document(
+                f"{user_id}_{granularity}_{bucket_start}"
+            )
+            writes.append(
+                (
+                    rollup_ref,
+                    {
+                        "user_id": user_id,
+                        "granularity": granularity,
+                        "bucket_start": bucket_start,
+                        "count": firestore.Increment(summary["count"]),
+                        "sum": {
+                            m: firestore.Increment(summary["sum"][m]) for m in METRICS
+                        },
+                        "min": {
+                            m: firestore.Minimum(summary["min"][m]) for m in METRICS
+                        },
+                        "max": {
+                            m: firestore.Maximum(summary["max"][m]) for m in METRICS
+                        },
+                        "hist": {
+                            m: {
+                                bin_key: firestore.Increment(count)
+                                for bin_key, count in summary["hist"][m].items()
+                            }
+                            for m in METRICS
+                        },
+                    },
+                )
+            )
+        return writes
+
+    def get_rollups(self, user_id, granularity, start, end):
+        """Rollup documents of one granularity with start <= bucket_start < end"""
+        query = (
+            self.db.collection("sensor_rollups")
+            .where("user_id", "==", user_id)
+            .where("granularity", "==", granularity)
+            .where("bucket_start", ">=", start)
+            .where("bucket_start", "<", end)
+        )
+        with FIRESTORE_LATENCY.time("sensor_rollups.query"):
+            return [doc.to_dict() for doc in query.stream()]
+
+    def get_recent_readings(self, user_id, limit=10):
+        """Latest readings of a user, newest first"""
+        readings = self.db.collection("sensor_readings")
+        query = (
+            readings.where(USER_ID, "==", user_id)
+            .order_by(TIMESTAMP, direction=firestore.Query.DESCENDING)
+            .limit(limit)
+        )
+        with FIRESTORE_LATENCY.time("sensor_readings.query"):
+            docs = list(query.stream())
+        if self.legacy_reads and len(docs) < limit:
+            # Document cũ chưa migrate đều cũ hơn document schema mới
+            legacy_query = (
+                readings.where("userId", "==", user_id)
+                .order_by("timestamp", direction=firestore.Query.DESCENDING)
+                .limit(limit - len(docs))
+            )
+            with FIRESTORE_LATENCY.time("sensor_readings.query"):
+                docs += list(legacy_query.stream())
+
+        expanded = self.expand_readings([doc.to_dict() for doc in docs])
+        for doc, reading in zip(docs, expanded):
+            reading["id"] = doc.id
+        return expanded
+
+    def migrate_legacy_readings(self, batch_size=200):
+        """Rewrite one page of old full-name readings in the compact schema.
+
+        Returns the number of documents migrated, 0 once none are left. Old
+        documents are found by their ISO timestamp field, which compact ones
+        do not have, so the migration can be stopped and resumed at any time.
+        Rollups were counted when the readings were first saved and are not
+        touched.
+        """
+        # Mỗi document tối đa 2 thao tác ghi (reading và khuyến nghị)
+        batch_size = min(batch_size, MAX_BATCH_WRITES // 2)
+        query = (
+            self.db.collection("sensor_readings").order_by("timestamp").limit(batch_size)
+        )
+        with FIRESTORE_LATENCY.time("sensor_readings.query"):
+            docs = list(query.stream())
+        if not docs:
+            return 0
+
+        batch = self.db.batch()
+        documents, suggestions = self._compact_writes(
+            batch, None, [doc.to_dict() for doc in docs]
+        )
+        for doc, document in zip(docs, documents):
+            batch.set(doc.reference, document)
+        with FIRESTORE_LATENCY.time("sensor_readings.batch_commit"):
+            batch.commit()
+        self._remember_suggestions(suggestions)
+        return len(docs)
+
+    def reading_pages(self, after=None, until=None, page_size=500, fields=None):
+        """Pages of (document_id, document) ordered by ts and document ID.
+
+        after is the (ts, document_id) cursor of the last document already
+        handled, until an exclusive upper bound on ts, fields an optional
+        projection. Documents in the old schema have no ts and are not
+        returned; run migrate_readings.py first.
+        """
+        query = self.db.collection("sensor_readings")
+        if until is not None:
+            query = query.where(TIMESTAMP, "<", until)
+        query = query.order_by(TIMESTAMP).order_by("__name__")
+        if fields:
+            query = query.select(list(fields))
+        while True:
+            page = query
+            if after is not None:
+                # Cursor theo giá trị nên vẫn dùng được khi document cuối đã bị xóa
+                page = page.start_after({TIMESTAMP: after[0], "__name__": after[1]})
+            with FIRESTORE_LATENCY.time("sensor_readings.query"):
+                docs = list(page.limit(page_size).stream())
+            if not docs:
+                return
+            yield [(doc.id, doc.to_dict()) for doc in docs]
+            if len(docs) < page_size:
+                return
+            after = (docs[-1].get(TIMESTAMP), docs[-1].id)
+
+    def delete_readings(self, document_ids):
+        """Delete readings in WriteBatches; rollups and suggestions are kept"""
+        readings = self.db.collection("sensor_readings")
+        for start in range(0, len(document_ids), MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for document_id in document_ids[start : start + MAX_BATCH_WRITES]:
+                batch.delete(readings.document(document_id))
+            with FIRESTORE_LATENCY.time("sensor_readings.batch_commit"):
+                batch.commit()
+
+    def watch_readings(self, user_id, since, callback, limit=50):
+        """Listen to the newest limit readings of a user stored from an ISO timestamp on.
+
+        The limit keeps the listener's result set bounded on a dashboard left
+        open for days; readings pushed out of it arrive as REMOVED changes.
+        Uses the u ascending + ts descending index of get_recent_readings.
+        """
+        query = (
+            self.db.collection("sensor_readings")
+            .where(USER_ID, "==", user_id)
+            .where(TIMESTAMP, ">=", to_epoch(since))
+            .order_by(TIMESTAMP, direction=firestore.Query.DESCENDING)
+            .limit(limit)
+        )
+        return query.on_snapshot(callback)
+
+    def watch_user(self, user_id, callback):
+        """Listen to changes of one user document"""
+        return self.db.collection("users").document(user_id).on_snapshot(callback)
+
+    def attach_suggestion(self, document_id, suggestion_data, raw_response):
+        """Add a suggestion generated in the background to a stored reading"""
+        key = suggestion_key(suggestion_data)
+        batch = self.db.batch()
+        if self.suggestion_docs.get(key) is None:
+            batch.set(
+                self.db.collection(SUGGESTIONS_COLLECTION).document(key),
+                {"suggestion": suggestion_data, "raw_response": raw_response},
+            )
+        batch.update(
+            self.db.collection("sensor_readings").document(document_id),
+            {
+                SUGGESTION_REF: key,
+                STATUS: "done",
+                PARTIAL_SUGGESTION: firestore.DELETE_FIELD,
+            },
+        )
+        with FIRESTORE_LATENCY.time("sensor_readings.update"):
+            batch.commit()
+        self.suggestion_docs.set(key, suggestion_data)
+
+    def attach_partial_suggestion(self, document_id, fields):
+        """Store the suggestion fields that have streamed in so far"""
+        reading_ref = self.db.collection("sensor_readings").document(document_id)
+        with FIRESTORE_LATENCY.time("sensor_readings.update"):
+            reading_ref.update({PARTIAL_SUGGESTION: fields, STATUS: "streaming"})
+
+    def mark_suggestion_status(self, document_id, status):
+        """Record why a stored reading has no suggestion"""
+        reading_ref = self.db.collection("sensor_readings").document(document_id)
+        with FIRESTORE_LATENCY.time("sensor_readings.update"):
+            reading_ref.update({STATUS: status})
+
+    @staticmethod
+    def fits_in_one_batch(readings):
+        """True when save_sensor_readings_batch can write readings in one WriteBatch"""
+        # Mỗi reading, mỗi rollup giờ/ngày, document user và tối đa một khuyến nghị
+        writes = len(readings) + len(summarize_for_rollups(readings)) + 2
+        return writes <= MAX_BATCH_WRITES
+
+    def save_sensor_readings_batch(self, user_id, readings, count_request=True):
+        """Save many readings, their rollups and the user's usage in one atomic WriteBatch.
+
+        Raises ValueError when they need more writes than one batch allows;
+        the rollup Increments must not be split across commits, or a retry
+        after a partial failure would count them twice.
+        """
+        writes = []
+        document_ids = []
+        batch = self.db.batch()
+        documents, suggestions = self._compact_writes(batch, user_id, readings)
+        for document in documents:
+            reading_ref = self.db.collection("sensor_readings").document()
+            writes.append((reading_ref, document, False))
+            document_ids.append(reading_ref.id)
+        for rollup_ref, rollup_data in self._rollup_writes(user_id, readings):
+            writes.append((rollup_ref, rollup_data, True))
+
+        # merge=True để không cần đọc document user trước khi ghi
+        user_update = {
+            "last_request_hour": datetime.now()
+            .replace(minute=0, second=0, microsecond=0)
+            .isoformat(),
+            "last_reading": self.compact_last_reading(readings[-1]),
+        }
+        if count_request:
+            user_update["requests_this_hour"] = firestore.Increment(1)
+        user_ref = self.db.collection("users").document(user_id)
+        writes.append((user_ref, user_update, True))
+
+        if len(writes) + len(suggestions) > MAX_BATCH_WRITES:
+            raise ValueError(
+                f"{len(writes) + len(suggestions)} writes do not fit in one batch "
+                f"of {MAX_BATCH_WRITES}"
+            )
+        for ref, data, merge in writes:
+            batch.set(ref, data, merge=merge)
+        with FIRESTORE_LATENCY.time("sensor_readings.batch_commit"):
+            batch.commit()
+        self._remember_suggestions(suggestions)
+        self.user_cache.invalidate(user_id)
+        return document_ids
+
+    @staticmethod
+    def compact_last_reading(reading_data):
+        """users.last_reading in the compact schema, the suggestion only by hash"""
+        return compact_reading(reading_data)[0]
+
     def update_user_usage(self, user_id, reading_data):
         """Update user's usage data"""
         user_ref = self.db.collection("users").document(user_id)
@@ -44,13 +507,41 @@ class FirebaseService:
             datetime.now().replace(minute=0, second=0, microsecond=0).isoformat()
         )
 
-        user_ref.update(
-            {
-                "requests_this_hour": firestore.Increment(1),
-                "last_request_hour": current_hour,
-                "last_reading": reading_data,
-            }
-        )
+        with FIRESTORE_LATENCY.time("users.update"):
+            user_ref.update(
+                {
+                    "requests_this_hour": firestore.Increment(1),
+                    "last_request_hour": current_hour,
+                    "last_reading": self.compact_last_reading(reading_data),
+                }
+            )
+        self.user_cache.invalidate(user_id)
+
+    def apply_usage_updates(self, updates):
+        """Write aggregated usage counters, {user_id: update}, in WriteBatches"""
+        items = list(updates.items())
+        for start in range(0, len(items), MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for user_id, update in items[start : start + MAX_BATCH_WRITES]:
+                user_ref = self.db.collection("users").document(user_id)
+                fields = {}
+                if update["count"]:
+                    fields = {
+                        "requests_this_hour": firestore.Increment(update["count"]),
+                        "last_request_hour": update["last_request_hour"],
+                    }
+                # Lần đọc không gọi Gemini vẫn cập nhật last_reading;
+                # entry chỉ có features thì không có lần đọc nào
+                if update.get("last_reading") is not None:
+                    fields["last_reading"] = self.compact_last_reading(update["last_reading"])
+                # Đặc trưng lịch sử được ghi cùng lần flush
+                if update.get("features") is not None:
+                    fields["features"] = update["features"]
+                batch.set(user_ref, fields, merge=True)
+            with FIRESTORE_LATENCY.time("users.batch_commit"):
+                batch.commit()
+            for user_id, _ in items[start : start + MAX_BATCH_WRITES]:
+                self.user_cache.invalidate(user_id)
 
     def update_gemini_key(self, user_id, api_key):
         """Update user's Gemini API key using transaction"""
@@ -80,7 +571,9 @@ class FirebaseService:
                 )
 
         transaction = self.db.transaction()
-        update_key_transaction(transaction, user_ref)
+        with FIRESTORE_LATENCY.time("users.transaction"):
+            update_key_transaction(transaction, user_ref)
+        self.user_cache.invalidate(user_id)
 
     def remove_gemini_key(self, user_id):
         """Remove user's Gemini API key using transaction"""
@@ -100,4 +593,6 @@ class FirebaseService:
                 )
 
         transaction = self.db.transaction()
-        remove_key_transaction(transaction, user_ref)
+        with FIRESTORE_LATENCY.time("users.transaction"):
+            remove_key_transaction(transaction, user_ref)
+        self.user_cache.invalidate(user_id)
@@ -0,0 +1,76 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+
+class GeminiClientPool:
+    """Thread-safe LRU pool of Gemini models, one per API key"""
+
+    def __init__(self, model_name="gemini-2.0-flash", max_clients=None, idle_ttl=None):
+        self.model_name = model_name
+        self.max_clients = max_clients or int(os.getenv("GEMINI_MAX_CLIENTS", "32"))
+        self.idle_ttl = idle_ttl or float(os.getenv("GEMINI_CLIENT_IDLE_TTL", "900"))
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _build_model(self, api_key):
+        model = genai.GenerativeModel(self.model_name)
+        # GenerativeModel dùng client toàn cục (genai.configure) nếu _client là None,
+        # gán client riêng để mỗi key độc lập giữa các thread
+        model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+        return model
+
+    def _expire_idle(self, now):
+        while self._models:
+            key, (last_used, _) = next(iter(self._models.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            del self._models[key]
+
+    def get(self, api_key):
+        """Return the model bound to api_key, creating it on first use"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire_idle(now)
+            entry = self._models.get(api_key)
+            if entry is not None:
+                self._models[api_key] = (now, entry[1])
+                self._models.move_to_end(api_key)
+                return entry[1]
+
+        # Tạo client ngoài lock để không chặn các thread khác
+        model = self._build_model(api_key)
+        with self._lock:
+            entry = self._models.get(api_key)
+            if entry is not None:
+                model = entry[1]
+            self._models[api_key] = (now, model)
+            self._models.move_to_end(api_key)
+            while len(self._models) > self.max_clients:
+                self._models.popitem(last=False)
+        return model
+
+    def get_async(self, api_key):
+        """Like get, with an async client bound to the same key.
+
+        Must be called from the event loop that will use the client.
+        """
+        model = self.get(api_key)
+        if model._async_client is None:
+            model._async_client = glm.GenerativeServiceAsyncClient(
+                client_options={"api_key": api_key}
+            )
+        return model
+
+    def discard(self, api_key):
+        """Drop the model of a key that turned out to be invalid"""
+        with self._lock:
+            self._models.pop(api_key, None)
+
+    def size(self):
+        with self._lock:
+            return len(self._models)
@@ -1,27 +1,66 @@
 import os
 import json
-import google.generativeai as genai
+import time
+import asyncio
+import hashlib
+import functools
+import threading
+
+from google.api_core.exceptions import InvalidArgument, PermissionDenied, Unauthenticated
+
+from services.gemini_client_pool import GeminiClientPool
+from services.metrics import ERRORS, GEMINI_LATENCY, JSON_PARSE_LATENCY
+from services.quota import QuotaExceeded
+from services.suggestion_batcher import SuggestionBatcher
+from services.suggestion_cache import SuggestionCache
+from services.suggestion_parser import IncrementalJSONParser
+from services.suggestion_rules import SuggestionRules
+
+SUGGESTION_FIELDS = ("immediate_actions", "health_impacts", "optimal_ranges", "summary")
 
 
 class GeminiService:
     def __init__(self):
         self.default_api_key = os.getenv("GEMINI_API_KEY")
-        genai.configure(api_key=self.default_api_key)
-        self.model = genai.GenerativeModel("gemini-2.0-flash")
+        self.client_pool = GeminiClientPool("gemini-2.0-flash")
+        self.suggestion_cache = SuggestionCache()
+        # Gom các yêu cầu cùng API key trong một cửa sổ ngắn thành một prompt
+        self.batcher = SuggestionBatcher(self._generate_batch)
+        # Chỉ gọi Gemini khi có chỉ số vượt ngưỡng hoặc thay đổi nhiều
+        self.rules = SuggestionRules()
+        self.validation_ttl = float(os.getenv("GEMINI_KEY_VALIDATION_TTL", "300"))
+        self._validation_results = {}
+        self._validation_lock = threading.Lock()
+
+    def get_model(self, api_key=None):
+        """Get the model for either user API key or default key"""
+        return self.client_pool.get(api_key if api_key else self.default_api_key)
 
-    def configure_with_key(self, api_key=None):
-        """Configure Gemini with either user API key or default key"""
-        key = api_key if api_key else self.default_api_key
-        genai.configure(api_key=key)
-        self.model = genai.GenerativeModel("gemini-2.0-flash")
+    def get_async_model(self, api_key=None):
+        """Same as get_model, for generate_content_async"""
+        return self.client_pool.get_async(api_key if api_key else self.default_api_key)
 
-    def get_health_suggestion(self, temperature, humidity, noise):
-        prompt = f"""
+    @staticmethod
+    def _context_key(context):
+        return context.key if context is not None else None
+
+    @staticmethod
+    def _history(context, indent="        "):
+        """Prompt lines of a FeatureContext, empty without history"""
+        if context is None:
+            return ""
+        return "".join(f"{indent}{line}\n" for line in context.text.splitlines())
+
+    def _build_prompt(self, temperature, humidity, noise, context=None):
+        history = self._history(context)
+        if history:
+            history = "\n" + history + "        Take the trends and time outside comfort ranges into account.\n"
+        return f"""
         Analyze these room conditions and provide health suggestions:
         Temperature: {temperature}°C
         Humidity: {humidity}%
         Noise Level: {noise}dB
-
+{history}
         Respond ONLY with a JSON object in this exact format, with NO additional text, quotes, or markdown:
         {{
             "immediate_actions": ["action1", "action2"],
@@ -37,37 +76,351 @@ class GeminiService:
         Keep each list to 2-3 items and the summary under 100 words. Do not include any markdown formatting, backticks, or the word 'json'.
         """
 
+    def _build_batch_prompt(self, rooms):
+        conditions = "\n".join(
+            f"        Room {index}: Temperature {temperature}°C, Humidity {humidity}%, Noise Level {noise}dB"
+            + ("\n" + self._history(context, indent="            ")).rstrip("\n")
+            for index, (temperature, humidity, noise, context, _) in enumerate(rooms, 1)
+        )
+        return f"""
+        Analyze the conditions of each of these rooms and provide health suggestions:
+{conditions}
+
+        Respond ONLY with a JSON object in this exact format, with NO additional text, quotes, or markdown:
+        {{
+            "rooms": [
+                {{
+                    "room": 1,
+                    "immediate_actions": ["action1", "action2"],
+                    "health_impacts": ["impact1", "impact2"],
+                    "optimal_ranges": {{
+                        "temperature": "range in celsius",
+                        "humidity": "range in percentage",
+                        "noise": "range in dB"
+                    }},
+                    "summary": "brief summary"
+                }}
+            ]
+        }}
+
+        Include exactly one entry per room, numbered as above. Keep each list to 2-3 items and each summary under 100 words. Do not include any markdown formatting, backticks, or the word 'json'.
+        """
+
+    def get_health_suggestion(
+        self, temperature, humidity, noise, api_key=None, user_id=None, context=None,
+        quota_check=None,
+    ):
+        """Suggestion for one reading; context is the user's FeatureContext, if any.
+
+        quota_check is called only when the model has to be asked, after the
+        local rules and the cache; it raises to refuse the model call.
+        """
+        local = self.rules.evaluate(user_id, temperature, humidity, noise)
+        if local is not None:
+            return local
+
+        suggestion_data, raw_response = self._model_suggestion(
+            temperature, humidity, noise, api_key, context, quota_check
+        )
+        if self._is_model_answer(suggestion_data):
+            self.rules.remember(
+                user_id, temperature, humidity, noise, suggestion_data, raw_response
+            )
+        return suggestion_data, raw_response
+
+    def _model_suggestion(
+        self, temperature, humidity, noise, api_key=None, context=None, quota_check=None
+    ):
+        context_key = self._context_key(context)
+        cached = self.suggestion_cache.get(temperature, humidity, noise, context_key)
+        if cached is not None:
+            return cached
+
+        if self.batcher.enabled:
+            # Batcher chỉ tính quota khi request mở một slot mới
+            future = self.batcher.submit(
+                api_key or self.default_api_key,
+                self.suggestion_cache.make_key(temperature, humidity, noise, context_key),
+                (temperature, humidity, noise, context, quota_check),
+                charge=quota_check,
+            )
+            try:
+                return future.result()
+            except Exception as e:
+                return self._get_error_response(), str(e)
+        if quota_check is not None:
+            quota_check()
+        return self._generate_suggestion(temperature, humidity, noise, api_key, context)
+
+    def _generate_suggestion(self, temperature, humidity, noise, api_key=None, context=None):
+        parser = IncrementalJSONParser()
         try:
-            response = self.model.generate_content(prompt)
-
-            # Clean the response text
-            clean_response = response.text.strip()
-            if clean_response.startswith("```"):
-                clean_response = clean_response.split("```")[1]
-            if clean_response.startswith("json"):
-                clean_response = clean_response[4:]
-            clean_response = clean_response.strip()
-
-            # Parse the JSON response
-            suggestion_data = json.loads(clean_response)
-            return suggestion_data, response.text
+            started = time.perf_counter()
+            response = self.get_model(api_key).generate_content(
+                self._build_prompt(temperature, humidity, noise, context)
+            )
+            elapsed = time.perf_counter() - started
+            GEMINI_LATENCY.observe(elapsed, "suggestion")
+            self.suggestion_cache.record_model_call(elapsed)
+            return self._parse_suggestion(
+                parser, response.text, temperature, humidity, noise, context
+            )
         except Exception as e:
+            ERRORS.inc("gemini.get_health_suggestion")
             print(f"Error generating suggestion: {e}")
-            return self._get_error_response(), str(e)
+            return self._recover(parser), str(e)
+
+    def _parse_suggestion(self, parser, text, temperature, humidity, noise, context=None):
+        with JSON_PARSE_LATENCY.time():
+            parser.feed(text)
+        if not parser.complete:
+            raise ValueError("No complete JSON object in response")
+        # Chỉ cache các phản hồi hợp lệ, không cache phản hồi lỗi
+        self.suggestion_cache.set(
+            temperature, humidity, noise, parser.fields, text, self._context_key(context)
+        )
+        return parser.fields, text
+
+    async def get_health_suggestion_async(
+        self, temperature, humidity, noise, api_key=None, user_id=None, context=None,
+        quota_check=None,
+    ):
+        """get_health_suggestion for the ASGI entry point, without blocking the loop"""
+        local = self.rules.evaluate(user_id, temperature, humidity, noise)
+        if local is not None:
+            return local
+
+        context_key = self._context_key(context)
+        cached = await self._off_loop(
+            self.suggestion_cache.get, temperature, humidity, noise, context_key
+        )
+        loop = asyncio.get_running_loop()
+        if cached is not None:
+            suggestion_data, raw_response = cached
+        elif self.batcher.enabled:
+            # Bộ đếm quota có thể nằm trên SQLite/Redis, submit tính quota nên
+            # không chạy trên event loop
+            future = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self.batcher.submit,
+                    api_key or self.default_api_key,
+                    self.suggestion_cache.make_key(temperature, humidity, noise, context_key),
+                    (temperature, humidity, noise, context, quota_check),
+                    charge=quota_check,
+                ),
+            )
+            try:
+                suggestion_data, raw_response = await asyncio.wrap_future(future)
+            except Exception as e:
+                return self._get_error_response(), str(e)
+        else:
+            if quota_check is not None:
+                await loop.run_in_executor(None, quota_check)
+            suggestion_data, raw_response = await self._generate_suggestion_async(
+                temperature, humidity, noise, api_key, context
+            )
+
+        if self._is_model_answer(suggestion_data):
+            self.rules.remember(
+                user_id, temperature, humidity, noise, suggestion_data, raw_response
+            )
+        return suggestion_data, raw_response
+
+    async def _generate_suggestion_async(
+        self, temperature, humidity, noise, api_key=None, context=None
+    ):
+        parser = IncrementalJSONParser()
+        try:
+            started = time.perf_counter()
+            response = await self.get_async_model(api_key).generate_content_async(
+                self._build_prompt(temperature, humidity, noise, context)
+            )
+            elapsed = time.perf_counter() - started
+            GEMINI_LATENCY.observe(elapsed, "suggestion")
+            self.suggestion_cache.record_model_call(elapsed)
+            # _parse_suggestion ghi vào cache
+            return await self._off_loop(
+                self._parse_suggestion, parser, response.text, temperature, humidity, noise,
+                context,
+            )
+        except Exception as e:
+            ERRORS.inc("gemini.get_health_suggestion")
+            print(f"Error generating suggestion: {e}")
+            return self._recover(parser), str(e)
+
+    async def _off_loop(self, function, *args):
+        """Run a call that touches the suggestion cache, in the executor if its backend blocks"""
+        if not self.suggestion_cache.blocking:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def _generate_batch(self, api_key, rooms):
+        """One model call for several rooms, split back into per-room results.
+
+        Each room carries the quota_check of the request that opened its slot,
+        charged again only if the room has to be asked on its own.
+        """
+        if len(rooms) == 1:
+            temperature, humidity, noise, context, _ = rooms[0]
+            return [self._generate_suggestion(temperature, humidity, noise, api_key, context)]
+
+        parser = IncrementalJSONParser()
+        try:
+            started = time.perf_counter()
+            response = self.get_model(api_key).generate_content(
+                self._build_batch_prompt(rooms)
+            )
+            elapsed = time.perf_counter() - started
+            GEMINI_LATENCY.observe(elapsed, "suggestion_batch")
+            self.suggestion_cache.record_model_call(elapsed)
+
+            with JSON_PARSE_LATENCY.time():
+                parser.feed(response.text)
+            if not parser.complete:
+                raise ValueError("No complete JSON object in response")
+            by_room = {
+                entry.get("room"): entry
+                for entry in parser.fields.get("rooms", [])
+                if isinstance(entry, dict)
+            }
+        except Exception as e:
+            ERRORS.inc("gemini.generate_batch")
+            print(f"Error generating batched suggestions: {e}")
+            # Mỗi phòng một dict lỗi riêng, caller có thể sửa kết quả của mình
+            return [(self._get_error_response(), str(e)) for _ in rooms]
+
+        results = []
+        for index, (temperature, humidity, noise, context, quota_check) in enumerate(rooms, 1):
+            entry = by_room.get(index)
+            if entry is None or not all(field in entry for field in SUGGESTION_FIELDS):
+                # Model bỏ sót phòng này: hỏi riêng thay vì trả lỗi, đây là
+                # một lời gọi model nữa nên tính thêm một lượt quota
+                if quota_check is not None:
+                    try:
+                        quota_check()
+                    except QuotaExceeded as e:
+                        results.append((self._get_error_response(), str(e)))
+                        continue
+                results.append(
+                    self._generate_suggestion(temperature, humidity, noise, api_key, context)
+                )
+                continue
+            suggestion_data = {field: entry[field] for field in SUGGESTION_FIELDS}
+            raw_response = json.dumps(entry)
+            self.suggestion_cache.set(
+                temperature, humidity, noise, suggestion_data, raw_response,
+                self._context_key(context),
+            )
+            results.append((suggestion_data, raw_response))
+        return results
+
+    def stream_health_suggestion(
+        self, temperature, humidity, noise, api_key=None, user_id=None, context=None,
+        quota_check=None,
+    ):
+        """Stream a suggestion from the model.
+
+        Yields ("field", name, value) as each top-level field of the JSON
+        object is complete, then ("done", suggestion_data, raw_response).
+        Local, cached and recovered suggestions only come with the final event.
+        quota_check works as in get_health_suggestion.
+        """
+        local = self.rules.evaluate(user_id, temperature, humidity, noise)
+        if local is not None:
+            yield "done", local[0], local[1]
+            return
+
+        context_key = self._context_key(context)
+        cached = self.suggestion_cache.get(temperature, humidity, noise, context_key)
+        if cached is not None:
+            self.rules.remember(user_id, temperature, humidity, noise, *cached)
+            yield "done", cached[0], cached[1]
+            return
+        if quota_check is not None:
+            quota_check()
+
+        parser = IncrementalJSONParser()
+        first_field = True
+        try:
+            started = time.perf_counter()
+            response = self.get_model(api_key).generate_content(
+                self._build_prompt(temperature, humidity, noise, context), stream=True
+            )
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunk cuối có thể chỉ chứa finish_reason, không có text
+                    continue
+                for name, value in parser.feed(text).items():
+                    if first_field:
+                        first_field = False
+                        GEMINI_LATENCY.observe(
+                            time.perf_counter() - started, "suggestion_first_field"
+                        )
+                    yield "field", name, value
+            elapsed = time.perf_counter() - started
+            GEMINI_LATENCY.observe(elapsed, "suggestion_stream")
+            self.suggestion_cache.record_model_call(elapsed)
+
+            if not parser.complete:
+                raise ValueError("Response ended before the JSON object was complete")
+            self.suggestion_cache.set(
+                temperature, humidity, noise, parser.fields, parser.text, context_key
+            )
+            self.rules.remember(
+                user_id, temperature, humidity, noise, parser.fields, parser.text
+            )
+            yield "done", parser.fields, parser.text
+        except Exception as e:
+            ERRORS.inc("gemini.stream_health_suggestion")
+            print(f"Error streaming suggestion: {e}")
+            yield "done", self._recover(parser), parser.text or str(e)
+
+    def _is_model_answer(self, suggestion_data):
+        """False for the error response and for partially recovered ones"""
+        return not suggestion_data.get("partial") and (
+            suggestion_data != self._get_error_response()
+        )
+
+    def _recover(self, parser):
+        """Keep what the model got right, fill the rest from the error response"""
+        recovered = parser.partial()
+        if not recovered:
+            return self._get_error_response()
+        # Đánh dấu để client biết phần còn thiếu là mặc định
+        return {**self._get_error_response(), **recovered, "partial": True}
 
     def validate_api_key(self, api_key):
-        """Test if an API key is valid"""
+        """Test if an API key is valid, reusing recent results.
+
+        Only a rejected key is remembered as invalid; network errors,
+        timeouts and server errors are raised and not cached.
+        """
+        # Chỉ lưu hash của key trong cache kết quả
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        now = time.monotonic()
+        with self._validation_lock:
+            cached = self._validation_results.get(key_hash)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+
         try:
-            genai.configure(api_key=api_key)
-            test_model = genai.GenerativeModel("gemini-2.0-flash")
-            test_model.generate_content("Test")
-            # Restore original configuration
-            self.configure_with_key()
-            return True
-        except:
-            # Restore original configuration
-            self.configure_with_key()
-            return False
+            with GEMINI_LATENCY.time("validate"):
+                self.client_pool.get(api_key).generate_content("Test")
+            is_valid = True
+        except (InvalidArgument, PermissionDenied, Unauthenticated):
+            # API trả về API_KEY_INVALID / permission denied: key chắc chắn sai
+            self.client_pool.discard(api_key)
+            is_valid = False
+
+        with self._validation_lock:
+            # Dọn các kết quả đã hết hạn
+            for expired in [k for k, v in self._validation_results.items() if v[1] <= now]:
+                del self._validation_results[expired]
+            self._validation_results[key_hash] = (is_valid, now + self.validation_ttl)
+        return is_valid
 
     def _get_error_response(self):
         """Return a default error response"""
@@ -0,0 +1,495 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+
+import requests
+from google.api_core import exceptions as api_exceptions
+
+try:
+    import fcntl
+except ImportError:
+    # Không có flock (Windows): coi như chỉ có một process dùng outbox
+    fcntl = None
+
+from services.metrics import ERRORS
+
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor.json"
+OWNER_LOCK = "owner.lock"
+ADOPT_LOCK = "adopt.lock"
+
+# Mỗi bản ghi tối đa 3 thao tác ghi (reading, rollup giờ, rollup ngày),
+# một WriteBatch Firestore tối đa 500 thao tác
+MAX_UPLOAD_BATCH = 160
+
+# Lỗi do mạng/Firestore tạm thời, thử lại sau; lỗi khác là bản ghi hỏng.
+# Không bắt OSError chung: lỗi đĩa của chính outbox không được coi là mất mạng
+TRANSIENT_ERRORS = (
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+    api_exceptions.TooManyRequests,
+    api_exceptions.Aborted,
+    api_exceptions.Unknown,
+    api_exceptions.RetryError,
+    # Lấy token OAuth qua google-auth dùng requests
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+class Outbox:
+    """Durable store-and-forward queue for readings Firestore could not take.
+
+    Readings are appended as JSON lines to rotated segment files; a cursor
+    file records how far the uploader has got, so queued readings survive a
+    restart. Every reading carries an idempotency key that becomes its
+    Firestore document ID, which makes re-sending after an ambiguous failure
+    harmless. The total size on disk is bounded: when it is exceeded the
+    oldest segment is dropped and counted.
+
+    Each process queues in its own subdirectory, directory/<pid>, held with
+    a flock for as long as the process runs. adopt_orphans, called at worker
+    startup, appends the unsent readings of processes that have exited
+    (gunicorn workers that were restarted) to this process's queue.
+    """
+
+    def __init__(
+        self,
+        directory,
+        firebase_service,
+        segment_bytes=None,
+        max_bytes=None,
+        batch_size=None,
+        write_timeout=None,
+        backoff_base=None,
+        backoff_max=None,
+    ):
+        self.root = directory
+        self.directory = os.path.join(directory, str(os.getpid()))
+        self.firebase_service = firebase_service
+        self.segment_bytes = segment_bytes or int(os.getenv("OUTBOX_SEGMENT_BYTES", "1048576"))
+        self.max_bytes = max_bytes or int(os.getenv("OUTBOX_MAX_BYTES", "67108864"))
+        self.batch_size = min(
+            batch_size or int(os.getenv("OUTBOX_BATCH_SIZE", "100")), MAX_UPLOAD_BATCH
+        )
+        self.write_timeout = write_timeout or float(os.getenv("OUTBOX_WRITE_TIMEOUT", "5"))
+        self.backoff_base = backoff_base or float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+        self.backoff_max = backoff_max or float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+        self.fsync = os.getenv("OUTBOX_FSYNC", "true").lower() == "true"
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._active = None
+        self._active_path = None
+        # Vị trí đã tải lên xong: (tên segment, offset byte)
+        self._cursor = (None, 0)
+        self._depth = 0
+        self._failures = 0
+        self._retry_at = 0.0
+        self.queued = 0
+        self.uploaded = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.last_error = None
+        self.last_upload = None
+        self.adopted = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._owner_lock = self._try_lock(self.directory)
+        if self._owner_lock is None:
+            raise RuntimeError(f"Outbox directory {self.directory} is in use")
+        self._recover()
+
+    # --- Segment log ---
+
+    def _segments(self):
+        """Segment names, oldest first"""
+        return sorted(
+            name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _try_lock(directory):
+        """Lock a queue directory without blocking; the open lock file, or None if held"""
+        lock_file = open(os.path.join(directory, OWNER_LOCK), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def adopt_orphans(self):
+        """Move the queues of exited processes into this process's queue.
+
+        Reads every orphaned segment, so it belongs in startup rather than
+        in the request that first touches the outbox.
+        """
+        with open(os.path.join(self.root, ADOPT_LOCK), "a") as guard:
+            # Hai worker khởi động cùng lúc không nhận cùng một hàng đợi
+            if fcntl is not None:
+                fcntl.flock(guard, fcntl.LOCK_EX)
+            orphans = [
+                os.path.join(self.root, name)
+                for name in sorted(os.listdir(self.root))
+                if os.path.isdir(os.path.join(self.root, name))
+                and os.path.join(self.root, name) != self.directory
+            ]
+            for directory in orphans:
+                lock_file = self._try_lock(directory)
+                if lock_file is None:
+                    # Process sở hữu vẫn đang chạy
+                    continue
+                try:
+                    adopted = self._adopt(directory)
+                finally:
+                    lock_file.close()
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                os.rmdir(directory)
+                if adopted:
+                    print(f"Outbox adopted {adopted} queued readings from {directory}")
+            # Bố cục cũ: segment nằm thẳng trong thư mục gốc
+            if any(name.endswith(SEGMENT_SUFFIX) for name in os.listdir(self.root)):
+                self._adopt(self.root)
+                for name in os.listdir(self.root):
+                    if name.endswith(SEGMENT_SUFFIX) or name == CURSOR_FILE:
+                        os.remove(os.path.join(self.root, name))
+
+    def _adopt(self, directory):
+        """Append the records of another queue directory after its cursor to this queue"""
+        try:
+            with open(os.path.join(directory, CURSOR_FILE)) as f:
+                cursor = json.load(f)
+            cursor = (cursor["segment"], cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            cursor = (None, 0)
+        segments = sorted(
+            name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        if cursor[0] not in segments:
+            cursor = (None, 0)
+
+        adopted = 0
+        for name in segments:
+            # Segment cũ hơn cursor đã tải lên hết
+            if cursor[0] is not None and name < cursor[0]:
+                continue
+            records = []
+            with open(os.path.join(directory, name), "rb") as f:
+                f.seek(cursor[1] if name == cursor[0] else 0)
+                for line in f:
+                    if not line.endswith(b"\n") or not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        ERRORS.inc("outbox.corrupt")
+            self._append(*records)
+            adopted += len(records)
+        self.adopted += adopted
+        return adopted
+
+    def _recover(self):
+        segments = self._segments()
+        try:
+            with open(self._path(CURSOR_FILE)) as f:
+                cursor = json.load(f)
+            self._cursor = (cursor["segment"], cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            self._cursor = (None, 0)
+        # Segment của cursor đã bị xóa: bắt đầu lại từ segment cũ nhất
+        if self._cursor[0] not in segments:
+            self._cursor = (None, 0)
+
+        if segments:
+            path = self._path(segments[-1])
+            with open(path, "rb") as f:
+                data = f.read()
+            # Bỏ dòng ghi dở nếu thiết bị mất điện giữa chừng
+            if data and not data.endswith(b"\n"):
+                with open(path, "r+b") as f:
+                    f.truncate(data.rfind(b"\n") + 1)
+            self._active_path = path
+            self._active = open(path, "ab")
+
+        for name in segments:
+            offset = self._cursor[1] if name == self._cursor[0] else 0
+            with open(self._path(name), "rb") as f:
+                f.seek(offset)
+                self._depth += sum(1 for line in f if line.strip())
+
+    def _rotate(self):
+        # Gọi khi đang giữ self._lock
+        if self._active is not None:
+            self._active.close()
+        name = "{:020d}{}".format(time.time_ns(), SEGMENT_SUFFIX)
+        self._active_path = self._path(name)
+        self._active = open(self._active_path, "ab")
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        """Drop the oldest segments until a full new segment fits in max_bytes"""
+        segments = self._segments()
+        total = sum(os.path.getsize(self._path(name)) for name in segments)
+        for name in segments[:-1]:
+            if total + self.segment_bytes <= self.max_bytes:
+                return
+            path = self._path(name)
+            offset = self._cursor[1] if name == self._cursor[0] else 0
+            with open(path, "rb") as f:
+                f.seek(offset)
+                lost = sum(1 for line in f if line.strip())
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self._depth -= lost
+            self.dropped += lost
+            if name == self._cursor[0]:
+                self._cursor = (None, 0)
+            ERRORS.inc("outbox.dropped")
+            print(f"Outbox over {self.max_bytes} bytes, dropped {lost} queued readings")
+
+    def _append(self, *records):
+        if not records:
+            return
+        lines = [(json.dumps(record, separators=(",", ":")) + "\n").encode() for record in records]
+        with self._lock:
+            for line in lines:
+                if self._active is None or self._active.tell() + len(line) > self.segment_bytes:
+                    self._rotate()
+                self._active.write(line)
+            # Một lần fsync cho cả nhóm bản ghi
+            self._active.flush()
+            if self.fsync:
+                os.fsync(self._active.fileno())
+            self._depth += len(lines)
+            self.queued += len(lines)
+        self._wake.set()
+
+    def _read_batch(self):
+        """Up to batch_size records after the cursor, the cursor after them and
+        the number of lines consumed (corrupt lines are skipped but counted)"""
+        with self._lock:
+            while True:
+                segments = self._segments()
+                name, offset = self._cursor
+                if name is None:
+                    if not segments:
+                        return [], self._cursor, 0
+                    name, offset = segments[0], 0
+                records = []
+                consumed = 0
+                with open(self._path(name), "rb") as f:
+                    f.seek(offset)
+                    while consumed < self.batch_size:
+                        line = f.readline()
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        if not line.strip():
+                            continue
+                        consumed += 1
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            ERRORS.inc("outbox.corrupt")
+                if consumed or self._path(name) == self._active_path:
+                    return records, (name, offset), consumed
+                # Segment cũ đã tải hết: xóa rồi đọc segment tiếp theo
+                os.remove(self._path(name))
+                self._cursor = (None, 0)
+
+    def _commit(self, cursor, count):
+        """Advance the cursor past count uploaded (or rejected) records"""
+        with self._lock:
+            name, offset = cursor
+            if not os.path.exists(self._path(name)):
+                # Segment bị _enforce_limit xóa khi đang tải lên, đã trừ vào depth
+                cursor = (None, 0)
+            else:
+                self._depth -= count
+                # Đã tải hết segment đang ghi: bỏ file, lần ghi sau mở segment mới
+                if (
+                    self._depth == 0
+                    and self._path(name) == self._active_path
+                    and self._active.tell() == offset
+                ):
+                    self._active.close()
+                    os.remove(self._active_path)
+                    self._active = self._active_path = None
+                    cursor = (None, 0)
+            self._cursor = cursor
+            tmp = self._path(CURSOR_FILE + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump({"segment": cursor[0], "offset": cursor[1]}, f)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp, self._path(CURSOR_FILE))
+
+    # --- Ghi từ request ---
+
+    def save(self, user_id, reading_data, queued_fields=None):
+        """Save a reading to Firestore, or queue it when Firestore is unreachable.
+
+        Returns (document_id, queued). While the uploader is backing off or
+        still has a backlog the reading is queued straight away instead of
+        waiting on a dead link. queued_fields are merged into a queued reading.
+        """
+        document_id = uuid.uuid4().hex
+        if self.accepting_direct_writes:
+            try:
+                self.firebase_service.save_sensor_reading(
+                    user_id, reading_data, document_id=document_id, timeout=self.write_timeout
+                )
+                return document_id, False
+            except api_exceptions.AlreadyExists:
+                # Lần thử trước đã ghi thành công dù báo lỗi
+                return document_id, False
+            except TRANSIENT_ERRORS as e:
+                self.direct_write_failed(e)
+
+        self.enqueue(user_id, {**reading_data, **(queued_fields or {})}, document_id)
+        return document_id, True
+
+    @property
+    def accepting_direct_writes(self):
+        return self._failures == 0 and self._depth == 0
+
+    def direct_write_failed(self, error):
+        """Record a failed request-path write so later requests queue directly"""
+        ERRORS.inc("outbox.direct_write")
+        print(f"Firestore unreachable, queueing reading: {error}")
+        self._record_failure(error)
+
+    def enqueue(self, user_id, reading_data, document_id=None):
+        """Append a reading to the on-disk queue, return its document ID"""
+        document_id = document_id or uuid.uuid4().hex
+        self._append(
+            {
+                "key": document_id,
+                "user_id": user_id,
+                "reading": reading_data,
+                "queued_at": time.time(),
+            }
+        )
+        return document_id
+
+    # --- Luồng tải lên ---
+
+    def start(self):
+        """Start the background uploader"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="outbox-uploader", daemon=True)
+        self._thread.start()
+
+    def _record_failure(self, error):
+        with self._lock:
+            self._failures += 1
+            # Backoff lũy thừa có jitter để nhiều thiết bị không thử lại cùng lúc
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (self._failures - 1))
+            self._retry_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            self.last_error = str(error)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._depth == 0:
+                self._wake.wait()
+            else:
+                delay = self._retry_at - time.monotonic()
+                if delay > 0:
+                    self._wake.wait(delay)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            if self._depth and time.monotonic() >= self._retry_at:
+                self.drain_once()
+
+    def drain_once(self):
+        """Upload one batch; return the number of records taken off the queue"""
+        records, cursor, consumed = self._read_batch()
+        if not consumed:
+            return 0
+        try:
+            if records:
+                self._upload(records)
+        except TRANSIENT_ERRORS as e:
+            ERRORS.inc("outbox.upload")
+            print(f"Outbox upload failed, retrying later: {e}")
+            self._record_failure(e)
+            return 0
+        self._commit(cursor, consumed)
+        with self._lock:
+            self._failures = 0
+            self._retry_at = 0.0
+            self.last_upload = time.time()
+        return len(records)
+
+    def _upload(self, records):
+        entries = [(r["key"], r["user_id"], r["reading"]) for r in records]
+        try:
+            self.firebase_service.save_keyed_readings(entries, timeout=self.write_timeout)
+            self.uploaded += len(entries)
+            return
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            # Một bản ghi đã có sẵn hoặc bị từ chối làm hỏng cả batch: gửi lại từng bản ghi
+            print(f"Outbox batch rejected, uploading one by one: {e}")
+
+        for key, user_id, reading_data in entries:
+            try:
+                self.firebase_service.save_sensor_reading(
+                    user_id, reading_data, document_id=key, timeout=self.write_timeout
+                )
+                self.uploaded += 1
+            except api_exceptions.AlreadyExists:
+                self.uploaded += 1
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                ERRORS.inc("outbox.rejected")
+                print(f"Dropping queued reading {key}: {e}")
+                self.rejected += 1
+
+    def shutdown(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+            if self._owner_lock is not None:
+                self._owner_lock.close()
+                self._owner_lock = None
+
+    def stats(self):
+        with self._lock:
+            segments = self._segments()
+            return {
+                "depth": self._depth,
+                "segments": len(segments),
+                "bytes": sum(os.path.getsize(self._path(name)) for name in segments),
+                "max_bytes": self.max_bytes,
+                "queued": self.queued,
+                "uploaded": self.uploaded,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "adopted": self.adopted,
+                "backing_off": self._failures > 0,
+                "consecutive_failures": self._failures,
+                "retry_in": round(max(0.0, self._retry_at - time.monotonic()), 3),
+                "last_error": self.last_error,
+                "last_upload": self.last_upload,
+            }
@@ -0,0 +1,327 @@
+import os
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from limits import parse
+
+from services.metrics import QUOTA_DECISIONS
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def sliding_count(previous, current, window, now):
+    """Requests in the last window, weighting the previous fixed window by overlap"""
+    elapsed = now % window
+    return previous * (1 - elapsed / window) + current
+
+
+def sliding_retry_after(previous, current, limit, window, now, cost=1):
+    """Seconds until sliding_count leaves room for cost more requests"""
+    elapsed = now % window
+    room = max(limit - cost, 0)
+    if current <= room:
+        # Trong cửa sổ hiện tại: chờ phần của cửa sổ trước giảm đủ
+        return max(window * (1 - (room - current) / previous) - elapsed, 0)
+    # Sang cửa sổ sau, khi các lượt hiện tại trở thành cửa sổ trước và giảm dần
+    return window - elapsed + window * (1 - room / current)
+
+
+class QuotaExceeded(Exception):
+    """Raised by QuotaManager.require when a request is over quota"""
+
+    def __init__(self, scope, limit, retry_after):
+        super().__init__(f"Quota exceeded: {scope} {limit}")
+        self.scope = scope
+        self.limit = limit
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {
+            "error": "Quota exceeded",
+            "scope": self.scope,
+            "limit": self.limit,
+            "retry_after": self.retry_after,
+        }
+
+
+class QuotaCheck:
+    """quota_check callable for GeminiService that remembers whether it ran.
+
+    GeminiService calls it right before asking the model, so called ends
+    up True exactly when the request cost a model call.
+    """
+
+    def __init__(self, manager, user_id, api_key=None, using_custom_key=False):
+        self.manager = manager
+        self.user_id = user_id
+        self.api_key = api_key
+        self.using_custom_key = using_custom_key
+        self.called = False
+
+    def __call__(self):
+        self.manager.require(self.user_id, self.api_key, self.using_custom_key)
+        self.called = True
+
+
+class MemoryQuotaStore:
+    """Sliding-window counters of this process only"""
+
+    def __init__(self):
+        # (key, window_start) -> count
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, cost=1):
+        """Add cost if it fits in the limit; return (allowed, retry_after seconds)"""
+        now = time.time()
+        start = now - now % window
+        with self._lock:
+            current = self._counts.get((key, start), 0)
+            previous = self._counts.get((key, start - window), 0)
+            if sliding_count(previous, current, window, now) + cost > limit:
+                return False, sliding_retry_after(previous, current, limit, window, now, cost)
+            self._counts[(key, start)] = current + cost
+            # Bỏ các cửa sổ không còn ảnh hưởng
+            if len(self._counts) > 10000:
+                self._counts = {
+                    k: v for k, v in self._counts.items() if k[1] >= start - window
+                }
+            return True, 0
+
+
+class SQLiteQuotaStore:
+    """Sliding-window counters in a SQLite file shared by every worker on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._hits = 0
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS quota_counters (
+                    key TEXT NOT NULL,
+                    window_start REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (key, window_start)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # isolation_level=None: tự quản lý transaction bằng BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def hit(self, key, limit, window, cost=1):
+        now = time.time()
+        start = now - now % window
+        with self._connect() as conn:
+            # Khóa ghi ngay từ đầu để đọc-kiểm tra-ghi là nguyên tử giữa các process
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = dict(
+                    conn.execute(
+                        "SELECT window_start, count FROM quota_counters "
+                        "WHERE key = ? AND window_start IN (?, ?)",
+                        (key, start, start - window),
+                    ).fetchall()
+                )
+                previous, current = rows.get(start - window, 0), rows.get(start, 0)
+                allowed = sliding_count(previous, current, window, now) + cost <= limit
+                retry_after = 0
+                if allowed:
+                    conn.execute(
+                        "INSERT INTO quota_counters (key, window_start, expires_at, count) "
+                        "VALUES (?, ?, ?, ?) ON CONFLICT (key, window_start) "
+                        "DO UPDATE SET count = count + excluded.count",
+                        (key, start, start + 2 * window, cost),
+                    )
+                else:
+                    retry_after = sliding_retry_after(previous, current, limit, window, now, cost)
+                self._hits += 1
+                if self._hits % 1000 == 0:
+                    conn.execute("DELETE FROM quota_counters WHERE expires_at < ?", (now,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return allowed, retry_after
+
+
+# Đọc-kiểm tra-tăng nguyên tử trên Redis
+REDIS_HIT_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local count = previous * tonumber(ARGV[1]) + current
+local cost = tonumber(ARGV[3])
+if count + cost > tonumber(ARGV[2]) then
+    return {0, previous, current}
+end
+redis.call('INCRBY', KEYS[1], cost)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+return {1, previous, current + cost}
+"""
+
+
+class RedisQuotaStore:
+    """Sliding-window counters on a Redis server shared by every host"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("The redis package is required for QUOTA_BACKEND=redis")
+        self.client = redis.Redis.from_url(url)
+        self._script = self.client.register_script(REDIS_HIT_SCRIPT)
+
+    def hit(self, key, limit, window, cost=1):
+        now = time.time()
+        start = int(now - now % window)
+        allowed, previous, current = self._script(
+            keys=[f"quota:{key}:{start}", f"quota:{key}:{start - int(window)}"],
+            args=[1 - (now % window) / window, limit, cost, int(2 * window)],
+        )
+        if allowed:
+            return True, 0
+        return False, sliding_retry_after(previous, current, limit, window, now, cost)
+
+
+class QuotaManager:
+    """Per-user and per-API-key request quotas enforced across workers.
+
+    Counters live in a shared store (SQLite by default, Redis for several
+    hosts). Two in-process shortcuts keep most requests off the store: a
+    key that ran out is refused locally until the sliding window has room
+    for it again, and
+    for large limits a worker leases a few requests at a time and hands
+    them out from memory. Leased requests that are not used in time are
+    lost, so a limit may be undershot by at most one lease per worker.
+    """
+
+    def __init__(self, store=None, lease_size=None, lease_ttl=None):
+        self.enabled = os.getenv("QUOTA_ENABLED", "true").lower() == "true"
+        self.store = store if store is not None else self._store_from_env()
+        self.lease_size = lease_size or int(os.getenv("QUOTA_LEASE_SIZE", "10"))
+        self.lease_ttl = lease_ttl or float(os.getenv("QUOTA_LEASE_TTL", "1"))
+        self.limits = {
+            "user": parse(os.getenv("QUOTA_USER_LIMIT", "3 per hour")),
+            "custom_key_user": parse(os.getenv("QUOTA_CUSTOM_KEY_USER_LIMIT", "15 per hour")),
+            "api_key": parse(os.getenv("QUOTA_API_KEY_LIMIT", "60 per minute")),
+        }
+        # (scope, key) -> thời điểm hết bị chặn
+        self._blocked = {}
+        # (scope, key) -> [số lượt còn lại, hạn dùng]
+        self._leases = {}
+        self._lock = threading.Lock()
+        self.local_decisions = 0
+        self.store_calls = 0
+
+    @staticmethod
+    def _store_from_env():
+        backend = os.getenv("QUOTA_BACKEND", "sqlite")
+        if backend == "redis":
+            return RedisQuotaStore(os.getenv("QUOTA_REDIS_URL", "redis://localhost:6379/0"))
+        if backend == "memory":
+            return MemoryQuotaStore()
+        return SQLiteQuotaStore(os.getenv("QUOTA_PATH", "cache/quota.sqlite3"))
+
+    @staticmethod
+    def api_key_id(api_key):
+        """Counter key for an API key; the key itself is never stored"""
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+    def _lease_for(self, limit):
+        # Lease nhỏ so với giới hạn để không worker nào giữ phần lớn quota
+        return max(1, min(self.lease_size, limit // 20))
+
+    def hit(self, scope, key):
+        """Count one request; return (allowed, retry_after seconds)"""
+        item = self.limits[scope]
+        limit, window = item.amount, item.get_expiry()
+        slot = (scope, key)
+        now = time.time()
+        with self._lock:
+            blocked_until = self._blocked.get(slot)
+            if blocked_until is not None:
+                if blocked_until > now:
+                    self.local_decisions += 1
+                    QUOTA_DECISIONS.inc(scope, "denied")
+                    return False, math.ceil(blocked_until - now)
+                del self._blocked[slot]
+            lease = self._leases.get(slot)
+            if lease is not None and lease[0] > 0 and lease[1] > now:
+                lease[0] -= 1
+                self.local_decisions += 1
+                QUOTA_DECISIONS.inc(scope, "allowed")
+                return True, 0
+
+        size = self._lease_for(limit)
+        allowed, retry_after = self.store.hit(f"{scope}:{key}", limit, window, size)
+        if not allowed and size > 1:
+            # Không đủ cho cả lease, thử một lượt
+            size = 1
+            allowed, retry_after = self.store.hit(f"{scope}:{key}", limit, window, size)
+
+        with self._lock:
+            self.store_calls += 1
+            if allowed:
+                if size > 1:
+                    self._leases[slot] = [size - 1, now + self.lease_ttl]
+                QUOTA_DECISIONS.inc(scope, "allowed")
+                return True, 0
+            # Chặn tại chỗ tới khi cửa sổ trượt có chỗ, giống bộ đếm chung
+            self._blocked[slot] = now + retry_after
+            if len(self._blocked) > 10000:
+                self._blocked = {k: v for k, v in self._blocked.items() if v > now}
+            QUOTA_DECISIONS.inc(scope, "denied")
+            return False, math.ceil(retry_after)
+
+    def check_request(self, user_id, api_key=None, using_custom_key=False):
+        """Apply the user's quota and the Gemini key's rate limit to one request.
+
+        Returns None when allowed, else (scope, limit description, retry_after).
+        """
+        if not self.enabled:
+            return None
+        # Key trước: lượt của user chỉ bị tính khi key còn hạn mức
+        checks = []
+        if api_key:
+            checks.append(("api_key", self.api_key_id(api_key)))
+        checks.append(("custom_key_user" if using_custom_key else "user", user_id))
+        for scope, key in checks:
+            allowed, retry_after = self.hit(scope, key)
+            if not allowed:
+                return scope, str(self.limits[scope]), retry_after
+        return None
+
+    def require(self, user_id, api_key=None, using_custom_key=False):
+        """check_request that raises QuotaExceeded instead of returning the reason"""
+        exceeded = self.check_request(user_id, api_key, using_custom_key)
+        if exceeded is not None:
+            raise QuotaExceeded(*exceeded)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "backend": type(self.store).__name__,
+                "limits": {scope: str(item) for scope, item in self.limits.items()},
+                "blocked_keys": sum(1 for until in self._blocked.values() if until > now),
+                "local_decisions": self.local_decisions,
+                "store_calls": self.store_calls,
+            }
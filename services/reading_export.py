@@ -0,0 +1,281 @@
+import os
+import glob
+import json
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import numpy as np
+
+from services.aggregation import GRANULARITIES
+from services.reading_schema import COMPACT_FIELDS, SUGGESTION_REF, TIMESTAMP, USER_ID
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Cột của file xuất: (tên, nguồn trong document, dtype numpy, giá trị khi thiếu)
+COLUMNS = (
+    ("id", None, "U", ""),
+    ("timestamp", TIMESTAMP, "float64", np.nan),
+    ("temperature", COMPACT_FIELDS["temperature"], "float32", np.nan),
+    ("humidity", COMPACT_FIELDS["humidity"], "float32", np.nan),
+    ("noise", COMPACT_FIELDS["noise"], "float32", np.nan),
+    ("suggestion_status", COMPACT_FIELDS["suggestion_status"], "U", ""),
+    ("suggestion_key", SUGGESTION_REF, "U", ""),
+    ("using_custom_key", COMPACT_FIELDS["using_custom_key"], "bool", False),
+    ("request_number", COMPACT_FIELDS["request_number"], "int32", -1),
+    ("batch", COMPACT_FIELDS["batch"], "bool", False),
+)
+
+STATE_FILE = "export_state.json"
+# Danh sách lần đọc của từng flush, dấu chấm để không trùng thư mục user
+MANIFEST_DIR = ".flushes"
+
+
+def part_extension():
+    """.parquet when pyarrow is installed, else compressed numpy columns"""
+    return ".parquet" if pa is not None else ".npz"
+
+
+def write_part(path, rows):
+    """Write rows (lists in COLUMNS order) column by column, atomically"""
+    columns = {}
+    for index, (name, _, dtype, missing) in enumerate(COLUMNS):
+        values = [row[index] if row[index] is not None else missing for row in rows]
+        columns[name] = np.array(values, dtype=dtype if dtype != "U" else str)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if pa is not None:
+            pq.write_table(pa.table(columns), f, compression="zstd")
+        else:
+            np.savez_compressed(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_part(path):
+    """{column: numpy array} of a part written by write_part"""
+    if path.endswith(".parquet"):
+        if pa is None:
+            raise RuntimeError(f"The pyarrow package is required to read {path}")
+        table = pq.read_table(path)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def day_of(timestamp):
+    """Local calendar day of an epoch, the same days as the daily rollups"""
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+class ReadingExporter:
+    """Export sensor_readings to per-user, per-day columnar files and prune old ones.
+
+    export() pages through the collection in (ts, document ID) order and
+    buffers at most max_rows readings before writing one part file per
+    user and day under directory/<user>/<day>/, so memory stays the same
+    whatever the collection size. The cursor is saved in export_state.json
+    after every flush; an interrupted run resumes from it and overwrites
+    the parts of the flush it did not finish.
+
+    Every flush also records the IDs it wrote in .flushes/, and prune()
+    only deletes readings listed there that are older than a retention
+    window, or keeps the first reading of each hour/day per user when
+    downsampling. A reading uploaded late with a ts behind the cursor is
+    never exported and so never deleted. Statistics stay available from
+    the rollups.
+    """
+
+    def __init__(self, firebase_service, directory, page_size=500, max_rows=100000):
+        self.firebase_service = firebase_service
+        self.directory = directory
+        self.page_size = page_size
+        self.max_rows = max_rows
+        os.makedirs(directory, exist_ok=True)
+        self.state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {
+                "cursor": None,
+                "flushes": 0,
+                "writing": None,
+                "exported": 0,
+                "parts": 0,
+                "prune_kept": {},
+                "deleted": 0,
+            }
+
+    def _save_state(self):
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _part_path(self, user_id, day, flush):
+        return os.path.join(
+            self.directory,
+            quote(user_id, safe=""),
+            day,
+            "part-{:06d}{}".format(flush, part_extension()),
+        )
+
+    def _manifest_path(self, flush):
+        return os.path.join(self.directory, MANIFEST_DIR, "flush-{:06d}.npz".format(flush))
+
+    def _write_manifest(self, path, ids, users, timestamps):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez_compressed(
+                f,
+                id=np.array(ids, dtype=str),
+                user=np.array(users, dtype=str),
+                timestamp=np.array(timestamps, dtype="float64"),
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _discard_unfinished(self):
+        """Remove parts of a flush that was interrupted before its checkpoint"""
+        flush = self.state.get("writing")
+        if flush is None:
+            return
+        pattern = os.path.join(self.directory, "*", "*", "part-{:06d}.*".format(flush))
+        for path in glob.glob(pattern) + glob.glob(self._manifest_path(flush)):
+            os.remove(path)
+        self.state["writing"] = None
+        self._save_state()
+
+    def _flush(self, buffers, cursor):
+        flush = self.state["flushes"] + 1
+        # Ghi lại lần flush đang làm để lần chạy sau dọn các part dở dang
+        self.state["writing"] = flush
+        self._save_state()
+        rows = 0
+        ids, users, timestamps = [], [], []
+        for (user_id, day), user_rows in buffers.items():
+            write_part(self._part_path(user_id, day, flush), user_rows)
+            rows += len(user_rows)
+            for row in user_rows:
+                ids.append(row[0])
+                users.append(user_id)
+                timestamps.append(row[1])
+        if ids:
+            # Theo thứ tự export để prune giữ đúng lần đọc đầu tiên của mỗi bucket
+            order = sorted(range(len(ids)), key=lambda i: (timestamps[i], ids[i]))
+            self._write_manifest(
+                self._manifest_path(flush),
+                [ids[i] for i in order],
+                [users[i] for i in order],
+                [timestamps[i] for i in order],
+            )
+        self.state.update(
+            cursor=cursor,
+            flushes=flush,
+            writing=None,
+            exported=self.state["exported"] + rows,
+            parts=self.state["parts"] + len(buffers),
+        )
+        self._save_state()
+        return rows
+
+    def export(self, until=None, max_pages=None, progress=None):
+        """Export readings with ts < until; returns the number exported"""
+        self._discard_unfinished()
+        after = tuple(self.state["cursor"]) if self.state["cursor"] else None
+        buffers = {}
+        buffered = 0
+        exported = 0
+        cursor = after
+        pages = self.firebase_service.reading_pages(
+            after=after, until=until, page_size=self.page_size
+        )
+        for number, page in enumerate(pages, 1):
+            for document_id, document in page:
+                timestamp = document.get(TIMESTAMP)
+                user_id = document.get(USER_ID)
+                if timestamp is None or not user_id:
+                    continue
+                row = [document_id] + [
+                    document.get(source) for _, source, _, _ in COLUMNS[1:]
+                ]
+                buffers.setdefault((user_id, day_of(timestamp)), []).append(row)
+                buffered += 1
+            if page:
+                cursor = [page[-1][1].get(TIMESTAMP), page[-1][0]]
+            if buffered >= self.max_rows:
+                exported += self._flush(buffers, cursor)
+                buffers, buffered = {}, 0
+                if progress:
+                    progress(self.state)
+            if max_pages is not None and number >= max_pages:
+                break
+        if buffers or cursor != after:
+            exported += self._flush(buffers, cursor)
+            if progress:
+                progress(self.state)
+        return exported
+
+    def prune(self, retention, downsample=None, progress=None):
+        """Delete exported readings older than retention seconds; returns the count.
+
+        With downsample ("hour" or "day") the first reading of each bucket
+        of a user is kept and the others are deleted.
+        """
+        self._discard_unfinished()
+        until = time.time() - retention
+        bucket_seconds = GRANULARITIES[downsample] if downsample else None
+        kept = self.state.setdefault("prune_kept", {})
+        deleted = 0
+        # Các flush theo thứ tự export, flush đã dọn xong thì manifest bị xóa
+        for path in sorted(glob.glob(os.path.join(self.directory, MANIFEST_DIR, "flush-*.npz"))):
+            with np.load(path) as data:
+                ids, users, timestamps = data["id"], data["user"], data["timestamp"]
+            doomed = []
+            for index in range(len(ids)):
+                timestamp = float(timestamps[index])
+                if timestamp >= until:
+                    remaining = index
+                    break
+                if bucket_seconds is not None:
+                    user_id = str(users[index])
+                    bucket = day_of(timestamp) if downsample == "day" else int(
+                        timestamp // bucket_seconds
+                    )
+                    if kept.get(user_id) != bucket:
+                        kept[user_id] = bucket
+                        continue
+                doomed.append(str(ids[index]))
+            else:
+                remaining = None
+
+            # Xóa lại document đã xóa không lỗi, nên dừng giữa chừng vẫn chạy lại được
+            self.firebase_service.delete_readings(doomed)
+            if remaining is None:
+                os.remove(path)
+            elif remaining:
+                self._write_manifest(
+                    path, ids[remaining:], users[remaining:], timestamps[remaining:]
+                )
+            deleted += len(doomed)
+            self.state["deleted"] += len(doomed)
+            self._save_state()
+            if progress:
+                progress(self.state)
+            if remaining is not None:
+                # Các flush sau đều mới hơn
+                break
+        return deleted
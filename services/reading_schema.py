@@ -0,0 +1,106 @@
+import json
+import hashlib
+from datetime import datetime
+
+SCHEMA_VERSION = 2
+
+# Tên trường đầy đủ (schema cũ, API và dashboard) -> tên ngắn lưu trên Firestore
+COMPACT_FIELDS = {
+    "userId": "u",
+    "temperature": "t",
+    "humidity": "h",
+    "noise": "n",
+    "suggestion_status": "st",
+    "using_custom_key": "k",
+    "request_number": "rn",
+    "batch": "b",
+}
+EXPANDED_FIELDS = {short: name for name, short in COMPACT_FIELDS.items()}
+USER_ID = COMPACT_FIELDS["userId"]
+STATUS = COMPACT_FIELDS["suggestion_status"]
+
+# Khóa khuyến nghị (hash nội dung) và phần khuyến nghị đang stream
+SUGGESTION_REF = "s"
+PARTIAL_SUGGESTION = "ps"
+TIMESTAMP = "ts"
+VERSION = "v"
+
+SUGGESTIONS_COLLECTION = "suggestions"
+
+
+def to_epoch(timestamp):
+    """Epoch seconds of an ISO string, datetime or number"""
+    if isinstance(timestamp, (int, float)):
+        return round(float(timestamp), 3)
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return round(timestamp.timestamp(), 3)
+
+
+def suggestion_key(suggestion_data):
+    """Content address of a suggestion: SHA-256 of its canonical JSON, 128 bits"""
+    canonical = json.dumps(
+        suggestion_data, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+def compact_reading(reading_data, user_id=None):
+    """Split a full reading into its compact document and its suggestion.
+
+    Returns (document, suggestion) where suggestion is None or
+    (key, {"suggestion": ..., "raw_response": ...}) to store under
+    suggestions/{key}. Fields without a short name are kept as they are.
+    """
+    document = {VERSION: SCHEMA_VERSION}
+    suggestion = None
+    for name, value in reading_data.items():
+        if name == "timestamp":
+            document[TIMESTAMP] = to_epoch(value)
+        elif name == "suggestion":
+            if value is not None:
+                key = suggestion_key(value)
+                suggestion = (
+                    key,
+                    {"suggestion": value, "raw_response": reading_data.get("raw_response")},
+                )
+                document[SUGGESTION_REF] = key
+        elif name == "raw_response":
+            continue
+        else:
+            document[COMPACT_FIELDS.get(name, name)] = value
+    if user_id is not None:
+        document.setdefault(USER_ID, user_id)
+    return document, suggestion
+
+
+def expand_reading(document, suggestions):
+    """Full-name reading for the API and dashboard.
+
+    Works for compact documents, old full-name documents and old documents
+    updated with compact fields (a suggestion attached after the upgrade).
+    suggestions maps content keys to stored suggestions; raw_response is
+    never returned.
+    """
+    reading = {}
+    for name, value in document.items():
+        if name == TIMESTAMP:
+            reading["timestamp"] = datetime.fromtimestamp(value).isoformat()
+        elif name in (VERSION, SUGGESTION_REF, PARTIAL_SUGGESTION, "raw_response"):
+            continue
+        else:
+            reading[EXPANDED_FIELDS.get(name, name)] = value
+    # Trường ngắn ghi sau cùng thắng trường đầy đủ của document cũ
+    if STATUS in document:
+        reading["suggestion_status"] = document[STATUS]
+    key = document.get(SUGGESTION_REF)
+    if key is not None:
+        reading["suggestion"] = suggestions.get(key)
+    elif PARTIAL_SUGGESTION in document:
+        reading["suggestion"] = document[PARTIAL_SUGGESTION]
+    return reading
+
+
+def suggestion_refs(documents):
+    """Content keys referenced by stored documents"""
+    return {document[SUGGESTION_REF] for document in documents if document.get(SUGGESTION_REF)}
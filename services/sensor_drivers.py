@@ -0,0 +1,224 @@
+import os
+import math
+import time
+import random
+import threading
+
+try:
+    import Adafruit_DHT
+except ImportError:
+    Adafruit_DHT = None
+
+try:
+    import Adafruit_MCP3008
+    import Adafruit_GPIO.SPI as SPI
+except ImportError:
+    Adafruit_MCP3008 = None
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+METRICS = ("temperature", "humidity", "noise")
+
+
+class SensorReadError(Exception):
+    """A single read attempt of a sensor failed"""
+
+
+def _setup_gpio():
+    """Number pins by BCM channel, as the driver settings do"""
+    # Mỗi driver đều gọi, đặt lại cùng chế độ không sao
+    if GPIO is not None:
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+
+def _cleanup_gpio():
+    """Release the GPIO pins claimed by this process"""
+    if GPIO is not None:
+        GPIO.cleanup()
+
+
+class SensorDriver:
+    """One physical (or simulated) sensor, read on its own schedule.
+
+    read() makes a single attempt and returns {metric: value} for the
+    metrics the driver provides, or raises SensorReadError. The service
+    retries after retry_delay, up to retries attempts for a direct read.
+    """
+
+    kind = None
+    metrics = ()
+
+    def __init__(self, name, interval, retries=1, retry_delay=0.0):
+        self.name = name
+        self.interval = interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Một cảm biến không đọc được từ hai luồng cùng lúc
+        self.lock = threading.Lock()
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DHTDriver(SensorDriver):
+    """DHT11/DHT22 temperature and humidity over one GPIO pin"""
+
+    kind = "dht"
+    metrics = ("temperature", "humidity")
+
+    def __init__(self, name="dht", interval=None, pin=None, model=None, retries=None):
+        if Adafruit_DHT is None:
+            raise RuntimeError("Adafruit_DHT is not installed")
+        # DHT11 cần ít nhất ~1-2 giây giữa hai lần đọc
+        super().__init__(
+            name,
+            interval or float(os.getenv("SENSOR_DHT_INTERVAL", "2")),
+            retries=retries or int(os.getenv("SENSOR_DHT_RETRIES", "3")),
+            retry_delay=2.0,
+        )
+        self.pin = pin or int(os.getenv("SENSOR_DHT_PIN", "4"))  # GPIO4 (Pin 7)
+        self.model = getattr(Adafruit_DHT, "DHT" + (model or os.getenv("SENSOR_DHT_MODEL", "11")))
+        _setup_gpio()
+
+    def read(self):
+        humidity, temperature = Adafruit_DHT.read(self.model, self.pin)
+        if humidity is None or temperature is None:
+            raise SensorReadError(f"Failed to read from DHT sensor on GPIO{self.pin}")
+        return {"temperature": round(temperature, 1), "humidity": round(humidity, 1)}
+
+    def close(self):
+        _cleanup_gpio()
+
+
+class MCP3008NoiseDriver(SensorDriver):
+    """Analog sound sensor on an MCP3008 ADC channel, reported in dB.
+
+    Each read samples the channel for a short window and converts the
+    peak-to-peak amplitude to a level: offset + 20 * log10(amplitude).
+    The offset has to be calibrated against a reference meter.
+    """
+
+    kind = "mcp3008"
+    metrics = ("noise",)
+
+    def __init__(self, name="noise", interval=None, channel=None, window=None, db_offset=None):
+        if Adafruit_MCP3008 is None:
+            raise RuntimeError("Adafruit_MCP3008 is not installed")
+        super().__init__(name, interval or float(os.getenv("SENSOR_NOISE_INTERVAL", "1")))
+        self.channel = channel if channel is not None else int(
+            os.getenv("SENSOR_NOISE_CHANNEL", "0")
+        )
+        self.window = window or float(os.getenv("SENSOR_NOISE_WINDOW", "0.05"))
+        self.db_offset = db_offset if db_offset is not None else float(
+            os.getenv("SENSOR_NOISE_DB_OFFSET", "30")
+        )
+        _setup_gpio()
+        self.adc = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(0, 0))
+
+    def read(self):
+        low, high = 1023, 0
+        deadline = time.monotonic() + self.window
+        while True:
+            value = self.adc.read_adc(self.channel)
+            low, high = min(low, value), max(high, value)
+            if time.monotonic() >= deadline:
+                break
+        amplitude = max(high - low, 1)
+        return {"noise": round(self.db_offset + 20 * math.log10(amplitude), 1)}
+
+    def close(self):
+        _cleanup_gpio()
+
+
+# Độ trễ và tỉ lệ lỗi gần với phần cứng thật: DHT11 chậm và hay đọc hỏng
+SIMULATED_PROFILES = {
+    "dht": {
+        "metrics": {"temperature": (18, 30, 0.2), "humidity": (30, 80, 1.0)},
+        "interval": 2.0,
+        "latency": 0.25,
+        "failure_rate": 0.15,
+        "retries": 3,
+        "retry_delay": 2.0,
+    },
+    "noise": {
+        "metrics": {"noise": (30, 100, 3.0)},
+        "interval": 1.0,
+        "latency": 0.05,
+        "failure_rate": 0.0,
+        "retries": 1,
+        "retry_delay": 0.0,
+    },
+}
+
+
+class SimulatedDriver(SensorDriver):
+    """Random-walk readings with the timing of a real sensor, for use without hardware"""
+
+    kind = "simulated"
+
+    def __init__(self, profile, name=None, interval=None, latency=None, failure_rate=None):
+        settings = SIMULATED_PROFILES[profile]
+        env = profile.upper()
+        super().__init__(
+            name or f"simulated-{profile}",
+            interval or float(os.getenv(f"SENSOR_{env}_INTERVAL", str(settings["interval"]))),
+            retries=settings["retries"],
+            retry_delay=settings["retry_delay"],
+        )
+        self.ranges = settings["metrics"]
+        self.metrics = tuple(self.ranges)
+        self.latency = latency if latency is not None else settings["latency"]
+        self.failure_rate = failure_rate if failure_rate is not None else float(
+            os.getenv(f"SENSOR_SIMULATED_{env}_FAILURE_RATE", str(settings["failure_rate"]))
+        )
+        self._values = {
+            metric: random.uniform(low, high) for metric, (low, high, _) in self.ranges.items()
+        }
+
+    def read(self):
+        time.sleep(self.latency * random.uniform(0.8, 1.2))
+        if random.random() < self.failure_rate:
+            raise SensorReadError(f"Simulated read failure of {self.name}")
+        for metric, (low, high, step) in self.ranges.items():
+            value = self._values[metric] + random.uniform(-step, step)
+            self._values[metric] = min(high, max(low, value))
+        return {metric: round(value, 1) for metric, value in self._values.items()}
+
+
+DRIVERS = {
+    "dht": DHTDriver,
+    "mcp3008": MCP3008NoiseDriver,
+    "simulated-dht": lambda: SimulatedDriver("dht"),
+    "simulated-noise": lambda: SimulatedDriver("noise"),
+}
+
+
+def register_driver(kind, factory):
+    """Make a driver available to SENSOR_DRIVERS under kind"""
+    DRIVERS[kind] = factory
+
+
+def create_drivers(spec=None):
+    """Drivers named in spec (comma separated), SENSOR_DRIVERS or the default"""
+    default = "dht,mcp3008" if Adafruit_DHT is not None else "simulated-dht,simulated-noise"
+    spec = spec or os.getenv("SENSOR_DRIVERS", default)
+    drivers = []
+    for kind in (kind.strip() for kind in spec.split(",")):
+        if not kind:
+            continue
+        if kind not in DRIVERS:
+            raise ValueError(f"Unknown sensor driver: {kind}")
+        drivers.append(DRIVERS[kind]())
+
+    provided = {metric for driver in drivers for metric in driver.metrics}
+    missing = [metric for metric in METRICS if metric not in provided]
+    if missing:
+        raise ValueError(f"No sensor driver provides {', '.join(missing)}")
+    return drivers
@@ -1,100 +1,297 @@
+import os
 import time
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
-PI_AVAILABLE = False
-try:
-    import Adafruit_DHT
-    import RPi.GPIO as GPIO
-    PI_AVAILABLE = True
-except ImportError:
-    print("Adafruit_DHT or RPi.GPIO not available. Running in non-PI mode.")
+from services.metrics import ERRORS, SENSOR_READ_ATTEMPTS, SENSOR_READ_LATENCY
+from services.sensor_drivers import METRICS, SensorReadError, SimulatedDriver, create_drivers
+
+
+class SampleRingBuffer:
+    """Fixed-size ring buffer of samples backed by arrays"""
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("SENSOR_BUFFER_SIZE must be at least 1")
+        self.capacity = capacity
+        self._timestamps = array("d", [0.0] * capacity)
+        self._temperatures = array("d", [0.0] * capacity)
+        self._humidities = array("d", [0.0] * capacity)
+        self._noises = array("d", [0.0] * capacity)
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, sample):
+        with self._lock:
+            i = self._next
+            self._timestamps[i] = sample["timestamp"]
+            self._temperatures[i] = sample["temperature"]
+            self._humidities[i] = sample["humidity"]
+            self._noises[i] = sample["noise"]
+            self._next = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def _sample(self, i):
+        return {
+            "temperature": self._temperatures[i],
+            "humidity": self._humidities[i],
+            "noise": self._noises[i],
+            "timestamp": self._timestamps[i],
+        }
+
+    def latest(self):
+        with self._lock:
+            if not self._count:
+                return None
+            return self._sample((self._next - 1) % self.capacity)
+
+    def window(self, count):
+        """The last count samples, oldest first"""
+        with self._lock:
+            count = min(count, self._count)
+            start = self._next - count
+            return [self._sample((start + k) % self.capacity) for k in range(count)]
+
+    def __len__(self):
+        return self._count
 
 
 class SensorService:
-    def __init__(self):
-        self.simulation_mode = not PI_AVAILABLE
-        if not self.simulation_mode:
-            # Khởi tạo loại cảm biến và pin
-            self.dht_sensor = Adafruit_DHT.DHT11
-            self.dht_pin = 4  # GPIO4 (Pin 7)
-            self.noise_pin = 17  # GPIO17 (Pin 11) - Giả sử pin cho cảm biến âm thanh analog
-
-            # Khởi tạo GPIO
-            GPIO.setmode(GPIO.BCM)
-            GPIO.setwarnings(False)
-
-            # Thiết lập pin nếu cần
-            # GPIO.setup(self.noise_pin, GPIO.IN)
-            print("Sensor service initialized")
-        else:
-            print("Running in simulation mode. No sensors available.")
-
-    def read_dht11(self):
-        """Đọc nhiệt độ và độ ẩm từ cảm biến DHT11"""
-        if not self.simulation_mode:
-            for _ in range(3):  # Thử 3 lần nếu đọc thất bại
-                humidity, temperature = Adafruit_DHT.read_retry(
-                    self.dht_sensor, self.dht_pin
-                )
-                if humidity is not None and temperature is not None:
-                    return {
-                        "temperature": round(temperature, 1),
-                        "humidity": round(humidity, 1),
-                    }
-                time.sleep(2)
-
-            # Trả về giá trị mặc định nếu không đọc được
-            return {
-                "temperature": 0,
-                "humidity": 0,
-                "error": "Failed to read from DHT11 sensor",
-            }
-        else:
-            # Mô phỏng dữ liệu cảm biến DHT11 trong chế độ mô phỏng
-            import random
-            return {
-                'temperature': round(random.uniform(18, 30), 1),
-                'humidity': round(random.uniform(30, 80), 1)
-            }
-
-    def read_noise_level(self):
-        """Đọc mức độ tiếng ồn từ cảm biến âm thanh
-        Lưu ý: Đây là một ví dụ, bạn cần thay thế bằng code thực tế cho cảm biến âm thanh của mình
+    """Reads every sensor driver on its own schedule and composes samples.
+
+    Each driver runs in its own thread at its own interval, so a slow or
+    failing DHT read never holds back a fast sensor. A sampler combines
+    the latest value of every metric into a sample every sample_interval;
+    a metric older than max_age makes the sample fail instead of reusing
+    a stale value.
+    """
+
+    def __init__(self, drivers=None):
+        self.drivers = drivers or create_drivers()
+        self.simulation_mode = all(isinstance(d, SimulatedDriver) for d in self.drivers)
+        self.buffer = SampleRingBuffer(int(os.getenv("SENSOR_BUFFER_SIZE", "720")))
+        self.sample_interval = float(os.getenv("SENSOR_SAMPLE_INTERVAL", "5"))
+        self.max_age = float(os.getenv("SENSOR_MAX_AGE", "30"))
+        self._threads = []
+        self._stop_sampling = threading.Event()
+        # Đã có giá trị cho mọi metric, có thể ghép mẫu
+        self._ready = threading.Event()
+        self._stats_lock = threading.Lock()
+        # metric -> (value, time.time() lúc đọc)
+        self._values = {}
+        self._driver_stats = {
+            driver.name: {"attempts": 0, "failures": 0, "last_duration": None, "last_success": None}
+            for driver in self.drivers
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.drivers), thread_name_prefix="sensor-read"
+        )
+        self.sample_attempts = 0
+        self.sample_failures = 0
+        names = ", ".join(f"{d.name} ({d.kind}, every {d.interval:g}s)" for d in self.drivers)
+        mode = "simulation mode" if self.simulation_mode else "hardware"
+        print(f"Sensor service initialized in {mode}: {names}")
+
+    def _read_once(self, driver, since=None):
+        """One read attempt with metrics; {metric: value} or None.
+
+        With since, a successful read that finished while waiting for the
+        sensor is returned instead of reading again.
         """
-        if self.simulation_mode:
-            # Mô phỏng dữ liệu cảm biến âm thanh trong chế độ mô phỏng
-            import random
-            return round(random.uniform(30, 100), 1)
-        try:
-            # Đây là code mẫu - cần thay thế bằng code thực tế cho cảm biến âm thanh
-            # Giả sử bạn đang sử dụng analog sound sensor qua MCP3008 ADC
-            # import Adafruit_MCP3008
-            # adc = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(0, 0))
-            # raw_value = adc.read_adc(0)  # đọc từ kênh 0
-
-            # Mô phỏng đọc giá trị
-            raw_value = 300  # giá trị mẫu
-
-            # Chuyển đổi giá trị sang dB (cần hiệu chỉnh theo cảm biến thực tế)
-            # Công thức này chỉ là ví dụ
-            noise_db = 20 * (raw_value / 1023)
-
-            return round(noise_db, 1)
-        except Exception as e:
-            print(f"Error reading noise level: {e}")
-            return 0
+        with driver.lock:
+            if since is not None:
+                with self._stats_lock:
+                    last_success = self._driver_stats[driver.name]["last_success"]
+                    if last_success is not None and last_success >= since:
+                        return {metric: self._values[metric][0] for metric in driver.metrics}
+            started = time.monotonic()
+            values = None
+            with SENSOR_READ_LATENCY.time(driver.name):
+                try:
+                    values = driver.read()
+                except SensorReadError as e:
+                    print(f"Sensor read failed: {e}")
+                except Exception as e:
+                    ERRORS.inc(f"sensor_service.{driver.name}")
+                    print(f"Error reading {driver.name}: {e}")
+        duration = time.monotonic() - started
+        SENSOR_READ_ATTEMPTS.inc(driver.name, "ok" if values is not None else "failed")
+
+        now = time.time()
+        with self._stats_lock:
+            stats = self._driver_stats[driver.name]
+            stats["attempts"] += 1
+            stats["last_duration"] = duration
+            if values is None:
+                stats["failures"] += 1
+            else:
+                stats["last_success"] = now
+                for metric, value in values.items():
+                    self._values[metric] = (value, now)
+                if len(self._values) == len(METRICS):
+                    self._ready.set()
+        return values
+
+    def _read_with_retries(self, driver):
+        # Các request đồng thời dùng chung một lần đọc thay vì xếp hàng đọc lại
+        requested = time.time()
+        for attempt in range(driver.retries):
+            values = self._read_once(driver, since=requested)
+            if values is not None:
+                return values
+            if attempt < driver.retries - 1:
+                time.sleep(driver.retry_delay)
+        return None
 
     def read_all_sensors(self):
-        """Đọc tất cả các cảm biến và trả về dữ liệu"""
-        dht_data = self.read_dht11()
-        noise_level = self.read_noise_level()
+        """Đọc tất cả các cảm biến song song và trả về dữ liệu"""
+        data = {}
+        for values in self._executor.map(self._read_with_retries, self.drivers):
+            data.update(values or {})
+        # Cảm biến đọc lỗi trả về 0 như trước
+        sample = {metric: data.get(metric, 0) for metric in METRICS}
+        sample["timestamp"] = time.time()
+        return sample
+
+    def start_sampling(self, on_sample=None):
+        """Chạy một luồng cho mỗi cảm biến và một luồng ghép mẫu vào ring buffer"""
+        if self._threads or self.sample_interval <= 0:
+            return
+        for driver in self.drivers:
+            self._threads.append(
+                threading.Thread(
+                    target=self._driver_loop,
+                    args=(driver,),
+                    name=f"sensor-{driver.name}",
+                    daemon=True,
+                )
+            )
+        self._threads.append(
+            threading.Thread(
+                target=self._sample_loop, args=(on_sample,), name="sensor-sampler", daemon=True
+            )
+        )
+        for thread in self._threads:
+            thread.start()
+        print(f"Sensor sampling every {self.sample_interval}s")
+
+    @property
+    def sampling(self):
+        return bool(self._threads)
+
+    def _driver_loop(self, driver):
+        while not self._stop_sampling.is_set():
+            started = time.monotonic()
+            values = self._read_once(driver)
+            # Đọc lỗi thì thử lại sớm hơn, nhưng không nhanh hơn cảm biến cho phép
+            delay = driver.interval if values is not None else min(
+                driver.retry_delay or driver.interval, driver.interval
+            )
+            self._stop_sampling.wait(max(0, delay - (time.monotonic() - started)))
 
+    def _compose(self):
+        """Latest value of every metric as a sample, None if one is missing or stale"""
+        now = time.time()
+        with self._stats_lock:
+            values = dict(self._values)
+        if any(
+            metric not in values or now - values[metric][1] > self.max_age
+            for metric in METRICS
+        ):
+            return None
+        sample = {metric: values[metric][0] for metric in METRICS}
+        sample["timestamp"] = now
+        return sample
+
+    def _sample_loop(self, on_sample):
+        # Chờ lần đọc thành công đầu tiên của mọi cảm biến
+        self._ready.wait(self.max_age)
+        while not self._stop_sampling.is_set():
+            started = time.monotonic()
+            sample = self._compose()
+            with self._stats_lock:
+                self.sample_attempts += 1
+                if sample is None:
+                    self.sample_failures += 1
+
+            # Bỏ qua mẫu lỗi, giữ lại mẫu tốt gần nhất trong buffer
+            if sample is not None:
+                self.buffer.append(sample)
+                if on_sample:
+                    try:
+                        on_sample(sample)
+                    except Exception as e:
+                        print(f"Error handling sensor sample: {e}")
+
+            elapsed = time.monotonic() - started
+            self._stop_sampling.wait(max(0, self.sample_interval - elapsed))
+
+    def latest_sample(self):
+        """Mẫu mới nhất từ ring buffer, None nếu chưa có"""
+        return self.buffer.latest()
+
+    def recent_samples(self, count):
+        return self.buffer.window(count)
+
+    def sampling_stats(self):
+        latest = self.buffer.latest()
+        now = time.time()
+        with self._stats_lock:
+            attempts, failures = self.sample_attempts, self.sample_failures
+            sensors = {}
+            for driver in self.drivers:
+                stats = self._driver_stats[driver.name]
+                sensors[driver.name] = {
+                    "kind": driver.kind,
+                    "metrics": list(driver.metrics),
+                    "interval": driver.interval,
+                    "attempts": stats["attempts"],
+                    "failures": stats["failures"],
+                    "failure_rate": (
+                        round(stats["failures"] / stats["attempts"], 4)
+                        if stats["attempts"]
+                        else 0.0
+                    ),
+                    "last_read_duration": (
+                        round(stats["last_duration"], 3)
+                        if stats["last_duration"] is not None
+                        else None
+                    ),
+                    "value_age": (
+                        round(now - stats["last_success"], 3)
+                        if stats["last_success"] is not None
+                        else None
+                    ),
+                }
+        durations = [
+            s["last_read_duration"] for s in sensors.values() if s["last_read_duration"] is not None
+        ]
         return {
-            "temperature": dht_data.get("temperature", 0),
-            "humidity": dht_data.get("humidity", 0),
-            "noise": noise_level,
-            "timestamp": time.time(),
+            "sampling": self.sampling,
+            "interval": self.sample_interval,
+            "buffered": len(self.buffer),
+            "capacity": self.buffer.capacity,
+            "sample_age": round(now - latest["timestamp"], 3) if latest else None,
+            "attempts": attempts,
+            "failures": failures,
+            "failure_rate": round(failures / attempts, 4) if attempts else 0.0,
+            # Cảm biến chậm nhất, các cảm biến được đọc song song
+            "last_read_duration": max(durations) if durations else None,
+            "sensors": sensors,
         }
 
+    def stop_sampling(self):
+        self._stop_sampling.set()
+        self._ready.set()
+        for thread in self._threads:
+            thread.join(timeout=max(d.interval for d in self.drivers) + 10)
+        self._threads = []
+
     def cleanup(self):
-        """Dọn dẹp GPIO khi đóng ứng dụng"""
-        GPIO.cleanup()
+        """Dừng các luồng đọc và giải phóng cảm biến khi đóng ứng dụng"""
+        self.stop_sampling()
+        self._executor.shutdown(wait=False)
+        for driver in self.drivers:
+            driver.close()
@@ -0,0 +1,80 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """Wall-clock time of each import and initialisation step of a process"""
+
+    def __init__(self):
+        self.created = time.perf_counter()
+        self._phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases.append(
+                    {
+                        "phase": name,
+                        "seconds": round(time.perf_counter() - started, 4),
+                        "at": round(started - self.created, 4),
+                        "pid": os.getpid(),
+                    }
+                )
+
+    def report(self):
+        with self._lock:
+            phases = [p for p in self._phases if p["pid"] == os.getpid()]
+            # Các bước chạy trong tiến trình cha trước khi fork (preload)
+            inherited = [p for p in self._phases if p["pid"] != os.getpid()]
+        return {
+            "pid": os.getpid(),
+            "phases": phases,
+            "inherited_phases": inherited,
+            "total_seconds": round(sum(p["seconds"] for p in phases + inherited), 4),
+        }
+
+
+STARTUP = StartupReport()
+
+
+class LazyService:
+    """Proxy that builds a service on first use, once per process.
+
+    Attribute access is forwarded to the instance. An instance built before
+    a fork is not reused by the child, which builds its own: gRPC channels
+    and background threads do not survive fork.
+    """
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self._pid == os.getpid()
+
+    def resolve(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    with STARTUP.phase(f"init {self._name}"):
+                        self._instance = self._factory()
+                    self._pid = os.getpid()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __bool__(self):
+        # Factory trả về None khi phần cứng/dịch vụ không khả dụng
+        return self.resolve() is not None
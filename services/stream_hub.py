@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from services.reading_schema import USER_ID
+
+
+class StreamSubscription:
+    """Pending events of one connected client, coalesced by key"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._events = OrderedDict()
+        self._condition = threading.Condition()
+        self.closed = False
+
+    def push(self, key, event, data):
+        with self._condition:
+            # Cập nhật mới thay thế cập nhật cũ cùng key chưa kịp gửi
+            self._events.pop(key, None)
+            self._events[key] = (event, data)
+            self._condition.notify()
+
+    def wait(self, timeout):
+        """Wait for events, return them all (possibly none after timeout)"""
+        with self._condition:
+            if not self._events and not self.closed:
+                self._condition.wait(timeout)
+            events = list(self._events.values())
+            self._events.clear()
+            return events
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+
+class StreamHub:
+    """Fan out Firestore changes to SSE clients.
+
+    Each process listens only to the users it has clients for: one listener
+    on users/{uid} and one on that user's new readings, shared by all of the
+    user's connections and stopped when the last one closes.
+    """
+
+    def __init__(self, firebase_service, coalesce_interval=None, heartbeat_interval=None, max_clients=None):
+        self.firebase_service = firebase_service
+        self.coalesce_interval = coalesce_interval or float(
+            os.getenv("STREAM_COALESCE_INTERVAL", "0.5")
+        )
+        self.heartbeat_interval = heartbeat_interval or float(
+            os.getenv("STREAM_HEARTBEAT_INTERVAL", "15")
+        )
+        self.max_clients = max_clients or int(os.getenv("STREAM_MAX_CLIENTS", "500"))
+        # Số lần đọc mới nhất listener giữ cho mỗi user
+        self.watch_limit = int(os.getenv("STREAM_WATCH_LIMIT", "50"))
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        # user_id -> listener của user (list rỗng khi đang được tạo)
+        self._watches = {}
+        self.events_received = 0
+
+    def _start_watches(self, user_id, pending):
+        """Listen to one user's document and new readings"""
+        since = datetime.now().isoformat()
+        watches = []
+        try:
+            watches.append(self.firebase_service.watch_user(user_id, self._on_user))
+            watches.append(
+                self.firebase_service.watch_readings(
+                    user_id, since, self._on_readings, limit=self.watch_limit
+                )
+            )
+        except Exception:
+            self._stop_watches(watches)
+            with self._lock:
+                if self._watches.get(user_id) is pending:
+                    del self._watches[user_id]
+            raise
+        with self._lock:
+            # Client cuối có thể đã ngắt (và client mới mở lại) trong lúc tạo listener
+            if self._watches.get(user_id) is pending:
+                self._watches[user_id] = watches
+                return
+        self._stop_watches(watches)
+
+    @staticmethod
+    def _stop_watches(watches):
+        for watch in watches:
+            watch.unsubscribe()
+
+    def subscribe(self, user_id):
+        with self._lock:
+            client_count = sum(len(subs) for subs in self._subscriptions.values())
+            if client_count >= self.max_clients:
+                return None
+            subscription = StreamSubscription(user_id)
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+            pending = None
+            if user_id not in self._watches:
+                pending = self._watches[user_id] = []
+        if pending is not None:
+            try:
+                self._start_watches(user_id, pending)
+            except Exception:
+                self.unsubscribe(subscription)
+                raise
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        watches = []
+        with self._lock:
+            subs = self._subscriptions.get(subscription.user_id)
+            if subs is not None:
+                subs.discard(subscription)
+                if not subs:
+                    del self._subscriptions[subscription.user_id]
+                    watches = self._watches.pop(subscription.user_id, [])
+        # Không còn ai xem user này thì dừng listener của user
+        self._stop_watches(watches)
+
+    def _subscribers(self, user_id):
+        with self._lock:
+            return list(self._subscriptions.get(user_id, ()))
+
+    def publish(self, user_id, key, event, data):
+        for subscription in self._subscribers(user_id):
+            subscription.push(key, event, data)
+
+    def _on_readings(self, snapshot, changes, read_time):
+        for change in changes:
+            # REMOVED: lần đọc bị đẩy ra khỏi cửa sổ limit của listener, không phải bị xóa
+            if change.type.name == "REMOVED":
+                continue
+            self.events_received += 1
+            document = change.document.to_dict()
+            user_id = document.get(USER_ID) or document.get("userId")
+            # Chỉ đọc khuyến nghị tham chiếu khi có người đang xem
+            if not user_id or not self._subscribers(user_id):
+                continue
+            # Trình duyệt nhận tên trường đầy đủ, không có raw_response
+            data = self.firebase_service.expand_readings([document])[0]
+            data["id"] = change.document.id
+            self.publish(user_id, ("reading", change.document.id), "reading", data)
+
+    def _on_user(self, snapshots, changes, read_time):
+        for document in snapshots:
+            if not document.exists:
+                continue
+            self.events_received += 1
+            data = document.to_dict()
+            # Không bao giờ gửi API key ra ngoài
+            usage = {
+                "requests_this_hour": data.get("requests_this_hour", 0),
+                "has_custom_key": bool(data.get("gemini_api_key")),
+            }
+            self.publish(document.id, ("usage",), "usage", usage)
+
+    @staticmethod
+    def format_event(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    def stream(self, subscription, initial_events=()):
+        """Generator of SSE messages for one client"""
+        try:
+            for event, data in initial_events:
+                yield self.format_event(event, data)
+
+            last_sent = time.monotonic()
+            while not subscription.closed:
+                events = subscription.wait(self.heartbeat_interval)
+                if events:
+                    # Gom các thay đổi đến gần nhau thành một lần gửi
+                    time.sleep(self.coalesce_interval)
+                    events += subscription.wait(0)
+                    # Mỗi key chỉ giữ bản mới nhất
+                    latest = OrderedDict()
+                    for event, data in events:
+                        latest[(event, data.get("id"))] = (event, data)
+                    for event, data in latest.values():
+                        yield self.format_event(event, data)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= self.heartbeat_interval:
+                    yield ": heartbeat\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "watched_users": len(self._watches),
+                "users": len(self._subscriptions),
+                "clients": sum(len(subs) for subs in self._subscriptions.values()),
+                "max_clients": self.max_clients,
+                "events_received": self.events_received,
+            }
+
+    def close(self):
+        with self._lock:
+            watches, self._watches = self._watches, {}
+            subscriptions = [s for subs in self._subscriptions.values() for s in subs]
+        for user_watches in watches.values():
+            self._stop_watches(user_watches)
+        for subscription in subscriptions:
+            subscription.close()
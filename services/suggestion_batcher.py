@@ -0,0 +1,170 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+
+from services.metrics import ERRORS, GEMINI_BATCH_SIZE
+
+
+class SuggestionBatcher:
+    """Coalesce suggestion requests that share an API key into one model call.
+
+    The first request for a key opens a window; everything submitted for the
+    same key before it closes, or until max_batch distinct items are waiting,
+    is handed to send_batch(batch_key, items) as one call. send_batch returns
+    one result per item, in order. Identical items share one slot.
+
+    submit's charge callable is called only when an item opens a new slot,
+    so a request merged into a waiting one is never charged for it.
+    """
+
+    def __init__(self, send_batch, window=None, max_batch=None, max_concurrent=None):
+        self.send_batch = send_batch
+        self.window = window if window is not None else float(
+            os.getenv("GEMINI_BATCH_WINDOW", "0")
+        )
+        self.max_batch = max_batch or int(os.getenv("GEMINI_BATCH_MAX_SIZE", "8"))
+        self.max_concurrent = max_concurrent or int(
+            os.getenv("GEMINI_BATCH_MAX_CONCURRENT", "4")
+        )
+        # batch_key -> {"deadline": ..., "items": {item_key: (item, future)}}
+        self._pending = {}
+        # Các batch đã đủ max_batch, chờ dispatcher gửi đi
+        self._ready = []
+        self._condition = threading.Condition()
+        self._thread = None
+        # Giới hạn số lời gọi model chạy song song
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._stopped = False
+        self.requests = 0
+        self.batches = 0
+        self.items_sent = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_batch > 1
+
+    def _ensure_started(self):
+        # Gọi khi đang giữ self._condition
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="suggestion-batcher", daemon=True
+            )
+            self._thread.start()
+
+    def submit(self, batch_key, item_key, item, charge=None):
+        """Queue an item, return a Future resolving to its result.
+
+        charge raises to refuse the item; it runs under the batcher's lock so
+        that two identical requests cannot both be charged.
+        """
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Suggestion batcher is shut down")
+            self._ensure_started()
+            self.requests += 1
+            batch = self._pending.get(batch_key)
+            entry = batch["items"].get(item_key) if batch is not None else None
+            if entry is not None:
+                return entry[1]
+            if charge is not None:
+                charge()
+            if batch is None:
+                batch = self._pending[batch_key] = {
+                    "deadline": time.monotonic() + self.window,
+                    "items": {},
+                }
+                # Dispatcher cần biết deadline mới
+                self._condition.notify()
+            future = Future()
+            batch["items"][item_key] = (item, future)
+            if len(batch["items"]) >= self.max_batch:
+                self._ready.append((batch_key, self._pending.pop(batch_key)["items"]))
+                self._condition.notify()
+            return future
+
+    def _take_due(self):
+        """Remove and return the batches that are full or past their window"""
+        now = time.monotonic()
+        due, self._ready = self._ready, []
+        for batch_key, batch in list(self._pending.items()):
+            if batch["deadline"] <= now:
+                due.append((batch_key, self._pending.pop(batch_key)["items"]))
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._take_due()
+                while not due and not self._stopped:
+                    if self._pending:
+                        deadline = min(b["deadline"] for b in self._pending.values())
+                        self._condition.wait(max(0.0, deadline - time.monotonic()))
+                    else:
+                        self._condition.wait()
+                    due = self._take_due()
+                stopped = self._stopped
+                if stopped:
+                    due += [(k, b["items"]) for k, b in self._pending.items()]
+                    self._pending.clear()
+                for _, items in due:
+                    self.batches += 1
+                    self.items_sent += len(items)
+
+            for batch_key, items in due:
+                self._slots.acquire()
+                threading.Thread(
+                    target=self._dispatch,
+                    args=(batch_key, list(items.values())),
+                    name="suggestion-batch",
+                    daemon=True,
+                ).start()
+            if stopped:
+                return
+
+    def _dispatch(self, batch_key, entries):
+        GEMINI_BATCH_SIZE.observe(len(entries))
+        try:
+            self._send(batch_key, entries)
+        finally:
+            self._slots.release()
+
+    def _send(self, batch_key, entries):
+        try:
+            results = self.send_batch(batch_key, [item for item, _ in entries])
+            if len(results) != len(entries):
+                raise ValueError(
+                    f"Batch returned {len(results)} results for {len(entries)} items"
+                )
+        except Exception as e:
+            ERRORS.inc("suggestion_batcher.dispatch")
+            print(f"Error sending suggestion batch: {e}")
+            for _, future in entries:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(entries, results):
+            future.set_result(result)
+
+    def shutdown(self, timeout=5):
+        """Send what is still waiting, then stop"""
+        with self._condition:
+            self._stopped = True
+            thread = self._thread
+            self._condition.notify()
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "enabled": self.enabled,
+                "window": self.window,
+                "max_batch": self.max_batch,
+                "waiting": sum(len(b["items"]) for b in self._pending.values())
+                + sum(len(items) for _, items in self._ready),
+                "requests": self.requests,
+                "batches": self.batches,
+                "average_batch_size": (
+                    round(self.items_sent / self.batches, 3) if self.batches else 0.0
+                ),
+            }
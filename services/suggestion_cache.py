@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache with TTL"""
+
+    # Không chạm đĩa/mạng, gọi thẳng trên event loop được
+    blocking = False
+
+    def __init__(self, max_entries=512, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCacheBackend:
+    """SQLite file cache shared by every worker process on the same host"""
+
+    blocking = True
+
+    def __init__(self, path, max_entries=512, ttl=600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS suggestions (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_last_access ON suggestions (last_access)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # Mỗi lần gọi mở một kết nối riêng để an toàn giữa các thread/process
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM suggestions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                conn.execute("DELETE FROM suggestions WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE suggestions SET last_access = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO suggestions (key, value, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM suggestions WHERE expires_at < ?", (now,))
+            conn.execute(
+                """
+                DELETE FROM suggestions WHERE key IN (
+                    SELECT key FROM suggestions ORDER BY last_access DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM suggestions WHERE key = ?", (key,))
+
+    def size(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM suggestions").fetchone()[0]
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM suggestions")
+
+
+class SuggestionCache:
+    """Cache health suggestions keyed on bucketed (temperature, humidity, noise)"""
+
+    def __init__(self, backend=None, temperature_step=None, humidity_step=None, noise_step=None):
+        self.temperature_step = temperature_step or float(
+            os.getenv("SUGGESTION_CACHE_TEMPERATURE_STEP", "1.0")
+        )
+        self.humidity_step = humidity_step or float(
+            os.getenv("SUGGESTION_CACHE_HUMIDITY_STEP", "5.0")
+        )
+        self.noise_step = noise_step or float(
+            os.getenv("SUGGESTION_CACHE_NOISE_STEP", "5.0")
+        )
+        self.backend = backend if backend is not None else self._backend_from_env()
+        self.hits = 0
+        self.misses = 0
+        self.model_calls = 0
+        self.model_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _backend_from_env():
+        backend_type = os.getenv("SUGGESTION_CACHE_BACKEND", "memory")
+        max_entries = int(os.getenv("SUGGESTION_CACHE_MAX_ENTRIES", "512"))
+        ttl = float(os.getenv("SUGGESTION_CACHE_TTL", "600"))
+        if backend_type == "disk":
+            path = os.getenv("SUGGESTION_CACHE_PATH", "cache/suggestions.sqlite3")
+            return DiskCacheBackend(path, max_entries=max_entries, ttl=ttl)
+        if backend_type == "none":
+            return None
+        return MemoryCacheBackend(max_entries=max_entries, ttl=ttl)
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @property
+    def blocking(self):
+        """True when get/set do I/O and must stay off an event loop"""
+        return getattr(self.backend, "blocking", False)
+
+    @staticmethod
+    def _bucket(value, step):
+        return int(float(value) // step)
+
+    def make_key(self, temperature, humidity, noise, context_key=None):
+        """Build the cache key from the bucketed readings and the history context"""
+        key = "{}:{}:{}".format(
+            self._bucket(temperature, self.temperature_step),
+            self._bucket(humidity, self.humidity_step),
+            self._bucket(noise, self.noise_step),
+        )
+        # Cùng chỉ số nhưng lịch sử khác (đang tăng, đã vượt ngưỡng lâu) là khuyến nghị khác
+        return f"{key}:{context_key}" if context_key else key
+
+    def get(self, temperature, humidity, noise, context_key=None):
+        """Return (suggestion_data, raw_response) or None"""
+        if not self.enabled:
+            return None
+        try:
+            cached = self.backend.get(self.make_key(temperature, humidity, noise, context_key))
+        except Exception as e:
+            print(f"Error reading suggestion cache: {e}")
+            cached = None
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return cached["suggestion"], cached["raw_response"]
+
+    def set(self, temperature, humidity, noise, suggestion_data, raw_response, context_key=None):
+        if not self.enabled:
+            return
+        try:
+            self.backend.set(
+                self.make_key(temperature, humidity, noise, context_key),
+                {"suggestion": suggestion_data, "raw_response": raw_response},
+            )
+        except Exception as e:
+            print(f"Error writing suggestion cache: {e}")
+
+    def record_model_call(self, seconds):
+        """Track model latency so stats can estimate what the hits saved"""
+        with self._lock:
+            self.model_calls += 1
+            self.model_seconds += seconds
+
+    def stats(self):
+        """Hit/miss counters of this process"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            model_calls, model_seconds = self.model_calls, self.model_seconds
+        total = hits + misses
+        avg_latency = model_seconds / model_calls if model_calls else 0.0
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__ if self.enabled else None,
+            "entries": self.backend.size() if self.enabled else 0,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            "model_calls": model_calls,
+            "avg_model_latency_seconds": round(avg_latency, 4),
+            "estimated_seconds_saved": round(hits * avg_latency, 2),
+            "model_calls_saved": hits,
+            "bucket_steps": {
+                "temperature": self.temperature_step,
+                "humidity": self.humidity_step,
+                "noise": self.noise_step,
+            },
+        }
@@ -0,0 +1,118 @@
+import re
+import json
+
+# Cặp "key": ở cuối một đoạn bị cắt, chưa có giá trị
+_DANGLING_KEY = re.compile(r'"(?:[^"\\]|\\.)*"\s*:\s*$')
+
+
+class IncrementalJSONParser:
+    """Parse the first JSON object in text that arrives in chunks.
+
+    Text before the opening brace (markdown fences, "json", prose) and after
+    the closing brace is ignored. Top-level fields are reported as soon as
+    their value is complete, and a truncated object can be recovered with
+    partial().
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self.complete = False
+        self._start = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._member_start = None
+
+    def feed(self, chunk):
+        """Add a chunk, return the top-level fields completed by it"""
+        self.text += chunk
+        completed = {}
+        if self.complete:
+            return completed
+        if self._start is None:
+            start = self.text.find("{")
+            if start == -1:
+                return completed
+            self._start = self._member_start = start + 1
+            self._pos = start + 1
+            self._depth = 1
+
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed.update(self._parse_member(text[self._member_start:i]))
+                    self.complete = True
+                    self._pos = i + 1
+                    break
+            elif char == "," and self._depth == 1:
+                completed.update(self._parse_member(text[self._member_start:i]))
+                self._member_start = i + 1
+        else:
+            self._pos = len(text)
+
+        self.fields.update(completed)
+        return completed
+
+    @staticmethod
+    def _parse_member(member):
+        if not member.strip():
+            return {}
+        return json.loads("{" + member + "}")
+
+    def partial(self):
+        """Completed fields plus whatever of the current field can be closed"""
+        recovered = dict(self.fields)
+        if self.complete or self._member_start is None:
+            return recovered
+
+        member = self.text[self._member_start:self._pos]
+        # Bỏ chuỗi đang viết dở, không giữ nửa câu
+        if self._in_string and self._string_start is not None:
+            member = member[: self._string_start - self._member_start]
+        member = member.rstrip().rstrip(",").rstrip()
+        member = _DANGLING_KEY.sub("", member).rstrip().rstrip(",")
+
+        closers = []
+        in_string = escape = False
+        for char in member:
+            if in_string:
+                if escape:
+                    escape = False
+                elif char == "\\":
+                    escape = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                closers.append("}")
+            elif char == "[":
+                closers.append("]")
+            elif char in "}]" and closers:
+                closers.pop()
+
+        try:
+            recovered.update(self._parse_member(member + "".join(reversed(closers))))
+        except ValueError:
+            pass
+        return recovered
+
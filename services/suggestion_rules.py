@@ -0,0 +1,164 @@
+import os
+import threading
+from collections import OrderedDict
+
+METRICS = ("temperature", "humidity", "noise")
+UNITS = {"temperature": "°C", "humidity": "%", "noise": "dB"}
+
+DEFAULT_RANGES = {"temperature": "20,24", "humidity": "40,60", "noise": "0,50"}
+# Khoảng trễ: đã vượt ngưỡng thì phải quay vào trong ngưỡng một đoạn mới coi là ổn
+DEFAULT_HYSTERESIS = {"temperature": "0.5", "humidity": "2", "noise": "3"}
+# Thay đổi so với lần hỏi Gemini gần nhất đủ lớn để hỏi lại
+DEFAULT_CHANGE = {"temperature": "2", "humidity": "10", "noise": "10"}
+
+RULES_RAW_RESPONSE = "local-rules"
+
+
+def comfort_range(metric):
+    """(low, high) comfort range of a metric from COMFORT_<METRIC>_RANGE"""
+    low, high = os.getenv(f"COMFORT_{metric.upper()}_RANGE", DEFAULT_RANGES[metric]).split(",")
+    return float(low), float(high)
+
+
+class SuggestionRules:
+    """Answer in-range readings locally and decide when Gemini is needed.
+
+    Each metric of a user is either in range or alerting. A metric starts
+    alerting when it leaves its comfort range and stops only once it is
+    back inside by the hysteresis margin, so readings hovering at a
+    boundary do not flip-flop. While everything is in range a template
+    suggestion is returned. While something is alerting, Gemini is asked
+    again only when a metric just crossed its threshold or a reading moved
+    far from the one behind the user's last model suggestion.
+    """
+
+    def __init__(self, ranges=None, hysteresis=None, change=None, max_users=None):
+        self.enabled = os.getenv("SUGGESTION_RULES_ENABLED", "true").lower() == "true"
+        self.ranges = ranges or {metric: comfort_range(metric) for metric in METRICS}
+        self.hysteresis = hysteresis or {
+            metric: float(
+                os.getenv(f"RULES_{metric.upper()}_HYSTERESIS", DEFAULT_HYSTERESIS[metric])
+            )
+            for metric in METRICS
+        }
+        self.change = change or {
+            metric: float(os.getenv(f"RULES_{metric.upper()}_CHANGE", DEFAULT_CHANGE[metric]))
+            for metric in METRICS
+        }
+        self.max_users = max_users or int(os.getenv("RULES_MAX_USERS", "1000"))
+        # user_id -> {"alerting": set, "last": (conditions, suggestion_data, raw_response)}
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.local = 0
+        self.reused = 0
+        self.escalated = 0
+
+    def _alerting(self, previous, conditions):
+        """Metrics outside their range, with hysteresis on the way back"""
+        alerting = set()
+        for metric in METRICS:
+            low, high = self.ranges[metric]
+            if metric in previous:
+                margin = self.hysteresis[metric]
+                low, high = low + margin, high - margin
+            if not low <= conditions[metric] <= high:
+                alerting.add(metric)
+        return alerting
+
+    def _changed(self, last, conditions):
+        return any(
+            abs(conditions[metric] - last[metric]) >= self.change[metric]
+            for metric in METRICS
+        )
+
+    def evaluate(self, user_id, temperature, humidity, noise):
+        """Return (suggestion_data, raw_response) when Gemini is not needed, else None"""
+        if not self.enabled:
+            return None
+        conditions = {
+            "temperature": float(temperature),
+            "humidity": float(humidity),
+            "noise": float(noise),
+        }
+        with self._lock:
+            state = self._states.get(user_id) if user_id is not None else None
+            previous = state["alerting"] if state else set()
+            alerting = self._alerting(previous, conditions)
+            if state is not None:
+                state["alerting"] = alerting
+                self._states.move_to_end(user_id)
+            elif alerting and user_id is not None:
+                state = self._add_state(user_id, alerting)
+
+            if not alerting:
+                self.local += 1
+                return self.in_range_suggestion(conditions), RULES_RAW_RESPONSE
+
+            last = state.get("last") if state else None
+            crossed = bool(alerting - previous)
+            if last is not None and not crossed and not self._changed(last[0], conditions):
+                self.reused += 1
+                return last[1], last[2]
+
+            self.escalated += 1
+            return None
+
+    def remember(self, user_id, temperature, humidity, noise, suggestion_data, raw_response):
+        """Record the model suggestion a user's later readings are compared with"""
+        if not self.enabled or user_id is None:
+            return
+        conditions = {
+            "temperature": float(temperature),
+            "humidity": float(humidity),
+            "noise": float(noise),
+        }
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                state = self._add_state(user_id, self._alerting(set(), conditions))
+            state["last"] = (conditions, suggestion_data, raw_response)
+            self._states.move_to_end(user_id)
+
+    def _add_state(self, user_id, alerting):
+        # Gọi khi đang giữ self._lock
+        state = self._states[user_id] = {"alerting": alerting}
+        while len(self._states) > self.max_users:
+            self._states.popitem(last=False)
+        return state
+
+    def format_range(self, metric):
+        low, high = self.ranges[metric]
+        if metric == "noise" and low <= 0:
+            return f"<{high:g} {UNITS[metric]}"
+        return f"{low:g}-{high:g}{UNITS[metric]}"
+
+    def in_range_suggestion(self, conditions):
+        return {
+            "immediate_actions": [
+                "No action needed, conditions are comfortable",
+                "Keep the room ventilated as usual",
+            ],
+            "health_impacts": [
+                "Current conditions support comfort and concentration",
+                "No health risks expected from temperature, humidity or noise",
+            ],
+            "optimal_ranges": {metric: self.format_range(metric) for metric in METRICS},
+            "summary": (
+                f"Temperature {conditions['temperature']:g}°C, humidity "
+                f"{conditions['humidity']:g}% and noise {conditions['noise']:g}dB "
+                "are all within the comfortable ranges."
+            ),
+        }
+
+    def stats(self):
+        with self._lock:
+            total = self.local + self.reused + self.escalated
+            return {
+                "enabled": self.enabled,
+                "ranges": {metric: list(self.ranges[metric]) for metric in METRICS},
+                "tracked_users": len(self._states),
+                "local": self.local,
+                "reused": self.reused,
+                "escalated": self.escalated,
+                "model_call_ratio": round(self.escalated / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,128 @@
+import os
+import queue
+import threading
+import time
+
+
+class SuggestionWorkerPool:
+    """Bounded background pool that runs suggestion jobs off the request thread"""
+
+    def __init__(self, handler, num_workers=None, max_queue=None):
+        self.handler = handler
+        self.num_workers = num_workers or int(os.getenv("SUGGESTION_WORKERS", "2"))
+        self.max_queue = max_queue or int(os.getenv("SUGGESTION_QUEUE_SIZE", "50"))
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._lock = threading.Lock()
+        self._threads = []
+        # Đặt khi không gửi được sentinel trước hạn, worker dừng sau job đang chạy
+        self._stopping = threading.Event()
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._started_at = None
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        """Start the worker threads (idempotent)"""
+        with self._lock:
+            if self._threads:
+                return
+            self._started_at = time.monotonic()
+            for index in range(self.num_workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"suggestion-worker-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        print(f"Suggestion worker pool started with {self.num_workers} workers")
+
+    def is_full(self):
+        return self._queue.full()
+
+    def submit(self, job):
+        """Queue a job, return False when the queue is full"""
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+
+            started = time.monotonic()
+            with self._lock:
+                self._busy += 1
+            try:
+                self.handler(job)
+                succeeded = True
+            except Exception as e:
+                print(f"Error processing suggestion job: {e}")
+                succeeded = False
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_seconds += time.monotonic() - started
+                self._queue.task_done()
+
+            with self._lock:
+                if succeeded:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+            if self._stopping.is_set():
+                return
+
+    def shutdown(self, timeout=5):
+        """Let queued jobs finish within timeout seconds, then stop the workers"""
+        with self._lock:
+            threads = list(self._threads)
+            self._threads = []
+        deadline = time.monotonic() + timeout
+        for _ in threads:
+            # Hàng đợi đầy thì không chờ quá hạn, bỏ các job còn lại
+            try:
+                self._queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                self._stopping.set()
+                break
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def status(self):
+        """Queue depth and worker utilisation"""
+        with self._lock:
+            busy = self._busy
+            busy_seconds = self._busy_seconds
+            running = len(self._threads)
+            uptime = (
+                time.monotonic() - self._started_at if self._started_at else 0.0
+            )
+            counters = {
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+        capacity = uptime * running
+        return {
+            "queue_length": self._queue.qsize(),
+            "max_queue": self.max_queue,
+            "workers": running,
+            "busy_workers": busy,
+            "utilisation": round(busy / running, 4) if running else 0.0,
+            "average_utilisation": (
+                round(min(busy_seconds / capacity, 1.0), 4) if capacity else 0.0
+            ),
+            **counters,
+        }
@@ -0,0 +1,268 @@
+import os
+import mmap
+import struct
+import threading
+
+from services.metrics import ERRORS
+
+try:
+    import fcntl
+except ImportError:
+    # Không có flock (Windows): coi như chỉ có một process ghi
+    fcntl = None
+
+# Mỗi bản ghi: timestamp (float64), temperature, humidity, noise (float32)
+RECORD = struct.Struct("<dfff")
+SEGMENT_SUFFIX = ".seg"
+
+
+class TimeSeriesStore:
+    """Append-only on-device store of sensor samples in rotated binary segments.
+
+    Only the process holding the directory's writer lock appends; with
+    several gunicorn workers the others skip their samples (every worker
+    samples the same sensors) and read the segments the writer produces.
+    A reader takes the lock over when the writer exits.
+    """
+
+    def __init__(self, directory, segment_records=None, max_segments=None):
+        self.directory = directory
+        self.segment_records = segment_records or int(
+            os.getenv("TIMESERIES_SEGMENT_RECORDS", "17280")
+        )
+        self.max_segments = max_segments or int(
+            os.getenv("TIMESERIES_MAX_SEGMENTS", "30")
+        )
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_count = 0
+        self._last_timestamp = None
+        self._lock_file = None
+        self.skipped = 0
+        self.out_of_order = 0
+        # Đang bỏ một chuỗi mẫu sau khi đồng hồ lùi, chỉ log mẫu đầu tiên
+        self._dropping = False
+        os.makedirs(directory, exist_ok=True)
+        if self._acquire_writer():
+            self._recover()
+
+    @property
+    def writer(self):
+        return self._lock_file is not None
+
+    def _acquire_writer(self):
+        """Take the writer lock without blocking, True when this process holds it"""
+        if self._lock_file is not None:
+            return True
+        lock_file = open(os.path.join(self.directory, "writer.lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        return True
+
+    def _segments(self):
+        """Segment paths, oldest first"""
+        names = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _recover(self):
+        segments = self._segments()
+        if not segments:
+            return
+        path = segments[-1]
+        size = os.path.getsize(path)
+        # Bỏ bản ghi ghi dở nếu thiết bị mất điện giữa chừng
+        if size % RECORD.size:
+            with open(path, "r+b") as f:
+                f.truncate(size - size % RECORD.size)
+            size -= size % RECORD.size
+        self._active_count = size // RECORD.size
+        if self._active_count:
+            with open(path, "rb") as f:
+                f.seek(size - RECORD.size)
+                self._last_timestamp = RECORD.unpack(f.read(RECORD.size))[0]
+        if self._active_count < self.segment_records:
+            self._active = open(path, "ab")
+
+    def _rotate(self, timestamp):
+        if self._active is not None:
+            self._active.close()
+        path = os.path.join(
+            self.directory, "{:016.3f}{}".format(timestamp, SEGMENT_SUFFIX)
+        )
+        self._active = open(path, "ab")
+        self._active_count = 0
+
+        segments = self._segments()
+        for old in segments[: max(0, len(segments) - self.max_segments)]:
+            os.remove(old)
+
+    def append(self, sample):
+        """Append a read_all_sensors sample.
+
+        A sample older than the last one stored (the clock went backwards) is
+        dropped and counted: the segments must stay sorted for the binary
+        search, and rewriting its timestamp would store it at the wrong time.
+        """
+        with self._lock:
+            if not self.writer:
+                # Process ghi đã thoát thì nhận lại khóa và tiếp tục từ segment cuối
+                if not self._acquire_writer():
+                    self.skipped += 1
+                    return
+                self._recover()
+            timestamp = float(sample["timestamp"])
+            if self._last_timestamp is not None and timestamp < self._last_timestamp:
+                self.out_of_order += 1
+                ERRORS.inc("timeseries_store.out_of_order")
+                if not self._dropping:
+                    print(
+                        f"Dropping samples older than the last stored one at "
+                        f"{self._last_timestamp}, first at {timestamp} (clock went backwards?)"
+                    )
+                self._dropping = True
+                return
+            self._dropping = False
+            if self._active is None or self._active_count >= self.segment_records:
+                self._rotate(timestamp)
+            self._active.write(
+                RECORD.pack(
+                    timestamp,
+                    sample["temperature"],
+                    sample["humidity"],
+                    sample["noise"],
+                )
+            )
+            self._active.flush()
+            self._active_count += 1
+            self._last_timestamp = timestamp
+
+    @staticmethod
+    def _segment_start(path):
+        """A segment is named after the timestamp of its first record"""
+        return float(os.path.basename(path)[: -len(SEGMENT_SUFFIX)])
+
+    @staticmethod
+    def _bisect(buf, count, timestamp):
+        """Index of the first record with timestamp >= the given one"""
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if RECORD.unpack_from(buf, mid * RECORD.size)[0] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    @staticmethod
+    def _sample(buf, index):
+        timestamp, temperature, humidity, noise = RECORD.unpack_from(buf, index * RECORD.size)
+        return {
+            "timestamp": timestamp,
+            "temperature": round(temperature, 1),
+            "humidity": round(humidity, 1),
+            "noise": round(noise, 1),
+        }
+
+    def _read_segment(self, path, start, end, limit):
+        """Samples of one segment with start <= timestamp < end, at most the last limit"""
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // RECORD.size
+            if not count:
+                return []
+            with mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ) as buf:
+                low = self._bisect(buf, count, start)
+                high = self._bisect(buf, count, end)
+                if limit is not None:
+                    low = max(low, high - limit)
+                return [self._sample(buf, index) for index in range(low, high)]
+
+    def range(self, start=None, end=None, limit=None):
+        """Samples with start <= timestamp < end, oldest first.
+
+        With a limit only the newest limit samples are kept: segments are
+        read newest first and reading stops once enough were found, so
+        memory and time depend on limit, not on the length of the range.
+        """
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be at least 1")
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        with self._lock:
+            segments = self._segments()
+
+        # Bỏ qua segment kết thúc trước start hoặc bắt đầu sau end
+        selected = [
+            path
+            for index, path in enumerate(segments)
+            if self._segment_start(path) < end
+            and not (index + 1 < len(segments) and self._segment_start(segments[index + 1]) < start)
+        ]
+
+        chunks = []
+        found = 0
+        for path in reversed(selected):
+            try:
+                chunk = self._read_segment(
+                    path, start, end, None if limit is None else limit - found
+                )
+            except FileNotFoundError:
+                # Segment vừa bị xoay vòng và xóa
+                continue
+            chunks.append(chunk)
+            found += len(chunk)
+            if limit is not None and found >= limit:
+                break
+        return [sample for chunk in reversed(chunks) for sample in chunk]
+
+    def _disk_last_timestamp(self):
+        """Timestamp of the last complete record on disk, for non-writer processes"""
+        for path in reversed(self._segments()):
+            try:
+                with open(path, "rb") as f:
+                    count = os.fstat(f.fileno()).st_size // RECORD.size
+                    if count:
+                        f.seek((count - 1) * RECORD.size)
+                        return RECORD.unpack(f.read(RECORD.size))[0]
+            except FileNotFoundError:
+                continue
+        return None
+
+    def latest(self, count):
+        """The last count samples, oldest first"""
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        # range đọc từ segment mới nhất và dừng khi đủ count mẫu
+        return self.range(limit=count)
+
+    def stats(self):
+        with self._lock:
+            segments = self._segments()
+            return {
+                "segments": len(segments),
+                "max_segments": self.max_segments,
+                "disk_bytes": sum(os.path.getsize(path) for path in segments),
+                "max_disk_bytes": self.max_segments * self.segment_records * RECORD.size,
+                "last_timestamp": (
+                    self._last_timestamp if self.writer else self._disk_last_timestamp()
+                ),
+                "writer": self.writer,
+                "skipped": self.skipped,
+                "out_of_order": self.out_of_order,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
@@ -0,0 +1,157 @@
+import os
+import threading
+from datetime import datetime
+
+
+class UsageAggregator:
+    """Write-behind usage counters, flushed to Firestore in batches"""
+
+    def __init__(self, firebase_service, flush_interval=None, max_pending=None):
+        self.firebase_service = firebase_service
+        self.flush_interval = flush_interval or float(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+        self.max_pending = max_pending or int(os.getenv("USAGE_MAX_PENDING", "200"))
+        # user_id -> {"count", "last_request_hour", "last_reading", "features"} chưa ghi
+        self._pending = {}
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the periodic flush thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="usage-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Thức dậy theo chu kỳ hoặc khi số lần tăng chờ ghi vượt ngưỡng
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            self.flush()
+
+    def get_user_data(self, user_id, create=True):
+        """User data with requests_this_hour including unflushed increments"""
+        # FirebaseService phục vụ từ cache hồ sơ, chỉ đọc Firestore khi hết hạn
+        return self._with_pending(
+            user_id, self.firebase_service.get_user_data(user_id, create=create)
+        )
+
+    async def get_user_data_async(self, user_id):
+        """Async get_user_data for the ASGI entry point"""
+        user_data = await self.firebase_service.get_user_data_async(user_id)
+        return self._with_pending(user_id, user_data)
+
+    def _with_pending(self, user_id, user_data):
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                if pending["count"]:
+                    user_data["requests_this_hour"] = (
+                        user_data.get("requests_this_hour", 0) + pending["count"]
+                    )
+                    user_data["last_request_hour"] = pending["last_request_hour"]
+                if pending["features"] is not None:
+                    user_data["features"] = pending["features"]
+        return user_data
+
+    def record(self, user_id, reading_data=None, requests=1):
+        """Count model requests and keep the last reading in memory.
+
+        requests is the number of Gemini calls to add to requests_this_hour,
+        0 for a reading answered by the local rules, the cache or nothing.
+        """
+        current_hour = (
+            datetime.now().replace(minute=0, second=0, microsecond=0).isoformat()
+        )
+        with self._lock:
+            pending = self._pending_for(user_id)
+            if requests:
+                pending["count"] += requests
+                pending["last_request_hour"] = current_hour
+            if reading_data is not None:
+                pending["last_reading"] = reading_data
+            self._pending_count += requests
+            should_flush = self._pending_count >= self.max_pending
+
+        if should_flush:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.flush()
+
+    def record_features(self, user_id, features):
+        """Write a user's rolling feature summary with the next flush"""
+        with self._lock:
+            self._pending_for(user_id)["features"] = features
+
+    def _pending_for(self, user_id):
+        # Gọi khi đang giữ self._lock
+        return self._pending.setdefault(
+            user_id,
+            {"count": 0, "last_request_hour": None, "last_reading": None, "features": None},
+        )
+
+    def flush(self, user_ids=None):
+        """Write accumulated increments to Firestore"""
+        with self._flush_lock:
+            with self._lock:
+                if user_ids is None:
+                    updates, self._pending = self._pending, {}
+                    self._pending_count = 0
+                else:
+                    updates = {
+                        user_id: self._pending.pop(user_id)
+                        for user_id in user_ids
+                        if user_id in self._pending
+                    }
+                    self._pending_count -= sum(u["count"] for u in updates.values())
+            if not updates:
+                return 0
+
+            try:
+                self.firebase_service.apply_usage_updates(updates)
+            except Exception as e:
+                print(f"Error flushing usage counters: {e}")
+                self._restore(updates)
+                return 0
+            return len(updates)
+
+    def _restore(self, updates):
+        """Put back updates whose flush failed so they are retried"""
+        with self._lock:
+            for user_id, update in updates.items():
+                pending = self._pending.get(user_id)
+                if pending is None:
+                    self._pending[user_id] = update
+                else:
+                    # Các lần đọc mới hơn giữ last_reading và features của chúng
+                    pending["count"] += update["count"]
+                    for field in ("last_request_hour", "last_reading", "features"):
+                        if pending[field] is None:
+                            pending[field] = update[field]
+                self._pending_count += update["count"]
+
+    def shutdown(self):
+        """Stop the flush thread and write everything still pending"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending_users": len(self._pending),
+                "pending_increments": self._pending_count,
+                "flush_interval": self.flush_interval,
+                "max_pending": self.max_pending,
+            }
@@ -0,0 +1,45 @@
+import os
+import threading
+
+from services.suggestion_cache import MemoryCacheBackend
+
+
+class UserProfileCache:
+    """TTL-bounded read-through cache of users/{id} documents"""
+
+    def __init__(self, backend=None):
+        # Backend chỉ cần get/set/delete/size, có thể thay bằng backend dùng chung
+        self.backend = backend or MemoryCacheBackend(
+            max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", "1000")),
+            ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+        )
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        user_data = self.backend.get(user_id)
+        with self._lock:
+            if user_data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return dict(user_data)
+
+    def set(self, user_id, user_data):
+        self.backend.set(user_id, dict(user_data))
+
+    def invalidate(self, user_id):
+        self.backend.delete(user_id)
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": self.backend.size(),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+        }
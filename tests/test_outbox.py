@@ -0,0 +1,181 @@
+import os
+import json
+
+import pytest
+from google.api_core.exceptions import AlreadyExists, InvalidArgument, ServiceUnavailable
+
+from services.outbox import Outbox
+
+
+class FlakyFirebase:
+    """Reading writes that fail on demand, keyed by document ID"""
+
+    def __init__(self):
+        self.failures = 0
+        self.error = ServiceUnavailable("Firestore unavailable")
+        self.rejected_keys = set()
+        self.stored = {}
+
+    def _fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+
+    def save_sensor_reading(self, user_id, reading_data, document_id=None, timeout=None):
+        self._fail()
+        if document_id in self.rejected_keys:
+            raise InvalidArgument("Bad reading")
+        if document_id in self.stored:
+            raise AlreadyExists("Document already exists")
+        self.stored[document_id] = (user_id, reading_data)
+
+    def save_keyed_readings(self, records, timeout=None):
+        self._fail()
+        for document_id, _, _ in records:
+            if document_id in self.stored:
+                raise AlreadyExists("A document in the batch already exists")
+            if document_id in self.rejected_keys:
+                raise InvalidArgument("Bad reading")
+        for document_id, user_id, reading_data in records:
+            self.stored[document_id] = (user_id, reading_data)
+
+
+@pytest.fixture
+def firebase():
+    return FlakyFirebase()
+
+
+@pytest.fixture
+def make_outbox(tmp_path, firebase):
+    outboxes = []
+
+    def make(**kwargs):
+        outbox = Outbox(str(tmp_path), firebase, backoff_base=0.001, backoff_max=0.001, **kwargs)
+        outboxes.append(outbox)
+        return outbox
+
+    yield make
+    for outbox in outboxes:
+        outbox.shutdown()
+
+
+def test_transient_failure_queues_the_reading(make_outbox, firebase):
+    outbox = make_outbox()
+    firebase.failures = 1
+
+    document_id, queued = outbox.save("u1", {"temperature": 21}, {"suggestion_status": "queued"})
+
+    assert queued
+    assert firebase.stored == {}
+    assert outbox.stats()["depth"] == 1
+    # Outbox còn hàng đợi: lần ghi sau xếp hàng luôn, không chờ Firestore
+    _, queued = outbox.save("u1", {"temperature": 22})
+    assert queued
+    assert outbox.stats()["depth"] == 2
+
+    assert outbox.drain_once() == 2
+    assert firebase.stored[document_id] == (
+        "u1",
+        {"temperature": 21, "suggestion_status": "queued"},
+    )
+    assert outbox.stats()["depth"] == 0
+    assert outbox.accepting_direct_writes
+
+
+def test_failed_upload_keeps_the_queue(make_outbox, firebase):
+    outbox = make_outbox()
+    outbox.enqueue("u1", {"temperature": 21})
+    firebase.failures = 1
+
+    assert outbox.drain_once() == 0
+    stats = outbox.stats()
+    assert stats["depth"] == 1
+    assert stats["backing_off"]
+    assert stats["last_error"]
+
+    assert outbox.drain_once() == 1
+    assert outbox.stats()["depth"] == 0
+    assert not outbox.stats()["backing_off"]
+
+
+def test_local_errors_are_not_transient(make_outbox, firebase):
+    outbox = make_outbox()
+    firebase.failures = 1
+    firebase.error = PermissionError("Disk is read-only")
+
+    with pytest.raises(PermissionError):
+        outbox.save("u1", {"temperature": 21})
+    assert outbox.stats()["depth"] == 0
+
+
+def test_rejected_batch_is_uploaded_one_by_one(make_outbox, firebase):
+    outbox = make_outbox()
+    good = outbox.enqueue("u1", {"temperature": 21})
+    bad = outbox.enqueue("u1", {"temperature": 999})
+    done = outbox.enqueue("u1", {"temperature": 22})
+    firebase.rejected_keys.add(bad)
+    # Lần thử trước đã ghi thành công dù báo lỗi
+    firebase.stored[done] = ("u1", {"temperature": 22})
+
+    assert outbox.drain_once() == 3
+    stats = outbox.stats()
+    assert stats["depth"] == 0
+    assert stats["uploaded"] == 2
+    assert stats["rejected"] == 1
+    assert good in firebase.stored
+    assert bad not in firebase.stored
+
+
+def test_queue_and_cursor_survive_a_restart(make_outbox, firebase):
+    outbox = make_outbox(batch_size=2)
+    keys = [outbox.enqueue("u1", {"temperature": 20 + i}) for i in range(5)]
+    assert outbox.drain_once() == 2
+    outbox.shutdown()
+
+    restored = make_outbox(batch_size=2)
+    assert restored.stats()["depth"] == 3
+    while restored.drain_once():
+        pass
+    assert set(firebase.stored) == set(keys)
+
+
+def test_torn_last_line_is_dropped_on_restart(make_outbox, firebase):
+    outbox = make_outbox()
+    key = outbox.enqueue("u1", {"temperature": 21})
+    outbox.shutdown()
+    segment = os.path.join(outbox.directory, sorted(os.listdir(outbox.directory))[-1])
+    # Mất điện giữa lúc ghi dòng thứ hai
+    with open(segment, "ab") as f:
+        f.write(b'{"key":"half')
+
+    restored = make_outbox()
+    assert restored.stats()["depth"] == 1
+    assert restored.drain_once() == 1
+    assert list(firebase.stored) == [key]
+
+
+def test_orphaned_queue_is_adopted_at_startup_only(tmp_path, make_outbox, firebase):
+    orphan = tmp_path / "99999999"
+    orphan.mkdir()
+    records = [
+        {"key": f"k{i}", "user_id": "u1", "reading": {"temperature": 20 + i}, "queued_at": 0}
+        for i in range(3)
+    ]
+    (orphan / "00000000000000000001.log").write_text(
+        "".join(json.dumps(record) + "\n" for record in records)
+    )
+    # Worker cũ đã tải lên bản ghi đầu tiên
+    first_line = len(json.dumps(records[0])) + 1
+    (orphan / "cursor.json").write_text(
+        json.dumps({"segment": "00000000000000000001.log", "offset": first_line})
+    )
+
+    outbox = make_outbox()
+    assert outbox.stats()["depth"] == 0
+    assert orphan.exists()
+
+    outbox.adopt_orphans()
+    assert outbox.stats()["adopted"] == 2
+    assert not orphan.exists()
+    assert outbox.drain_once() == 2
+    assert set(firebase.stored) == {"k1", "k2"}
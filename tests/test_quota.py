@@ -0,0 +1,131 @@
+import pytest
+
+from services import quota as quota_module
+from services.quota import (
+    MemoryQuotaStore,
+    QuotaExceeded,
+    QuotaManager,
+    SQLiteQuotaStore,
+    sliding_count,
+    sliding_retry_after,
+)
+
+HOUR = 3600.0
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Đầu một cửa sổ giờ để dễ tính
+    clock = Clock(1_000 * HOUR)
+    monkeypatch.setattr(quota_module.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryQuotaStore()
+    return SQLiteQuotaStore(str(tmp_path / "quota.sqlite3"))
+
+
+def manager(store, monkeypatch, **limits):
+    monkeypatch.setenv("QUOTA_ENABLED", "true")
+    for name, value in limits.items():
+        monkeypatch.setenv(f"QUOTA_{name.upper()}_LIMIT", value)
+    return QuotaManager(store=store)
+
+
+def test_store_refuses_over_limit(store, clock):
+    assert store.hit("user:u1", 3, HOUR) == (True, 0)
+    assert store.hit("user:u1", 3, HOUR, cost=2) == (True, 0)
+    allowed, retry_after = store.hit("user:u1", 3, HOUR)
+    assert not allowed
+    # Ba lượt đều trong cửa sổ hiện tại: chờ sang cửa sổ sau và giảm đủ một lượt
+    assert retry_after == pytest.approx(HOUR + HOUR / 3)
+
+
+def test_retry_after_is_when_the_sliding_window_has_room(store, clock):
+    for _ in range(3):
+        assert store.hit("user:u1", 3, HOUR)[0]
+    clock.now += HOUR + 10  # sang cửa sổ sau, 3 lượt cũ vẫn nặng gần đủ
+    allowed, retry_after = store.hit("user:u1", 3, HOUR)
+    assert not allowed
+    assert retry_after == pytest.approx(HOUR / 3 - 10)
+
+    clock.now += retry_after - 1
+    assert not store.hit("user:u1", 3, HOUR)[0]
+    clock.now += 2
+    assert store.hit("user:u1", 3, HOUR)[0]
+
+
+def test_sliding_retry_after_leaves_room():
+    window, limit = 60.0, 10
+    for previous, current, now in [(10, 0, 6000.0), (9, 6, 6030.0), (0, 10, 6059.0), (4, 9, 6001.0)]:
+        assert sliding_count(previous, current, window, now) + 1 > limit
+        wait = sliding_retry_after(previous, current, limit, window, now)
+        later = now + wait
+        if (later // window) == (now // window):
+            count = sliding_count(previous, current, window, later)
+        else:
+            count = sliding_count(current, 0, window, later)
+        assert count + 1 <= limit + 1e-9
+
+
+def test_manager_blocks_locally_until_store_allows(store, clock, monkeypatch):
+    quota = manager(store, monkeypatch, user="2 per hour")
+    assert quota.check_request("u1") is None
+    assert quota.check_request("u1") is None
+    scope, limit, retry_after = quota.check_request("u1")
+    assert (scope, limit) == ("user", "2 per 1 hour")
+
+    calls = quota.store_calls
+    assert quota.check_request("u1") is not None
+    assert quota.store_calls == calls  # từ chối tại chỗ
+
+    # Hết hạn chặn đúng lúc bộ đếm chung cho phép lại
+    clock.now += retry_after
+    assert quota.check_request("u1") is None
+
+
+def test_workers_agree_on_shared_store(tmp_path, clock, monkeypatch):
+    path = str(tmp_path / "quota.sqlite3")
+    first = manager(SQLiteQuotaStore(path), monkeypatch, user="2 per hour")
+    second = manager(SQLiteQuotaStore(path), monkeypatch, user="2 per hour")
+    assert first.check_request("u1") is None
+    assert second.check_request("u1") is None
+    refused_first = first.check_request("u1")
+    refused_second = second.check_request("u1")
+    assert refused_first is not None and refused_second is not None
+    assert refused_first[2] == refused_second[2]
+
+
+def test_key_is_checked_before_user(store, clock, monkeypatch):
+    quota = manager(store, monkeypatch, user="2 per hour", api_key="1 per minute")
+    assert quota.check_request("u1", api_key="k") is None
+    assert quota.check_request("u1", api_key="k")[0] == "api_key"
+    # Lượt bị key từ chối không trừ vào quota của user
+    assert quota.check_request("u1", api_key="other") is None
+
+
+def test_require_raises(store, clock, monkeypatch):
+    quota = manager(store, monkeypatch, user="1 per hour")
+    quota.require("u1")
+    with pytest.raises(QuotaExceeded) as excinfo:
+        quota.require("u1")
+    assert excinfo.value.to_dict()["scope"] == "user"
+    assert excinfo.value.retry_after > 0
+
+
+def test_disabled_quota_allows_everything(store, monkeypatch):
+    monkeypatch.setenv("QUOTA_ENABLED", "false")
+    quota = QuotaManager(store=store)
+    for _ in range(10):
+        assert quota.check_request("u1") is None
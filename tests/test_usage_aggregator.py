@@ -0,0 +1,104 @@
+import pytest
+
+from services.usage_aggregator import UsageAggregator
+
+USAGE_FIELDS = ("count", "last_request_hour", "last_reading", "features")
+
+
+class FlakyFirebase:
+    """apply_usage_updates that fails on demand and checks the update fields"""
+
+    def __init__(self):
+        self.failures = 0
+        self.before_failure = None
+        self.applied = []
+
+    def apply_usage_updates(self, updates):
+        if self.failures:
+            self.failures -= 1
+            if self.before_failure is not None:
+                self.before_failure()
+            raise ConnectionError("Firestore unavailable")
+        for user_id, update in updates.items():
+            assert set(update) == set(USAGE_FIELDS)
+            if update["count"]:
+                assert update["last_request_hour"] is not None, user_id
+                assert update["last_reading"] is not None, user_id
+        self.applied.append(updates)
+
+    def get_user_data(self, user_id, create=True):
+        return {"requests_this_hour": 0}
+
+
+@pytest.fixture
+def firebase():
+    return FlakyFirebase()
+
+
+@pytest.fixture
+def aggregator(firebase):
+    return UsageAggregator(firebase, flush_interval=60, max_pending=1000)
+
+
+def test_flush_writes_pending_counts(aggregator, firebase):
+    aggregator.record("u1", {"temperature": 21})
+    aggregator.record("u1", {"temperature": 22})
+
+    assert aggregator.flush() == 1
+    assert firebase.applied[0]["u1"]["count"] == 2
+    assert firebase.applied[0]["u1"]["last_reading"] == {"temperature": 22}
+    assert aggregator.stats()["pending_increments"] == 0
+
+
+def test_failed_flush_is_retried(aggregator, firebase):
+    aggregator.record("u1", {"temperature": 21})
+    firebase.failures = 1
+
+    assert aggregator.flush() == 0
+    assert aggregator.stats()["pending_increments"] == 1
+    assert aggregator.get_user_data("u1")["requests_this_hour"] == 1
+
+    assert aggregator.flush() == 1
+    assert firebase.applied[0]["u1"]["count"] == 1
+
+
+def test_restore_into_features_only_entry(aggregator, firebase):
+    aggregator.record("u1", {"temperature": 21})
+    aggregator.record("u2", {"temperature": 30})
+    # Trong lúc flush đang lỗi, một lần đọc không gọi Gemini chỉ ghi features
+    firebase.failures = 1
+    firebase.before_failure = lambda: aggregator.record_features("u1", {"ewma": 1.0})
+
+    assert aggregator.flush() == 0
+    assert aggregator.flush() == 2
+
+    update = firebase.applied[0]["u1"]
+    assert update["count"] == 1
+    assert update["last_reading"] == {"temperature": 21}
+    assert update["last_request_hour"] is not None
+    assert update["features"] == {"ewma": 1.0}
+    assert firebase.applied[0]["u2"]["count"] == 1
+
+
+def test_restore_keeps_newer_reading(aggregator, firebase):
+    aggregator.record("u1", {"temperature": 21})
+    firebase.failures = 1
+    firebase.before_failure = lambda: aggregator.record("u1", {"temperature": 25})
+
+    aggregator.flush()
+    aggregator.flush()
+
+    update = firebase.applied[0]["u1"]
+    assert update["count"] == 2
+    assert update["last_reading"] == {"temperature": 25}
+
+
+def test_reading_without_model_call_is_not_counted(aggregator, firebase):
+    aggregator.record("u1", {"temperature": 21}, requests=0)
+    aggregator.record("u1", {"temperature": 22})
+
+    assert aggregator.get_user_data("u1")["requests_this_hour"] == 1
+    aggregator.flush()
+    update = firebase.applied[0]["u1"]
+    assert update["count"] == 1
+    assert update["last_reading"] == {"temperature": 22}